@@ -1,3 +1,7 @@
 def profile_changed(sender, instance, **kwargs):
     from accounts.services import UserService
-    UserService.invalidate_profile(instance.user_id)
\ No newline at end of file
+    from django.contrib.auth.models import User
+    from utils.memcached_helper import MemcachedHelper
+    UserService.invalidate_profile(instance.user_id)
+    # get_users_through_cache 写进 L1 的 user 带着 _cached_user_profile，需要一起删除
+    MemcachedHelper.invalidate_cached_object(User, instance.user_id)
\ No newline at end of file
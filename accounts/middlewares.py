@@ -0,0 +1,17 @@
+from accounts.services import UserService
+
+
+class LastSeenMiddleware:
+    """
+    记录登录用户最近一次访问的时间，fanout 的时候用来跳过不活跃的 followers
+    需要放在 AuthenticationMiddleware 后面
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.user.is_authenticated:
+            UserService.touch_last_seen(request.user.id)
+        return response
@@ -1,12 +1,22 @@
 from accounts.models import UserProfile
 from django.conf import settings
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import USER_PROFILE_PATTERN, USER_LAST_SEEN_KEY
 from django.contrib.auth.models import User
+from utils.local_cache import LocalCache
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 记录这个进程最近写过 last seen 的 users，避免每个请求都写一次 redis
+last_seen_updates = LocalCache(
+    max_size = settings.LOCAL_CACHE_MAX_SIZE,
+    ttl = settings.USER_LAST_SEEN_UPDATE_INTERVAL,
+)
+
 
 class UserService:
 
@@ -21,6 +31,35 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        # 返回 user_id -> profile，一次 get_many，miss 的用一次 user_id__in 查询
+        keys = {
+            user_id: USER_PROFILE_PATTERN.format(user_id = user_id)
+            for user_id in user_ids
+        }
+        cached = cache.get_many(list(keys.values()))
+        profiles = {
+            user_id: cached[key]
+            for user_id, key in keys.items()
+            if key in cached
+        }
+
+        missed_ids = [user_id for user_id in keys if user_id not in profiles]
+        if not missed_ids:
+            return profiles
+        for profile in UserProfile.objects.filter(user_id__in = missed_ids):
+            profiles[profile.user_id] = profile
+        # 和 get_profile_through_cache 一样，还没有 profile 的 user 创建一个
+        for user_id in missed_ids:
+            if user_id not in profiles:
+                profiles[user_id], _ = UserProfile.objects.get_or_create(user_id = user_id)
+        cache.set_many({
+            keys[user_id]: profiles[user_id]
+            for user_id in missed_ids
+        })
+        return profiles
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id = user_id)
@@ -28,4 +67,46 @@ class UserService:
 
     @classmethod
     def get_user_by_id(cls, user_id):
-        return MemcachedHelper.get_object_through_cache(User, user_id)
\ No newline at end of file
+        return MemcachedHelper.get_object_through_cache(User, user_id)
+
+    @classmethod
+    def get_users_through_cache(cls, user_ids):
+        """
+        批量读取 users 和他们的 profile，渲染一页数据之前调用
+        profile 和 get_profile 一样记在 user 的 _cached_user_profile 上，并且把 user 重新写进 L1
+        渲染的时候 cached_user 从 L1 读到的 user 已经带着 profile，不用再读 memcached
+        """
+        user_ids = list(dict.fromkeys(
+            user_id for user_id in user_ids if user_id is not None
+        ))
+        users = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        missed_users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        profiles = cls.get_profiles_through_cache([user.id for user in missed_users])
+        for user in missed_users:
+            setattr(user, '_cached_user_profile', profiles[user.id])
+        MemcachedHelper.set_local_objects(User, missed_users)
+        return users
+
+    @classmethod
+    def touch_last_seen(cls, user_id):
+        if last_seen_updates.get(user_id) is not None:
+            return
+        conn = RedisClient.get_connection()
+        conn.hset(USER_LAST_SEEN_KEY, user_id, int(time.time()))
+        last_seen_updates.set(user_id, True)
+
+    @classmethod
+    def clear_last_seen_updates(cls):
+        last_seen_updates.clear()
+
+    @classmethod
+    def get_last_seen_many(cls, user_ids):
+        # 返回 user_id -> timestamp，没有记录的 user 是 None
+        if not user_ids:
+            return {}
+        conn = RedisClient.get_connection()
+        values = conn.hmget(USER_LAST_SEEN_KEY, user_ids)
+        return {
+            user_id: int(value) if value is not None else None
+            for user_id, value in zip(user_ids, values)
+        }
@@ -1,5 +1,16 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
+from django.contrib.auth.models import User
 from testing.testcases import TestCase
+from utils.local_cache import LocalCache
+from utils.memcached_helper import MemcachedHelper, cache, local_cache
+from utils.redis_client import RedisClient
+from twitter.cache import USER_LAST_SEEN_KEY
+
+from unittest import mock
+
+import pickle
 
 
 class UserProfileTests(TestCase):
@@ -13,3 +24,165 @@ class UserProfileTests(TestCase):
         p = rui.profile
         self.assertEqual(isinstance(p, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
+
+
+class LastSeenTests(TestCase):
+
+    def test_last_seen(self):
+        rui, rui_client = self.create_user_and_client('rui')
+        conn = RedisClient.get_connection()
+        self.assertEqual(UserService.get_last_seen_many([rui.id]), {rui.id: None})
+
+        # 匿名访问不记录
+        self.anonymous_client.get('/api/tweets/', {'user_id': rui.id})
+        self.assertEqual(conn.hlen(USER_LAST_SEEN_KEY), 0)
+
+        rui_client.get('/api/newsfeeds/')
+        seen_at = UserService.get_last_seen_many([rui.id])[rui.id]
+        self.assertNotEqual(seen_at, None)
+
+        # 同一个进程里短时间内不重复写 redis
+        conn.hset(USER_LAST_SEEN_KEY, rui.id, 1)
+        rui_client.get('/api/newsfeeds/')
+        self.assertEqual(UserService.get_last_seen_many([rui.id])[rui.id], 1)
+        UserService.clear_last_seen_updates()
+        rui_client.get('/api/newsfeeds/')
+        self.assertEqual(UserService.get_last_seen_many([rui.id])[rui.id] >= seen_at, True)
+
+
+class MemcachedHelperTests(TestCase):
+
+    def setUp(self):
+        super(MemcachedHelperTests, self).setUp()
+        self.rui = self.create_user('rui')
+        self.clear_cache()
+        MemcachedHelper.reset_stats()
+
+    def test_local_cache(self):
+        cache = LocalCache(max_size = 2, ttl = 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b 是最久没有使用的，被淘汰
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+
+        cache = LocalCache(max_size = 2, ttl = 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_tiers(self):
+        # 两层 cache 都 miss，从数据库读取
+        with self.assertNumQueries(1):
+            user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(user.username, 'rui')
+
+        # L1 hit，不访问 memcached
+        with self.assertNumQueries(0):
+            user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(MemcachedHelper.get_stats(), {
+            'local': {'hits': 1, 'misses': 1},
+            'memcached': {'hits': 0, 'misses': 1},
+        })
+
+        # 其他进程的 L1 被清空之后从 memcached 读取
+        MemcachedHelper.clear_local_cache()
+        users = MemcachedHelper.get_objects_through_cache(User, [self.rui.id])
+        self.assertEqual([u.id for u in users], [self.rui.id])
+        self.assertEqual(MemcachedHelper.get_stats(), {
+            'local': {'hits': 1, 'misses': 2},
+            'memcached': {'hits': 1, 'misses': 1},
+        })
+
+    def test_local_cache_returns_copies(self):
+        user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        user.username = 'changed'
+        setattr(user, '_cached_user_profile', None)
+        # L1 hit 每次得到一个新的 object，调用方的修改不会影响下一次读取
+        with self.assertNumQueries(0):
+            cached_user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertIsNot(cached_user, user)
+        self.assertEqual(cached_user.username, 'rui')
+        self.assertEqual(hasattr(cached_user, '_cached_user_profile'), False)
+        users = MemcachedHelper.get_objects_through_cache(User, [self.rui.id])
+        users[0].username = 'changed'
+        self.assertEqual(MemcachedHelper.get_object_through_cache(User, self.rui.id).username, 'rui')
+
+    def test_invalidation(self):
+        key = MemcachedHelper.get_key(User, self.rui.id)
+        MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertNotEqual(local_cache.get(key), None)
+
+        # 修改 user 之后 L1 和 memcached 里的都会被删除
+        self.rui.username = 'michael'
+        self.rui.save()
+        self.assertEqual(local_cache.get(key), None)
+        user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(user.username, 'michael')
+
+        # 其他进程广播的 invalidation，在下一次读取之前处理
+        local_cache.set(key, pickle.dumps(User(id = self.rui.id, username = 'stale')))
+        conn = RedisClient.get_connection()
+        conn.publish(settings.LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+        user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(user.username, 'michael')
+
+    def test_get_users_through_cache(self):
+        ming = self.create_user('ming')
+        ming.profile.nickname = 'ming'
+        ming.profile.save()
+        self.rui.profile
+        self.clear_cache()
+
+        # users 和 profiles 各一次查询
+        with self.assertNumQueries(2):
+            users = UserService.get_users_through_cache([ming.id, self.rui.id, ming.id, None])
+        self.assertEqual([user.id for user in users], [ming.id, self.rui.id])
+
+        # 渲染的时候不再访问数据库，cached_user 从 L1 读到的 user 带着 profile，也不再读 memcached
+        with self.assertNumQueries(0), \
+                mock.patch.object(cache, 'get', wraps = cache.get) as cache_get, \
+                mock.patch.object(cache, 'get_many', wraps = cache.get_many) as cache_get_many:
+            self.assertEqual(users[0].profile.nickname, 'ming')
+            for user_id in [ming.id, self.rui.id]:
+                user = MemcachedHelper.get_object_through_cache(User, user_id)
+                self.assertEqual(user.profile.user_id, user_id)
+            self.assertEqual(user.profile.user_id, self.rui.id)
+        self.assertEqual(cache_get.call_count, 0)
+        self.assertEqual(cache_get_many.call_count, 0)
+        self.assertEqual(
+            MemcachedHelper.get_object_through_cache(User, ming.id).profile.nickname,
+            'ming',
+        )
+
+        # profile 修改之后 L1 里带着旧 profile 的 user 被删除
+        profile = ming.profile
+        profile.nickname = 'ming2'
+        profile.save()
+        user = MemcachedHelper.get_object_through_cache(User, ming.id)
+        self.assertEqual(user.profile.nickname, 'ming2')
+
+        # L1 被清空之后从 memcached 批量读取
+        MemcachedHelper.clear_local_cache()
+        with self.assertNumQueries(0):
+            users = UserService.get_users_through_cache([ming.id, self.rui.id])
+        self.assertEqual(users[1].profile.user_id, self.rui.id)
+
+    def test_cache_lease(self):
+        key = MemcachedHelper.get_key(User, self.rui.id)
+
+        # 其他进程正在读取数据库，等不到的话自己读取，但是不写回 memcached
+        cache.add('lease:{}'.format(key), 1)
+        user = MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(user.id, self.rui.id)
+        self.assertEqual(cache.get(key), None)
+
+        cache.delete('lease:{}'.format(key))
+        MemcachedHelper.clear_local_cache()
+        MemcachedHelper.get_object_through_cache(User, self.rui.id)
+        self.assertEqual(cache.get(key).id, self.rui.id)
+        self.assertEqual(cache.get('lease:{}'.format(key)), None)
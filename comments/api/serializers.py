@@ -4,6 +4,8 @@ from rest_framework.exceptions import ValidationError
 from accounts.api.serializers import UserSerializerForComment
 from tweets.models import Tweet
 from likes.services import LikeService
+from accounts.services import UserService
+from utils.serializers import PrefetchListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -13,6 +15,7 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
+        list_serializer_class = PrefetchListSerializer
         fields = (
             'id',
             'tweet_id',
@@ -23,6 +26,9 @@ class CommentSerializer(serializers.ModelSerializer):
             'has_liked',
         )
 
+    def prefetch(self, comments):
+        UserService.get_users_through_cache([comment.user_id for comment in comments])
+
     def get_likes_count(self, obj):
         return obj.like_set.count()
 
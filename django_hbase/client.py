@@ -1,13 +1,289 @@
+from contextlib import contextmanager
 from django.conf import settings
+from django.utils.module_loading import import_string
+from thriftpy2.thrift import TException
 
 import happybase
+import os
+import queue
+import socket
+import threading
+import time
+
+
+class NoConnectionsAvailable(Exception):
+    pass
+
+
+class HBaseConnectionPool:
+    """
+    有上限的、线程安全的 HBase connection pool
+    - checkout: 从 pool 里取出一个 connection，pool 空了并且已经达到上限则等待
+    - checkin: 用完之后放回 pool
+    - 同一个线程里嵌套的 with pool.connection() 会复用同一个 connection（引用计数）
+    - lazy 的 scanner 使用 exclusive = True，单独 checkout 一个 connection
+    - checkout 的时候做 health check，长时间闲置的 connection 会先 ping 一下
+    - 使用过程中出现 Thrift/socket 异常的 connection 会被丢弃并重新建立
+    - connection_class 默认是 happybase.Connection，也可以换成其他实现了同样接口的 class
+    """
+
+    def __init__(
+        self,
+        size,
+        timeout = None,
+        health_check_interval = None,
+        connection_class = None,
+        **connection_kwargs
+    ):
+        if size <= 0:
+            raise ValueError('HBase connection pool size must be greater than zero')
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.connection_class = connection_class or happybase.Connection
+        self.connection_kwargs = connection_kwargs
+
+        # LIFO，尽量复用刚刚用过的（更可能是健康的）connection
+        self._queue = queue.LifoQueue(maxsize = size)
+        self._lock = threading.Lock()
+        self._thread_local = threading.local()
+        self._created = 0
+        self._last_used = {}
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'checkout_time_total': 0.0,
+            'checkout_time_max': 0.0,
+            'reconnects': 0,
+            'health_check_failures': 0,
+            'timeouts': 0,
+        }
+
+    def _new_connection(self):
+        return self.connection_class(**self.connection_kwargs)
+
+    def _acquire(self, timeout):
+        # 先尝试不等待直接拿一个闲置的 connection
+        try:
+            return self._queue.get_nowait(), 0.0
+        except queue.Empty:
+            pass
+
+        # 没有闲置的，如果还没有达到上限就新建一个
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._new_connection(), 0.0
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # 达到上限，只能等别的线程 checkin
+        start = time.monotonic()
+        try:
+            conn = self._queue.get(timeout = timeout)
+        except queue.Empty:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise NoConnectionsAvailable(
+                f'No HBase connection available within {timeout} seconds'
+            )
+        waited = time.monotonic() - start
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return conn, waited
+
+    def _release(self, conn):
+        self._last_used[id(conn)] = time.monotonic()
+        self._queue.put_nowait(conn)
+
+    def _reconnect(self, conn):
+        # 关掉旧的 connection 换一个新的，新的也建不起来的话把名额让出来再抛出异常
+        # 这样调用者不会把已经关掉的 connection 放回 pool
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats['reconnects'] += 1
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _check_health(self, conn):
+        # transport 已经断开了，直接重连
+        if not conn.transport.is_open():
+            try:
+                conn.open()
+                return conn
+            except Exception:
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                return self._reconnect(conn)
+
+        # 闲置太久的 connection 可能已经被服务端或者中间的网络设备断开了
+        # 用一个很轻量的 rpc ping 一下
+        if self.health_check_interval is None:
+            return conn
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return conn
+        try:
+            conn.tables()
+            return conn
+        except Exception:
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+            return self._reconnect(conn)
+
+    def _checkout(self, timeout):
+        conn, _ = self._acquire(self.timeout if timeout is None else timeout)
+        # health check 失败会重连，重连也失败的时候 _reconnect 已经把名额让出来了
+        conn = self._check_health(conn)
+        with self._lock:
+            self._stats['checkouts'] += 1
+        return conn
+
+    @contextmanager
+    def connection(self, timeout = None, exclusive = False):
+        """
+        同一个线程里嵌套使用的时候复用同一个 connection，用引用计数决定什么时候 checkin
+        exclusive = True 的时候单独 checkout 一个 connection，不和其他 with 共用
+        lazy 的 scanner（generator）需要 exclusive，否则外层的 with 结束的时候 connection 被 checkin
+        其他线程 checkout 之后会和还没有结束的 scanner 同时使用这个 connection
+        """
+        if exclusive:
+            with self._exclusive_connection(timeout) as conn:
+                yield conn
+            return
+
+        state = self._thread_local
+        if getattr(state, 'depth', 0) == 0:
+            state.conn = self._checkout(timeout)
+            state.tainted = False
+            state.checkout_at = time.monotonic()
+            state.depth = 0
+
+        state.depth += 1
+        try:
+            yield state.conn
+        except (TException, socket.error):
+            # Thrift 层出错之后无法确定这个 connection 是否还可用，checkin 的时候换一个新的
+            state.tainted = True
+            raise
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                conn = state.conn
+                state.conn = None
+                self._checkin(conn, state.checkout_at, state.tainted)
+
+    @contextmanager
+    def _exclusive_connection(self, timeout):
+        conn = self._checkout(timeout)
+        checkout_at = time.monotonic()
+        tainted = False
+        try:
+            yield conn
+        except (TException, socket.error):
+            tainted = True
+            raise
+        finally:
+            self._checkin(conn, checkout_at, tainted)
+
+    def _checkin(self, conn, checkout_at, tainted):
+        held = time.monotonic() - checkout_at
+        with self._lock:
+            self._stats['checkout_time_total'] += held
+            self._stats['checkout_time_max'] = max(self._stats['checkout_time_max'], held)
+        if tainted:
+            try:
+                conn = self._reconnect(conn)
+            except Exception:
+                # 连新的 connection 都建不起来，_reconnect 已经把名额让出来了，下次 checkout 再重建
+                return
+        self._release(conn)
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get_free_count(self):
+        # 不需要等待就能 checkout 的 connection 个数：闲置的加上还可以新建的
+        with self._lock:
+            not_created = self.size - self._created
+        return not_created + self._queue.qsize()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['created'] = self._created
+        stats['idle'] = self._queue.qsize()
+        stats['in_use'] = stats['created'] - stats['idle']
+        checkouts = stats['checkouts'] or 1
+        stats['wait_time_avg'] = stats['wait_time_total'] / checkouts
+        stats['checkout_time_avg'] = stats['checkout_time_total'] / checkouts
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                conn = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
 
 class HBaseClient:
-    conn = None
+    pool = None
+    pool_pid = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        # gunicorn / celery 的 worker 是 fork 出来的，fork 之后不能和父进程共用 socket
+        # 所以每个进程自己创建一个 pool
+        pid = os.getpid()
+        if cls.pool is not None and cls.pool_pid == pid:
+            return cls.pool
+        with cls.lock:
+            if cls.pool is None or cls.pool_pid != pid:
+                cls.pool = HBaseConnectionPool(
+                    size = settings.HBASE_POOL_SIZE,
+                    timeout = settings.HBASE_POOL_TIMEOUT,
+                    health_check_interval = settings.HBASE_POOL_HEALTH_CHECK_INTERVAL,
+                    connection_class = import_string(settings.HBASE_BACKEND),
+                    host = settings.HBASE_HOST,
+                )
+                cls.pool_pid = pid
+        return cls.pool
+
+    @classmethod
+    def connection(cls, timeout = None, exclusive = False):
+        # with HBaseClient.connection() as conn:
+        #     conn.table(...)
+        return cls.get_pool().connection(timeout = timeout, exclusive = exclusive)
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
\ No newline at end of file
+    def get_pool_stats(cls):
+        return cls.get_pool().get_stats()
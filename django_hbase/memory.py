@@ -0,0 +1,463 @@
+"""
+进程内存里的 HBase，实现了 django_hbase 用到的 happybase Connection / Table / Batch 接口
+row key 按照字典序排好，scan 的 start / stop / prefix / reverse 语义和 hbase 一致
+用于单元测试和 benchmark，不需要启动 hbase thrift server
+
+settings.HBASE_BACKEND = 'django_hbase.memory.Connection'
+"""
+import bisect
+import operator
+import re
+import threading
+
+# 同一个进程里的所有 connection 共享同一份数据，就像连接的是同一个 hbase
+_tables = {}
+_lock = threading.RLock()
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def _bytes_increment(value):
+    # 比所有以 value 为前缀的 row key 都大的最小的 row key，和 happybase 的实现一致
+    value = bytearray(value)
+    while value and value[-1] == 0xff:
+        value.pop()
+    if not value:
+        return None
+    value[-1] += 1
+    return bytes(value)
+
+
+class _TableData:
+
+    def __init__(self, families):
+        self.families = families
+        # 排好序的 row key 列表，用 bisect 做范围查询
+        self.keys = []
+        # row key -> {b'cf:qualifier': value}
+        self.rows = {}
+
+    def put(self, row_key, data):
+        row = self.rows.get(row_key)
+        if row is None:
+            bisect.insort(self.keys, row_key)
+            row = self.rows[row_key] = {}
+        row.update(data)
+
+    def delete(self, row_key, columns = None):
+        row = self.rows.get(row_key)
+        if row is None:
+            return
+        if columns is not None:
+            for column in list(row):
+                if _match_columns(column, columns):
+                    del row[column]
+            if row:
+                return
+        del self.rows[row_key]
+        del self.keys[bisect.bisect_left(self.keys, row_key)]
+
+
+def _match_columns(column, columns):
+    # columns 里可以是 b'cf:qualifier' 也可以是整个 column family b'cf'
+    family = column.split(b':', 1)[0]
+    return column in columns or family in columns
+
+
+def _project(row, columns):
+    if columns is None:
+        return dict(row)
+    return {
+        column: value
+        for column, value in row.items()
+        if _match_columns(column, columns)
+    }
+
+
+class _Transport:
+
+    def __init__(self):
+        self.opened = False
+
+    def is_open(self):
+        return self.opened
+
+
+class Connection:
+
+    def __init__(self, host = None, port = None, autoconnect = True, **kwargs):
+        self.host = host
+        self.port = port
+        self.transport = _Transport()
+        if autoconnect:
+            self.open()
+
+    def open(self):
+        self.transport.opened = True
+
+    def close(self):
+        self.transport.opened = False
+
+    def table(self, name):
+        return Table(_to_bytes(name).decode('utf-8'), self)
+
+    def tables(self):
+        with _lock:
+            return [name.encode('utf-8') for name in _tables]
+
+    def create_table(self, name, families):
+        with _lock:
+            if name in _tables:
+                raise ValueError(f'Table {name} already exists')
+            _tables[name] = _TableData(families)
+
+    def delete_table(self, name, disable = False):
+        with _lock:
+            if name not in _tables:
+                raise ValueError(f'Table {name} does not exist')
+            del _tables[name]
+
+
+class Table:
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+
+    def _data(self):
+        data = _tables.get(self.name)
+        if data is None:
+            raise ValueError(f'Table {self.name} does not exist')
+        return data
+
+    def row(self, row, columns = None, timestamp = None, include_timestamp = False):
+        with _lock:
+            data = self._data().rows.get(_to_bytes(row))
+            if data is None:
+                return {}
+            return _project(data, self._column_keys(columns))
+
+    def rows(self, rows, columns = None, timestamp = None, include_timestamp = False):
+        # 和 hbase 一样只返回存在的 row
+        columns = self._column_keys(columns)
+        results = []
+        with _lock:
+            table_rows = self._data().rows
+            for row_key in rows:
+                row_key = _to_bytes(row_key)
+                data = table_rows.get(row_key)
+                if data is not None:
+                    results.append((row_key, _project(data, columns)))
+        return results
+
+    def scan(
+        self,
+        row_start = None,
+        row_stop = None,
+        row_prefix = None,
+        columns = None,
+        filter = None,
+        timestamp = None,
+        include_timestamp = False,
+        batch_size = 1000,
+        scan_batching = None,
+        limit = None,
+        sorted_columns = False,
+        reverse = False,
+    ):
+        if row_prefix is not None:
+            if row_start is not None or row_stop is not None:
+                raise TypeError(
+                    "'row_prefix' cannot be combined with 'row_start' or 'row_stop'"
+                )
+            row_prefix = _to_bytes(row_prefix)
+            # 和 happybase 一样转换成 start / stop，所以 reverse 的时候和 prefix 完全相等的 row
+            # 不会返回，而 prefix 加一之后的那个 row 会返回，真实的 hbase 也是这样
+            if reverse:
+                row_start, row_stop = _bytes_increment(row_prefix), row_prefix
+            else:
+                row_start, row_stop = row_prefix, _bytes_increment(row_prefix)
+        row_start = _to_bytes(row_start) or None
+        row_stop = _to_bytes(row_stop) or None
+
+        # 先在锁里面取出范围内的 row key，然后再一行一行地返回
+        with _lock:
+            keys = self._data().keys
+            if not reverse:
+                # [row_start, row_stop)
+                begin = 0 if row_start is None else bisect.bisect_left(keys, row_start)
+                end = len(keys) if row_stop is None else bisect.bisect_left(keys, row_stop)
+                row_keys = keys[begin:end]
+            else:
+                # reverse 的时候 row_start 是上界（包含），row_stop 是下界（不包含）
+                begin = 0 if row_stop is None else bisect.bisect_right(keys, row_stop)
+                end = len(keys) if row_start is None else bisect.bisect_right(keys, row_start)
+                row_keys = keys[begin:end][::-1]
+        return self._scan_rows(
+            row_keys,
+            self._column_keys(columns),
+            None if filter is None else parse_filter(filter),
+            limit,
+        )
+
+    def _scan_rows(self, row_keys, columns, row_filter, limit):
+        returned = 0
+        for row_key in row_keys:
+            if limit is not None and returned >= limit:
+                return
+            with _lock:
+                data = self._data().rows.get(row_key)
+                if data is None:
+                    # scan 过程中被删掉了
+                    continue
+                data = dict(data)
+            if row_filter is not None:
+                data = row_filter.filter_row(row_key, data)
+                if data is None:
+                    continue
+            data = _project(data, columns)
+            if not data:
+                continue
+            returned += 1
+            yield row_key, data
+
+    def put(self, row, data, timestamp = None, wal = True):
+        data = {_to_bytes(column): _to_bytes(value) for column, value in data.items()}
+        with _lock:
+            self._data().put(_to_bytes(row), data)
+
+    def delete(self, row, columns = None, timestamp = None, wal = True):
+        with _lock:
+            self._data().delete(_to_bytes(row), self._column_keys(columns))
+
+    def batch(self, timestamp = None, batch_size = None, transaction = False, wal = True):
+        return Batch(self, batch_size = batch_size, transaction = transaction)
+
+    def counter_get(self, row, column):
+        # 和 hbase 一样，不存在的 counter 是 0
+        return self.counter_inc(row, column, value = 0)
+
+    def counter_set(self, row, column, value = 0):
+        self.put(row, {column: int(value).to_bytes(8, 'big', signed = True)})
+
+    def counter_inc(self, row, column, value = 1):
+        row, column = _to_bytes(row), _to_bytes(column)
+        with _lock:
+            data = self._data().rows.get(row, {})
+            current = data.get(column)
+            current = 0 if current is None else int.from_bytes(current, 'big', signed = True)
+            if value:
+                self.counter_set(row, column, current + value)
+            return current + value
+
+    def counter_dec(self, row, column, value = 1):
+        return self.counter_inc(row, column, -value)
+
+    @classmethod
+    def _column_keys(cls, columns):
+        if columns is None:
+            return None
+        return [_to_bytes(column) for column in columns]
+
+
+class Batch:
+
+    def __init__(self, table, batch_size = None, transaction = False):
+        self.table = table
+        self.batch_size = batch_size
+        self.transaction = transaction
+        self._mutations = []
+
+    def put(self, row, data, wal = None):
+        self._add_mutation((self.table.put, row, data))
+
+    def delete(self, row, columns = None, wal = None):
+        self._add_mutation((self.table.delete, row, columns))
+
+    def _add_mutation(self, mutation):
+        self._mutations.append(mutation)
+        if self.batch_size is not None and len(self._mutations) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        mutations, self._mutations = self._mutations, []
+        with _lock:
+            for method, row, value in mutations:
+                method(row, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 和 happybase 一样，只有 transaction 的 batch 在出错的时候才会丢弃
+        if self.transaction and exc_type is not None:
+            return
+        self.send()
+
+
+# ---------------------------------------------------------------------------
+# filter language，只支持 django_hbase.models.filters 里用到的几种 filter
+# ---------------------------------------------------------------------------
+
+_FILTER_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<open>\()
+        |(?P<close>\))
+        |(?P<operator>AND|OR)\b
+        |(?P<name>[A-Za-z]+)\((?P<arguments>(?:'(?:[^']|'')*'|[^()'])*)\)
+    )
+""", re.VERBOSE)
+
+_COMPARE_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class _KeyOnlyFilter:
+
+    def filter_row(self, row_key, data):
+        return {column: b'' for column in data}
+
+
+class _FirstKeyOnlyFilter:
+
+    def filter_row(self, row_key, data):
+        if not data:
+            return data
+        column = min(data)
+        return {column: data[column]}
+
+
+class _PageFilter:
+
+    def __init__(self, page_size):
+        self.page_size = int(page_size)
+        self.returned = 0
+
+    def filter_row(self, row_key, data):
+        if self.returned >= self.page_size:
+            return None
+        self.returned += 1
+        return data
+
+
+class _SingleColumnValueFilter:
+
+    def __init__(self, family, qualifier, compare_operator, comparator, filter_if_missing = 'true', *args):
+        if compare_operator not in _COMPARE_OPERATORS:
+            raise ValueError(f'Unsupported compare operator: {compare_operator}')
+        if not comparator.startswith('binary:'):
+            raise ValueError(f'Unsupported comparator: {comparator}')
+        self.column = _to_bytes('{}:{}'.format(family, qualifier))
+        self.compare = _COMPARE_OPERATORS[compare_operator]
+        self.value = _to_bytes(comparator[len('binary:'):])
+        self.filter_if_missing = filter_if_missing == 'true'
+
+    def filter_row(self, row_key, data):
+        value = data.get(self.column)
+        if value is None:
+            return None if self.filter_if_missing else data
+        return data if self.compare(value, self.value) else None
+
+
+class _FilterList:
+
+    def __init__(self, operator_name, filters):
+        self.operator_name = operator_name
+        self.filters = filters
+
+    def filter_row(self, row_key, data):
+        if self.operator_name == 'OR':
+            matched = [f.filter_row(row_key, data) is not None for f in self.filters]
+            return data if any(matched) else None
+        # AND: 每个 filter 都用原始的数据判断是否保留这一行，然后依次做 KeyOnly 之类的转换
+        result = data
+        for f in self.filters:
+            filtered = f.filter_row(row_key, data)
+            if filtered is None:
+                return None
+            result = {column: filtered[column] for column in result if column in filtered}
+        return result
+
+
+_FILTER_CLASSES = {
+    'KeyOnlyFilter': _KeyOnlyFilter,
+    'FirstKeyOnlyFilter': _FirstKeyOnlyFilter,
+    'PageFilter': _PageFilter,
+    'SingleColumnValueFilter': _SingleColumnValueFilter,
+}
+
+
+def _split_arguments(text):
+    # "'cf', 'key', =, 'binary:1'" -> ['cf', 'key', '=', 'binary:1']
+    arguments, current, quoted, index = [], '', False, 0
+    while index < len(text):
+        char = text[index]
+        if char == "'":
+            if quoted and text[index + 1:index + 2] == "'":
+                current += "'"
+                index += 2
+                continue
+            quoted = not quoted
+        elif char == ',' and not quoted:
+            arguments.append(current.strip())
+            current = ''
+        else:
+            current += char
+        index += 1
+    if current.strip():
+        arguments.append(current.strip())
+    return arguments
+
+
+def _tokenize(text):
+    tokens, position, text = [], 0, text.strip()
+    while position < len(text):
+        match = _FILTER_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f'Can not parse filter string: {text[position:]}')
+        position = match.end()
+        if match.group('open'):
+            tokens.append('(')
+        elif match.group('close'):
+            tokens.append(')')
+        elif match.group('operator'):
+            tokens.append(match.group('operator'))
+        else:
+            name = match.group('name')
+            if name not in _FILTER_CLASSES:
+                raise ValueError(f'Unsupported filter: {name}')
+            tokens.append(_FILTER_CLASSES[name](*_split_arguments(match.group('arguments'))))
+    return tokens
+
+
+def _parse_expression(tokens, index):
+    left, index = _parse_term(tokens, index)
+    while index < len(tokens) and tokens[index] in ('AND', 'OR'):
+        operator_name = tokens[index]
+        right, index = _parse_term(tokens, index + 1)
+        left = _FilterList(operator_name, [left, right])
+    return left, index
+
+
+def _parse_term(tokens, index):
+    if tokens[index] == '(':
+        expression, index = _parse_expression(tokens, index + 1)
+        return expression, index + 1
+    return tokens[index], index + 1
+
+
+def parse_filter(filter_string):
+    # 每次 scan 重新 parse 一次，PageFilter 之类有状态的 filter 不会在多次 scan 之间共享
+    filter_string = _to_bytes(filter_string).decode('utf-8')
+    expression, _ = _parse_expression(_tokenize(filter_string), 0)
+    return expression
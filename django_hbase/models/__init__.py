@@ -1,3 +1,4 @@
 from .fields import *
 from .hbase_models import *
-from .exceptions import *
\ No newline at end of file
+from .exceptions import *
+from .filters import *
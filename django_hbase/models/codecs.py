@@ -0,0 +1,87 @@
+from .exceptions import BadRowKeyError
+
+
+class TextRowKeyCodec:
+    """
+    原来的编码方式，每个 field 转成字符串之后用 ':' 连接
+    {key1: val1, key2: val2} -> b'val1:val2'
+    """
+    name = 'text'
+
+    def validate(self, model_class):
+        pass
+
+    def serialize(self, model_class, data, is_prefix = False):
+        values = []
+        for key, field in model_class._row_key_fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            value = field.serialize(value)
+            if ':' in value:
+                raise BadRowKeyError(f"{key} should not be contain ':' in value: {value}")
+            values.append(value)
+        return bytes(':'.join(values), encoding = 'utf-8')
+
+    def deserialize(self, model_class, row_key):
+        if isinstance(row_key, bytes):
+            # bytes -> str
+            row_key = row_key.decode('utf-8')
+
+        # zip 会在较短的一方结束，所以 prefix 形式的 row key 只会得到前面几个 field
+        return {
+            key: field.deserialize(value)
+            for (key, field), value in zip(model_class._row_key_fields, row_key.split(':'))
+        }
+
+
+class BinaryRowKeyCodec:
+    """
+    每个 field 编码成固定长度的 bytes 直接拼接，不需要分隔符
+    解析的时候按照固定的 offset 切分，不需要查找 ':'
+    {key1: val1, key2: val2} -> bytes(val1) + bytes(val2)
+    """
+    name = 'binary'
+
+    def validate(self, model_class):
+        for key, field in model_class._row_key_fields:
+            if field is None or field.key_width is None:
+                raise BadRowKeyError(
+                    f'{model_class.__name__}.{key} can not be used in a binary row key'
+                )
+
+    def serialize(self, model_class, data, is_prefix = False):
+        values = []
+        for key, field in model_class._row_key_fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            values.append(field.serialize_key_bytes(value))
+        return b''.join(values)
+
+    def deserialize(self, model_class, row_key):
+        data = {}
+        offset = 0
+        for key, field in model_class._row_key_fields:
+            end = offset + field.key_width
+            if end > len(row_key):
+                break
+            data[key] = field.deserialize_key_bytes(row_key[offset:end])
+            offset = end
+        return data
+
+
+ROW_KEY_CODECS = {
+    TextRowKeyCodec.name: TextRowKeyCodec(),
+    BinaryRowKeyCodec.name: BinaryRowKeyCodec(),
+}
+
+
+def get_row_key_codec(name):
+    if name not in ROW_KEY_CODECS:
+        raise ValueError(f'Unknown row key codec: {name}')
+    return ROW_KEY_CODECS[name]
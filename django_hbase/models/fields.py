@@ -1,5 +1,10 @@
+import zlib
+
+
 class HBaseField:
     field_type = None
+    # 在 binary row key 里占用的固定字节数，None 表示不支持 binary row key
+    key_width = None
 
     def __init__(self, reverse = False, column_family = None):
         self.reverse = reverse
@@ -7,9 +12,103 @@ class HBaseField:
         # 增加 is_required 属性，默认为true和default属性，默认为None
         # 并在HBaseModel中做相应的处理，抛出相应的异常信息
 
-class IntegerField(HBaseField):
+    def serialize(self, value):
+        # python value -> str
+        value = str(value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        # str / bytes -> python value
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def serialize_key_bytes(self, value):
+        raise NotImplementedError(
+            f'{self.__class__.__name__} can not be used in a binary row key'
+        )
+
+    def deserialize_key_bytes(self, value):
+        raise NotImplementedError(
+            f'{self.__class__.__name__} can not be used in a binary row key'
+        )
+
+
+class Int64KeyMixin:
+    """
+    binary row key 里的整数编码成 8 个字节的 big endian，字典序和数值大小的顺序一致
+    - signed = True 时把最高位翻转（加上 2^63），这样负数会排在正数前面
+    - reverse = True 时在前面加一个 hash 出来的 salt 字节，作用和 text 编码里倒序数字一样，
+      把连续的 id 打散到不同的 region 上，同一个 id 的 salt 是固定的所以仍然可以按照 prefix 查询
+    """
+
+    def __init__(self, reverse = False, column_family = None, signed = True):
+        super().__init__(reverse = reverse, column_family = column_family)
+        self.signed = signed
+        self.key_width = 9 if reverse else 8
+
+    def serialize_key_bytes(self, value):
+        value = int(value)
+        if self.signed:
+            value += 1 << 63
+        elif value < 0:
+            raise ValueError(f'{value} can not be stored in an unsigned field')
+        value = value.to_bytes(8, 'big')
+        if self.reverse:
+            return bytes([zlib.crc32(value) & 0xff]) + value
+        return value
+
+    def deserialize_key_bytes(self, value):
+        if self.reverse:
+            value = value[1:]
+        value = int.from_bytes(value, 'big')
+        if self.signed:
+            value -= 1 << 63
+        return value
+
+
+class IntegerField(Int64KeyMixin, HBaseField):
     field_type = 'int'
 
+    def serialize(self, value):
+        # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+        # 解决的办法是固定 int 的位数为16位（8的倍数更容易利用空间），不足位补0
+        value = str(value).rjust(16, '0')
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        if self.reverse:
+            value = value[::-1]
+        return int(value)
 
-class TimestampField(HBaseField):
+
+class TimestampField(Int64KeyMixin, HBaseField):
     field_type = 'timestamp'
+
+    def deserialize(self, value):
+        if self.reverse:
+            value = value[::-1]
+        return int(value)
+
+
+class CounterField(HBaseField):
+    """
+    hbase 原生的计数器，通过 HBaseModel.counter_inc / counter_get 原子地修改和读取
+    存储的值是 8 个字节 big endian 的 long，不能用在 row key 里
+    """
+    field_type = 'counter'
+
+    def __init__(self, column_family = None):
+        if not column_family:
+            raise ValueError('CounterField should be stored in a column family')
+        super().__init__(column_family = column_family)
+
+    def serialize(self, value):
+        return int(value).to_bytes(8, 'big', signed = True)
+
+    def deserialize(self, value):
+        return int.from_bytes(value, 'big', signed = True)
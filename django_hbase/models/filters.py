@@ -0,0 +1,107 @@
+class HBaseFilter:
+    """
+    HBase Thrift filter language 的简单封装，str(filter) 就是传给 scan 的 filter string
+    可以用 & 和 | 组合多个 filter:
+        KeyOnlyFilter() & FirstKeyOnlyFilter()
+        -> "KeyOnlyFilter() AND FirstKeyOnlyFilter()"
+    """
+
+    def to_string(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.to_string()
+
+    def __and__(self, other):
+        return FilterList('AND', self, other)
+
+    def __or__(self, other):
+        return FilterList('OR', self, other)
+
+
+class FilterList(HBaseFilter):
+
+    def __init__(self, operator, *filters):
+        self.operator = operator
+        self.filters = filters
+
+    def to_string(self):
+        return '({})'.format(
+            ' {} '.format(self.operator).join(str(f) for f in self.filters)
+        )
+
+
+class KeyOnlyFilter(HBaseFilter):
+    """
+    只返回 column key，不返回 column value，用于只关心 row key 的场景
+    """
+
+    def to_string(self):
+        return 'KeyOnlyFilter()'
+
+
+class FirstKeyOnlyFilter(HBaseFilter):
+    """
+    每一行只返回第一个 column，用于 count 或者判断存在性
+    """
+
+    def to_string(self):
+        return 'FirstKeyOnlyFilter()'
+
+
+class PageFilter(HBaseFilter):
+    """
+    每个 region server 最多返回 page_size 行，注意并不是整个 scan 最多返回 page_size 行
+    需要精确的条数还是要用 filter 的 limit 参数
+    """
+
+    def __init__(self, page_size):
+        self.page_size = int(page_size)
+
+    def to_string(self):
+        return 'PageFilter({})'.format(self.page_size)
+
+
+class SingleColumnValueFilter(HBaseFilter):
+    """
+    在 region server 上按照某一个 column 的值来过滤 row，只有满足条件的 row 才会返回
+    value 需要是已经 serialize 过的值，一般通过 HBaseModel.column_value_filter 来创建
+    """
+    OPERATORS = ('<', '<=', '=', '!=', '>', '>=')
+
+    def __init__(
+        self,
+        column_family,
+        qualifier,
+        operator,
+        value,
+        filter_if_missing = True,
+        latest_version_only = True,
+    ):
+        if operator not in self.OPERATORS:
+            raise ValueError(f'Unsupported compare operator: {operator}')
+        self.column_family = column_family
+        self.qualifier = qualifier
+        self.operator = operator
+        self.value = value
+        self.filter_if_missing = filter_if_missing
+        self.latest_version_only = latest_version_only
+
+    @classmethod
+    def quote(cls, value):
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        # filter language 里的字符串用单引号，单引号本身需要写两次来转义
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def to_string(self):
+        return 'SingleColumnValueFilter({}, {}, {}, {}, {}, {})'.format(
+            self.quote(self.column_family),
+            self.quote(self.qualifier),
+            self.operator,
+            self.quote('binary:{}'.format(
+                self.value.decode('utf-8') if isinstance(self.value, bytes) else self.value
+            )),
+            'true' if self.filter_if_missing else 'false',
+            'true' if self.latest_version_only else 'false',
+        )
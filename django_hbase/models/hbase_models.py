@@ -1,18 +1,156 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from django_hbase.client import HBaseClient
-from .exceptions import EmptyColumnError, BadRowKeyError
-from .fields import HBaseField, IntegerField, TimestampField
+from .codecs import get_row_key_codec
+from .exceptions import BadRowKeyError, EmptyColumnError
+from .fields import CounterField, HBaseField
+from .filters import FirstKeyOnlyFilter, KeyOnlyFilter, SingleColumnValueFilter
 from  django.conf import settings
 
+import heapq
+import itertools
+import operator
+import threading
+import zlib
+
+# 每个线程当前打开的 batch，table_name -> happybase Batch
+_thread_batches = threading.local()
+
+# 二级索引表里存储主表 row key 的 column
+INDEX_COLUMN_FAMILY = 'index'
+INDEX_ROW_KEY_COLUMN = '{}:row_key'.format(INDEX_COLUMN_FAMILY)
+
+# 计算前一个 row key 的时候在后面补的 0xff 的个数，需要不小于 row key 可能多出来的长度
+ROW_KEY_PADDING = 64
+
+
+def next_row_key(row_key):
+    # 字典序里紧挨着 row_key 的下一个 row key，中间不可能有其他的 row key
+    return row_key + b'\x00'
+
+
+def prev_row_key(row_key):
+    # 字典序里比 row_key 小的最大的 row key
+    # b'ab' -> b'aa\xff\xff...'，b'ab\x00' -> b'ab'
+    if not row_key:
+        raise ValueError('There is no row key before the empty row key')
+    if row_key[-1] == 0:
+        return row_key[:-1]
+    return row_key[:-1] + bytes([row_key[-1] - 1]) + b'\xff' * ROW_KEY_PADDING
+
+
+def increment_row_key(row_key):
+    # prefix scan 的上界，和 happybase 一样去掉末尾的 0xff 之后最后一个字节加一
+    # b'ab' -> b'ac'，b'a\xff' -> b'b'，全部是 0xff 的时候没有上界
+    row_key = row_key.rstrip(b'\xff')
+    if not row_key:
+        return None
+    return row_key[:-1] + bytes([row_key[-1] + 1])
+
+
+class InlineExecutor:
+    """
+    和 ThreadPoolExecutor 一样的接口，submit 的时候在当前线程里马上执行
+    pool 里没有空闲的 connection 的时候使用，当前线程已经持有的 connection 会被复用
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
 class HBaseModel:
 
     class Meta:
         table_name = None
         row_key = ()
+        # row key 的编码方式，'text' 是原来用 ':' 连接的字符串，'binary' 是定长的 bytes
+        row_key_codec = 'text'
+        # 从 text 迁移到 binary 的过程中设置成 'text'，读的时候两种格式都会读，写只写新格式
+        legacy_row_key_codec = None
+        # 把 row key 打散到多少个 bucket 里，None 表示不打散
+        # 打散之后每个 row key 前面会多一个 bucket 字节，同一个 prefix 的数据会分布在所有 bucket 里
+        # 写入不再集中在同一个 region，代价是 prefix / 范围查询需要 scan 每一个 bucket 再归并
+        salt_buckets = None
+        # 二级索引 [('from_user_id', 'to_user_id')]，每个索引是一组 field name，可以是 row key 里的 field
+        # 也可以是 column 里的 field。索引存在单独的 <table_name>_index 表里，save / delete 的时候维护，
+        # 通过 get_by_index 一次 rpc 取回整行数据。索引的值需要是唯一的，重复的话只会保留最后写入的那一行
+        indexes = ()
+
+    # 下面这些 field 的元信息在定义 model 的时候计算一次，serialize / deserialize 的时候直接使用
+    # 避免每处理一行数据都要遍历一次 cls.__dict__
+    # field name -> field
+    _field_hash = {}
+    # row key 里的 field，按照 Meta.row_key 的顺序 ((field name, field), ...)
+    _row_key_fields = ()
+    # 存在 column 里的 field ((field name, field, 'cf:name'), ...)
+    _column_fields = ()
+    # b'cf:name' -> (field name, field)
+    _column_key_hash = {}
+    _row_key_codec = get_row_key_codec('text')
+    _legacy_row_key_codec = None
+    _salt_buckets = None
+    _indexes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.init_field_metadata()
+
+    @classmethod
+    def init_field_metadata(cls):
+        field_hash = {}
+        # 父类里定义的 field 也要算上，子类可以覆盖父类的 field
+        for klass in reversed(cls.__mro__):
+            for key, value in klass.__dict__.items():
+                if isinstance(value, HBaseField):
+                    field_hash[key] = value
+        cls._field_hash = field_hash
+        cls._row_key_fields = tuple(
+            (key, field_hash.get(key))
+            for key in cls.Meta.row_key
+        )
+        cls._column_fields = tuple(
+            (key, field, '{}:{}'.format(field.column_family, key))
+            for key, field in field_hash.items()
+            if field.column_family
+        )
+        cls._column_key_hash = {
+            bytes(column_key, encoding = 'utf-8'): (key, field)
+            for key, field, column_key in cls._column_fields
+        }
+        cls._row_key_codec = get_row_key_codec(getattr(cls.Meta, 'row_key_codec', 'text'))
+        cls._row_key_codec.validate(cls)
+        legacy_codec_name = getattr(cls.Meta, 'legacy_row_key_codec', None)
+        if legacy_codec_name is None:
+            cls._legacy_row_key_codec = None
+        else:
+            cls._legacy_row_key_codec = get_row_key_codec(legacy_codec_name)
+            cls._legacy_row_key_codec.validate(cls)
+        salt_buckets = getattr(cls.Meta, 'salt_buckets', None)
+        if salt_buckets is not None and not 1 <= salt_buckets <= 256:
+            raise ValueError(f'{cls.__name__}.Meta.salt_buckets should be between 1 and 256')
+        cls._salt_buckets = salt_buckets
+        indexes = tuple(tuple(index) for index in getattr(cls.Meta, 'indexes', ()))
+        for index in indexes:
+            for key in index:
+                field = field_hash.get(key)
+                if field is None or isinstance(field, CounterField):
+                    raise ValueError(f'{cls.__name__}.{key} can not be used in an index')
+        cls._indexes = indexes
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
-            value = kwargs.get(key)
-            setattr(self, key, value)
+        for key in self._field_hash:
+            setattr(self, key, kwargs.get(key))
 
     @classmethod
     def create(cls, **kwargs):
@@ -23,191 +161,948 @@ class HBaseModel:
 
     @classmethod
     def get(cls, **kwargs):
-        row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row_data = table.row(row_key)
+        row_key = cls.salt_row_key(cls.serialize_row_key(kwargs))
+        with cls.get_table() as table:
+            row_data = table.row(row_key)
+            legacy_codec = cls._legacy_row_key_codec
+            if not row_data and legacy_codec is not None:
+                # 新格式里没有，可能是还没有迁移的旧数据
+                row_key = cls.serialize_row_key(kwargs, codec = legacy_codec)
+                row_data = table.row(row_key)
+                return cls.init_from_row(row_key, row_data, codec = legacy_codec, salted = False)
         return cls.init_from_row(row_key, row_data)
 
+    @classmethod
+    def get_many(cls, list_of_kwargs, chunk_size = None):
+        """
+        HBaseFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts1},
+            {'from_user_id': 2, 'created_at': ts2},
+        ])
+        用 table.rows() 一次 rpc 取多行，返回的顺序和传入的顺序一致，不存在的为 None
+        key 太多的时候按照 chunk_size 拆成多次 rpc，避免单次请求过大
+        """
+        if chunk_size is None:
+            chunk_size = settings.HBASE_GET_MANY_CHUNK_SIZE
+        row_keys = [cls.salt_row_key(cls.serialize_row_key(kwargs)) for kwargs in list_of_kwargs]
+        # 去重，重复的 key 只需要取一次
+        unique_row_keys = list(dict.fromkeys(row_keys))
+
+        with cls.get_table() as table:
+            row_data_hash = cls._get_rows(table, unique_row_keys, chunk_size)
+            instances = [
+                cls.init_from_row(row_key, row_data_hash.get(row_key))
+                for row_key in row_keys
+            ]
+
+            # 新格式里没有取到的，再用旧格式的 row key 取一次
+            legacy_codec = cls._legacy_row_key_codec
+            missing_indexes = [index for index, instance in enumerate(instances) if instance is None]
+            if legacy_codec is None or not missing_indexes:
+                return instances
+            legacy_row_keys = {
+                index: cls.serialize_row_key(list_of_kwargs[index], codec = legacy_codec)
+                for index in missing_indexes
+            }
+            row_data_hash = cls._get_rows(
+                table,
+                list(dict.fromkeys(legacy_row_keys.values())),
+                chunk_size,
+            )
+        for index, row_key in legacy_row_keys.items():
+            instances[index] = cls.init_from_row(
+                row_key,
+                row_data_hash.get(row_key),
+                codec = legacy_codec,
+                salted = False,
+            )
+        return instances
+
+    @classmethod
+    def _get_rows(cls, table, row_keys, chunk_size):
+        row_data_hash = {}
+        for index in range(0, len(row_keys), chunk_size):
+            chunk = row_keys[index:index + chunk_size]
+            for row_key, row_data in table.rows(chunk):
+                row_data_hash[row_key] = row_data
+        return row_data_hash
+
     def save(self):
         row_data = self.serialize_row_data(self.__dict__)
         # 如果 row_data 为空，即没有任何 column key values 需要存储 hbase 会直接不存储
         # 这个 row_key，因此我们可以 raise 一个 exception 提醒调用者，避免存储空值
         if len(row_data) == 0:
             raise EmptyColumnError()
-        table = self.get_table()
-        table.put(self.row_key, row_data)
+        row_key = self.row_key
+        with self.get_writer() as writer:
+            writer.put(row_key, row_data)
+        if self._indexes:
+            # 从表里读出来的 instance 记住了读出来时候的索引，更新之后索引的值变了的话删除旧的索引
+            # create 出来的 instance 没有旧的 row，不需要多读一次
+            old_index_keys = []
+            loaded_row_key, loaded_index_keys = self.__dict__.get('_loaded_index_keys', (None, []))
+            if loaded_row_key == row_key:
+                old_index_keys = loaded_index_keys
+            self.save_index_rows([(row_key, row_data, self.__dict__)], old_index_keys)
+            self._loaded_index_keys = (row_key, self.get_index_keys(self.__dict__))
+
+    @classmethod
+    def save_index_rows(cls, rows, old_index_keys = ()):
+        # rows: [(row_key, row_data, data)]
+        # 索引表的每一行存储主表的 row key 和所有的 column，get_by_index 不需要再读主表
+        index_rows = {}
+        for row_key, row_data, data in rows:
+            index_row_data = dict(row_data)
+            index_row_data[INDEX_ROW_KEY_COLUMN] = row_key
+            for index_key in cls.get_index_keys(data):
+                index_rows[index_key] = index_row_data
+        with cls.get_writer(cls.get_index_table_name()) as writer:
+            for index_key in old_index_keys:
+                if index_key not in index_rows:
+                    writer.delete(index_key)
+            for index_key, index_row_data in index_rows.items():
+                writer.put(index_key, index_row_data)
+
+    @classmethod
+    def bulk_create(cls, instances, batch_size = None, wal = True):
+        # 先把所有的 row 都 serialize 好，有问题的话在写入任何数据之前就 raise
+        rows = []
+        for instance in instances:
+            row_data = cls.serialize_row_data(instance.__dict__)
+            if len(row_data) == 0:
+                raise EmptyColumnError()
+            rows.append((instance.row_key, row_data, instance.__dict__))
+        with cls.batch(batch_size = batch_size, wal = wal) as batch:
+            for row_key, row_data, _ in rows:
+                batch.put(row_key, row_data)
+            # 只用于写入新的数据，不会检查和删除已经存在的 row 的旧索引
+            if cls._indexes:
+                cls.save_index_rows(rows)
+        return instances
+
+    @classmethod
+    @contextmanager
+    def batch(cls, batch_size = None, wal = True):
+        """
+        with HBaseFollowing.batch():
+            HBaseFollowing.create(...)
+            HBaseFollowing.delete(...)
+        with 里面的 save / delete 都会先缓存在 batch 里，每攒够 batch_size 个
+        mutation 发一次 rpc，退出 with 的时候把剩下的一起发出去。
+        with 里面出现异常的话，还没有发出去的 mutation 会被丢弃。
+        wal = False 可以跳过 write ahead log 加快写入，适合可以重跑的 backfill 任务，
+        但是 region server 挂掉的话没有落盘的数据会丢失。
+        """
+        batches = cls._get_thread_batches()
+        table_name = cls.get_table_name()
+        if table_name in batches:
+            # 嵌套的 batch 直接复用外层的
+            yield batches[table_name]
+            return
+
+        if batch_size is None:
+            batch_size = settings.HBASE_BATCH_SIZE
+        # 有二级索引的话，索引表也用一个 batch
+        table_names = [table_name]
+        if cls._indexes:
+            table_names.append(cls.get_index_table_name())
+        with HBaseClient.connection() as conn:
+            new_batches = {
+                name: conn.table(name).batch(batch_size = batch_size, wal = wal)
+                for name in table_names
+            }
+            batches.update(new_batches)
+            try:
+                yield new_batches[table_name]
+                for batch in new_batches.values():
+                    batch.send()
+            finally:
+                for name in table_names:
+                    del batches[name]
+
+    @classmethod
+    def _get_thread_batches(cls):
+        if not hasattr(_thread_batches, 'batches'):
+            _thread_batches.batches = {}
+        return _thread_batches.batches
 
     @classmethod
-    def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+    def get_current_batch(cls):
+        return cls._get_thread_batches().get(cls.get_table_name())
+
+    @classmethod
+    @contextmanager
+    def get_table(cls, table_name = None, exclusive = False):
+        # table 依赖于从 connection pool 里 checkout 出来的 connection
+        # 所以需要用 with cls.get_table() as table: 的方式使用，用完之后自动 checkin
+        # generator 里使用的时候需要 exclusive = True，见 HBaseConnectionPool.connection
+        with HBaseClient.connection(exclusive = exclusive) as conn:
+            yield conn.table(table_name or cls.get_table_name())
+
+    @classmethod
+    @contextmanager
+    def get_writer(cls, table_name = None):
+        # 当前线程打开了这张表的 batch 就写入 batch，否则直接写入 table
+        table_name = table_name or cls.get_table_name()
+        batch = cls._get_thread_batches().get(table_name)
+        if batch is not None:
+            yield batch
+            return
+        with cls.get_table(table_name) as table:
+            yield table
 
     @property
     def row_key(self):
-        return self.serialize_row_key(self.__dict__)
+        # 实际存储在 hbase 里的 row key，打散的 model 会带上 bucket 前缀
+        return self.salt_row_key(self.serialize_row_key(self.__dict__))
 
     @classmethod
-    def serialize_row_key(cls, data, is_prefix = False):
+    def get_salt(cls, row_key):
+        # bucket 只由 row key 本身决定，同一行每次都落在同一个 bucket 里
+        return bytes([zlib.crc32(row_key) % cls._salt_buckets])
+
+    @classmethod
+    def salt_row_key(cls, row_key):
+        if not cls._salt_buckets:
+            return row_key
+        return cls.get_salt(row_key) + row_key
+
+    @classmethod
+    def unsalt_row_key(cls, row_key):
+        if not cls._salt_buckets:
+            return row_key
+        return row_key[1:]
+
+    @classmethod
+    def serialize_row_key(cls, data, is_prefix = False, codec = None):
         """
         serialize dict to bytes (not str)
+        text codec:
         {key1: val1} -> b'val1'
         {key1: val1, key2: val2} -> b'val1:val2'
         {key1: val1, key2: val2, key3: val3} -> b'val1:val2:val3'
+        binary codec:
+        {key1: val1, key2: val2} -> bytes(val1) + bytes(val2)
         """
-        field_hash = cls.get_field_hash()
-        values = []
-        for key in cls.Meta.row_key:
-            field = field_hash.get(key)
-            value = data.get(key)
-            if value is None:
-                if not is_prefix:
-                    raise BadRowKeyError(f"{key} is missing in row key")
-                break
-            value = cls.serialize_field(field, value)
-            if ':' in value:
-                raise BadRowKeyError(f"{key} should not be contain ':' in value: {value}")
-            values.append(value)
-        return bytes(':'.join(values), encoding = 'utf-8')
+        if codec is None:
+            codec = cls._row_key_codec
+        return codec.serialize(cls, data, is_prefix = is_prefix)
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        return cls._field_hash
 
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为16位（8的倍数更容易利用空间），不足位补0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return field.serialize(value)
 
     @classmethod
     def serialize_row_data(cls, data):
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            if not field.column_family:
-                continue
-            column_key = '{}:{}'.format(field.column_family, key)
+        for key, field, column_key in cls._column_fields:
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            row_data[column_key] = field.serialize(column_value)
         return row_data
 
     @classmethod
-    def init_from_row(cls, row_key, row_data):
+    def init_from_row(cls, row_key, row_data, codec = None, salted = True):
+        # row_key 是 hbase 里存储的 row key，salted = False 表示没有 bucket 前缀（旧格式的数据）
         if not row_data:
             return None
-        data = cls.deserialize_row_key(row_key)
+        if salted:
+            row_key = cls.unsalt_row_key(row_key)
+        data = cls.deserialize_row_key(row_key, codec = codec)
+        column_key_hash = cls._column_key_hash
         for column_key, column_value in row_data.items():
-            column_key = column_key.decode('utf-8')
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
-        return cls(**data)
+            # 使用 KeyOnlyFilter 的时候 column value 都是空的
+            if not column_value:
+                continue
+            key_and_field = column_key_hash.get(column_key)
+            # 已经从 model 里删掉的 column 直接忽略
+            if key_and_field is None:
+                continue
+            key, field = key_and_field
+            data[key] = field.deserialize(column_value)
+        instance = cls(**data)
+        if cls._indexes:
+            instance._loaded_index_keys = (instance.row_key, cls.get_index_keys(data))
+        return instance
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls._field_hash[key].deserialize(value)
 
     @classmethod
-    def deserialize_row_key(cls, row_key):
+    def deserialize_row_key(cls, row_key, codec = None):
         """
         "val1" => {'key1': val1, 'key2': None, 'key3': None}
         "val1:val2" => {'key1': val1, 'key2': val2, 'key3': None}
         "val1:val2:val3" => {'key1': val1, 'key2': val2, 'key3': val3}
         """
-        data = {}
-        if isinstance(row_key, bytes):
-            # bytes -> str
-            row_key = row_key.decode('utf-8')
-
-        # val1:val2 => val1:val2: 方便每次find(':')都能够找到一个val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
-        return data
+        if codec is None:
+            codec = cls._row_key_codec
+        return codec.deserialize(cls, row_key)
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        # convert table name from bytes to str
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            # convert table name from bytes to str
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                field.column_family: dict()
+                for key, field, column_key in cls._column_fields
+            }
+            conn.create_table(cls.get_table_name(), column_families)
+            if cls._indexes:
+                column_families[INDEX_COLUMN_FAMILY] = dict()
+                conn.create_table(cls.get_index_table_name(), column_families)
 
     @classmethod
     def get_table_name(cls):
+        table_name = cls.get_unsalted_table_name()
+        # 打散之后 row key 的格式不一样了，存在单独的表里，见 copy_unsalted_rows
+        if cls._salt_buckets:
+            return '{}_salted{}'.format(table_name, cls._salt_buckets)
+        return table_name
+
+    @classmethod
+    def get_unsalted_table_name(cls):
         if not cls.Meta.table_name:
             raise NotImplementedError('Missing table_name in HBaseModel meta class')
         if settings.TESTING:
             return 'test_{}'.format(cls.Meta.table_name)
         return cls.Meta.table_name
 
+    @classmethod
+    def copy_unsalted_rows(cls, batch_size = None):
+        """
+        打开 salt_buckets 的时候把没有打散的旧表里的数据复制到打散的新表里，返回复制的行数
+        每一行都是整行覆盖写入，重复执行不会产生重复的数据，索引也会一起写入
+        复制的过程中在旧表里删除的行不会从新表里删除，需要在低峰期执行
+        """
+        if not cls._salt_buckets:
+            raise ValueError(f'{cls.__name__} is not salted')
+        if batch_size is None:
+            batch_size = settings.HBASE_BATCH_SIZE
+        copied = 0
+        with cls.get_table(cls.get_unsalted_table_name(), exclusive = True) as table:
+            rows = table.scan(batch_size = batch_size)
+            instances = cls._init_scanned_rows(rows, cls._row_key_codec, salted = False)
+            while True:
+                chunk = list(itertools.islice(instances, batch_size))
+                if not chunk:
+                    return copied
+                cls.bulk_create(chunk, batch_size = batch_size)
+                copied += len(chunk)
+
     @classmethod
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
+            if cls._indexes:
+                conn.delete_table(cls.get_index_table_name(), True)
+
+    @classmethod
+    def get_index_table_name(cls):
+        return '{}_index'.format(cls.get_table_name())
 
     @classmethod
-    def serialize_row_key_from_tuple(cls, row_key_tuple):
+    def get_index(cls, keys):
+        keys = set(keys)
+        for index in cls._indexes:
+            if set(index) == keys:
+                return index
+        raise ValueError(f'{cls.__name__} has no index on {tuple(sorted(keys))}')
+
+    @classmethod
+    def serialize_index_key(cls, index, data):
+        """
+        ('from_user_id', 'to_user_id'), {'from_user_id': 1, 'to_user_id': 2}
+        -> b'from_user_id,to_user_id:val1:val2'
+        前面加上索引的名字，不同的索引存在同一张索引表里也不会冲突
+        有 field 的值为 None 的时候不建索引，返回 None
+        """
+        values = [','.join(index)]
+        for key in index:
+            value = data.get(key)
+            if value is None:
+                return None
+            value = cls._field_hash[key].serialize(value)
+            if ':' in value:
+                raise BadRowKeyError(f"{key} should not be contain ':' in value: {value}")
+            values.append(value)
+        return bytes(':'.join(values), encoding = 'utf-8')
+
+    @classmethod
+    def get_index_keys(cls, data):
+        index_keys = []
+        for index in cls._indexes:
+            index_key = cls.serialize_index_key(index, data)
+            if index_key is not None:
+                index_keys.append(index_key)
+        return index_keys
+
+    @classmethod
+    def get_by_index(cls, **kwargs):
+        """
+        HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 2)
+        kwargs 需要正好是 Meta.indexes 里的某一个索引，一次 rpc 读取索引表里的一行
+        """
+        index_key = cls.serialize_index_key(cls.get_index(kwargs), kwargs)
+        if index_key is None:
+            return None
+        with cls.get_table(cls.get_index_table_name()) as table:
+            row_data = table.row(index_key)
+        row_key = row_data.pop(bytes(INDEX_ROW_KEY_COLUMN, encoding = 'utf-8'), None)
+        if row_key is None:
+            return None
+        return cls.init_from_row(row_key, row_data)
+
+    @classmethod
+    def build_indexes(cls, batch_size = None):
+        """
+        scan 整张主表重新写入所有的索引，用于给已经有数据的表加上新的索引
+        """
+        built = 0
+        with cls.batch(batch_size = batch_size):
+            for instance in cls.iter_filter():
+                row_data = cls.serialize_row_data(instance.__dict__)
+                cls.save_index_rows([(instance.row_key, row_data, instance.__dict__)])
+                built += 1
+        return built
+
+    @classmethod
+    def serialize_row_key_from_tuple(cls, row_key_tuple, codec = None):
         if row_key_tuple is None:
             return None
         data = {
             key: value
             for key, value in zip(cls.Meta.row_key, row_key_tuple)
         }
-        return cls.serialize_row_key(data, is_prefix = True)
+        return cls.serialize_row_key(data, is_prefix = True, codec = codec)
+
+    @classmethod
+    def get_scan_bounds(cls, start, stop, reverse = False, start_exclusive = False, stop_inclusive = False, codec = None):
+        """
+        把 start / stop 转换成 scan 的 (row_start, row_stop)
+        hbase 的 scan 只支持包含 row_start 不包含 row_stop，其他的情况通过相邻的 row key 实现:
+        - 正序: row_start 是下界，start_exclusive 用下一个 row key，stop_inclusive 用下一个 row key
+        - 倒序: row_start 是上界，start_exclusive 用前一个 row key，stop_inclusive 用前一个 row key
+        """
+        row_start = cls.serialize_row_key_from_tuple(start, codec = codec)
+        row_stop = cls.serialize_row_key_from_tuple(stop, codec = codec)
+        adjacent_row_key = prev_row_key if reverse else next_row_key
+        if start_exclusive and row_start is not None:
+            row_start = adjacent_row_key(row_start)
+        if stop_inclusive and row_stop is not None:
+            row_stop = adjacent_row_key(row_stop)
+        return row_start, row_stop
 
     @classmethod
-    def filter(cls, start = None, stop = None, prefix = None, limit = None, reverse = None):
-        # serialize tuple to str
-        row_start = cls.serialize_row_key_from_tuple(start)
-        row_stop = cls.serialize_row_key_from_tuple(stop)
+    def get_scan_ranges(
+        cls,
+        start = None,
+        stop = None,
+        prefix = None,
+        reverse = False,
+        start_exclusive = False,
+        stop_inclusive = False,
+    ):
+        """
+        一次 filter 需要 scan 的所有 row key 范围 [(codec, salted, row_start, row_stop, row_prefix)]
+        迁移 row key 格式的过程中，新旧两种格式各有一个范围
+        打散的 model 每个 bucket 各有一个范围，旧格式的数据没有打散
+        """
+        bounds = {
+            'reverse': reverse,
+            'start_exclusive': start_exclusive,
+            'stop_inclusive': stop_inclusive,
+        }
+        row_start, row_stop = cls.get_scan_bounds(start, stop, **bounds)
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
+        if cls._salt_buckets:
+            scan_ranges = [
+                (cls._row_key_codec, True, *cls.get_bucket_range(
+                    bucket,
+                    row_start,
+                    row_stop,
+                    row_prefix,
+                    reverse,
+                ))
+                for bucket in range(cls._salt_buckets)
+            ]
+        else:
+            scan_ranges = [(cls._row_key_codec, True, row_start, row_stop, row_prefix)]
+
+        legacy_codec = cls._legacy_row_key_codec
+        if legacy_codec is not None:
+            scan_ranges.append((
+                legacy_codec,
+                False,
+                *cls.get_scan_bounds(start, stop, codec = legacy_codec, **bounds),
+                cls.serialize_row_key_from_tuple(prefix, codec = legacy_codec),
+            ))
+        return scan_ranges
+
+    @classmethod
+    def get_bucket_range(cls, bucket, row_start, row_stop, row_prefix, reverse = False):
+        """
+        把一个没有打散的范围转换成某一个 bucket 里的范围 (row_start, row_stop, row_prefix)
+        没有指定的边界用 bucket 自己的边界代替，避免 scan 到相邻的 bucket 里
+        """
+        salt = bytes([bucket])
+        if row_prefix is not None:
+            return None, None, salt + row_prefix
+        if row_start is None and row_stop is None:
+            return None, None, salt
+        # 下一个 bucket 的第一个字节，最后一个 bucket 没有上界
+        next_salt = bytes([bucket + 1]) if bucket < 255 else None
+        # reverse 的时候 row_start 是上界，row_stop 是下界
+        lower, upper = (salt, next_salt) if not reverse else (next_salt, salt)
+        row_start = lower if row_start is None else salt + row_start
+        row_stop = upper if row_stop is None else salt + row_stop
+        return row_start, row_stop, None
+
+    @classmethod
+    def merge_key(cls, instance):
+        # 多个范围的结果按照新格式的 row key 归并，和迁移完成之后单次 scan 的顺序一致
+        return cls.serialize_row_key(instance.__dict__)
+
+    @classmethod
+    def filter(cls, start = None, stop = None, prefix = None, limit = None, reverse = None, **kwargs):
+        return list(cls.iter_filter(
+            start = start,
+            stop = stop,
+            prefix = prefix,
+            limit = limit,
+            reverse = reverse,
+            **kwargs
+        ))
+
+    @classmethod
+    def iter_filter(
+        cls,
+        start = None,
+        stop = None,
+        prefix = None,
+        limit = None,
+        reverse = None,
+        batch_size = None,
+        scan_batching = None,
+        columns = None,
+        filter_string = None,
+        start_exclusive = False,
+        stop_inclusive = False,
+    ):
+        """
+        和 filter 一样的参数，但是返回一个 generator，每次只从 hbase 取 batch_size 行
+        只有被读到的 row 才会被 deserialize 成 instance，调用者可以随时 break 提前结束
+        scan 过程中会单独占用一个 pool 里的 connection，generator 结束或者被回收的时候才会 checkin
+        scan_batching 限制每次返回的一行里最多多少个 column，用于 column 非常多的宽行
+        columns 是需要返回的 field name 列表，只传输这些 column，其他的 field 为 None
+        filter_string 是在 region server 上执行的 filter，可以是 str 也可以是 HBaseFilter
+        start_exclusive = True 不包含 start 这一行，stop_inclusive = True 包含 stop 这一行
+        """
+        scan_ranges, scan_kwargs = cls._prepare_scan(
+            start,
+            stop,
+            prefix,
+            limit,
+            reverse,
+            batch_size,
+            scan_batching,
+            columns,
+            filter_string,
+            start_exclusive,
+            stop_inclusive,
+        )
+        if limit is not None and limit <= 0:
+            return
+        if len(scan_ranges) == 1:
+            # generator 暂停的时候 scanner 还在使用这个 connection，不能和其他 with 共用
+            with cls.get_table(exclusive = True) as table:
+                yield from cls._scan_range(table, *scan_ranges[0], **scan_kwargs)
+            return
+
+        # 多个范围（每个 bucket 一个）在线程池里同时 scan，每个范围都是有序的，用 heap 归并成一个有序的结果
+        # 每个范围每次只 scan batch_size 行，调用者读得慢的时候也不会把整个范围读到内存里
+        with cls.scan_executor(len(scan_ranges)) as executor:
+            yield from cls._stream_filter(executor, scan_ranges, scan_kwargs)
+
+    @classmethod
+    def _prepare_scan(
+        cls,
+        start = None,
+        stop = None,
+        prefix = None,
+        limit = None,
+        reverse = None,
+        batch_size = None,
+        scan_batching = None,
+        columns = None,
+        filter_string = None,
+        start_exclusive = False,
+        stop_inclusive = False,
+    ):
+        # iter_filter 的参数转换成需要 scan 的范围和传给 table.scan 的参数
+        if batch_size is None:
+            batch_size = settings.HBASE_SCAN_BATCH_SIZE
+        scan_kwargs = {
+            'limit': limit,
+            'reverse': reverse,
+            'batch_size': batch_size,
+            'scan_batching': scan_batching,
+            'columns': cls.get_column_keys(columns),
+            'filter': None if filter_string is None else str(filter_string),
+        }
+        scan_ranges = cls.get_scan_ranges(
+            start,
+            stop,
+            prefix,
+            reverse = bool(reverse),
+            start_exclusive = start_exclusive,
+            stop_inclusive = stop_inclusive,
+        )
+        return scan_ranges, scan_kwargs
+
+    @classmethod
+    def _stream_filter(cls, executor, scan_ranges, scan_kwargs):
+        """
+        一次 filter 的所有范围提交到 executor 分块 scan，返回按照 row key 排好序的 instance 的 iterator
+        每个范围的第一块在调用的时候就提交了，之后的块只有读到的时候才会提交
+        """
+        limit = scan_kwargs['limit']
+        if limit is not None and limit <= 0:
+            return iter(())
+        reverse = bool(scan_kwargs['reverse'])
+        streams = [
+            cls._stream_scan_range(executor, scan_range, limit, reverse, scan_kwargs)
+            for scan_range in scan_ranges
+        ]
+        if len(streams) == 1:
+            return streams[0]
+        merged = heapq.merge(*streams, key = cls.merge_key, reverse = reverse)
+        if cls._legacy_row_key_codec is not None:
+            merged = cls._unique_by_row_key(merged)
+        return itertools.islice(merged, limit)
+
+    @classmethod
+    @contextmanager
+    def scan_executor(cls, scans_count, max_workers = None):
+        """
+        并发执行 scan 的线程池，每个线程使用 pool 里自己的 connection
+        线程数不超过 pool 里不需要等待就能 checkout 的 connection 个数，多出来的线程只会等到超时
+        一个都没有的时候（比如调用者在 batch() 里已经占用了所有的 connection）在当前线程里执行
+        """
+        if max_workers is None:
+            max_workers = settings.HBASE_MULTI_FILTER_MAX_WORKERS
+        max_workers = min(max_workers, HBaseClient.get_pool().get_free_count(), scans_count)
+        if max_workers <= 0:
+            with InlineExecutor() as executor:
+                yield executor
+            return
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            yield executor
+
+    @classmethod
+    def _stream_scan_range(cls, executor, scan_range, limit, reverse, scan_kwargs):
+        """
+        把一个范围拆成每次最多 batch_size 行的多次 scan 提交到 executor，返回 instance 的 generator
+        第一次 scan 在调用的时候马上提交，读取每一块的时候下一块已经提交了，多个范围可以同时 scan
+        """
+        codec, salted, row_start, row_stop, row_prefix = scan_range
+        if row_prefix is not None:
+            # 和 happybase 一样转换成 start / stop，之后的每一块从上一块的最后一行之后开始
+            if reverse:
+                row_start, row_stop = increment_row_key(row_prefix), row_prefix
+            else:
+                row_start, row_stop = row_prefix, increment_row_key(row_prefix)
+        chunk = cls._submit_scan_chunk(executor, row_start, row_stop, limit, reverse, scan_kwargs)
+        return cls._iter_scan_chunks(executor, chunk, codec, salted, row_stop, limit, reverse, scan_kwargs)
+
+    @classmethod
+    def _submit_scan_chunk(cls, executor, row_start, row_stop, remaining, reverse, scan_kwargs):
+        size = scan_kwargs['batch_size'] if remaining is None else min(scan_kwargs['batch_size'], remaining)
+        scan_kwargs = dict(scan_kwargs, limit = size, batch_size = size, reverse = reverse)
+        return executor.submit(cls._scan_chunk, row_start, row_stop, scan_kwargs), size
+
+    @classmethod
+    def _scan_chunk(cls, row_start, row_stop, scan_kwargs):
+        # 在 executor 的线程里执行，with 结束之前就读完了，不需要 exclusive 的 connection
+        with cls.get_table() as table:
+            return list(table.scan(row_start, row_stop, **scan_kwargs))
+
+    @classmethod
+    def _iter_scan_chunks(cls, executor, chunk, codec, salted, row_stop, remaining, reverse, scan_kwargs):
+        future, size = chunk
+        while True:
+            rows = future.result()
+            if remaining is not None:
+                remaining -= len(rows)
+            next_chunk = None
+            # 这一块是满的说明后面可能还有，先提交下一块再处理这一块
+            if len(rows) == size and remaining != 0:
+                last_row_key = rows[-1][0]
+                next_start = prev_row_key(last_row_key) if reverse else next_row_key(last_row_key)
+                next_chunk = cls._submit_scan_chunk(
+                    executor,
+                    next_start,
+                    row_stop,
+                    remaining,
+                    reverse,
+                    scan_kwargs,
+                )
+            yield from cls._init_scanned_rows(rows, codec, salted)
+            if next_chunk is None:
+                return
+            future, size = next_chunk
+
+    @classmethod
+    def multi_filter(cls, scan_specs, max_workers = None, merge_by = None, limit = None, reverse = False):
+        """
+        HBaseFollowing.multi_filter([
+            {'prefix': (1,), 'reverse': True},
+            {'prefix': (2,), 'reverse': True},
+        ], merge_by = 'created_at', limit = 10, reverse = True)
+        每个 scan_spec 是 filter 的参数，多个 scan 在线程池里并发执行，每个线程使用 pool 里自己的 connection
+        merge_by = None 按照 scan_specs 的顺序拼接结果
+        merge_by = 'row_key' 或者某个 field name 的时候用 heap 归并成一个有序的结果，
+        这时每个 scan 的结果需要已经按照同样的顺序排好（reverse 和归并的 reverse 一致）
+        limit 是所有 scan 一共最多返回多少个，每个 scan 最多也只需要取 limit 个
+        每个 scan 都是分块读取的，一开始每个 scan 只读第一块 min(batch_size, limit) 行，
+        之后只有归并或者拼接读到了这个 scan 的末尾才会读下一块，凑够 limit 个马上结束，
+        所以最多多读 len(scan_specs) 块，而不是每个 scan 都读满 limit 行
+        线程数不超过 pool 里空闲的 connection 个数，调用者在 batch() 里占用了 connection
+        导致没有空闲的时候在当前线程里复用调用者的 connection 依次执行，不会 NoConnectionsAvailable
+        """
+        if merge_by is None:
+            key = None
+        elif merge_by == 'row_key':
+            key = cls.merge_key
+        elif merge_by in cls._field_hash:
+            key = operator.attrgetter(merge_by)
+        else:
+            raise ValueError(f'Can not merge {cls.__name__} by {merge_by}')
+
+        scans = []
+        for spec in scan_specs:
+            spec = dict(spec)
+            if limit is not None:
+                spec['limit'] = limit if spec.get('limit') is None else min(spec['limit'], limit)
+            scans.append(cls._prepare_scan(**spec))
+        if not scans:
+            return []
+
+        scans_count = sum(len(scan_ranges) for scan_ranges, _ in scans)
+        with cls.scan_executor(scans_count, max_workers = max_workers) as executor:
+            streams = [
+                cls._stream_filter(executor, scan_ranges, scan_kwargs)
+                for scan_ranges, scan_kwargs in scans
+            ]
+            if key is None:
+                merged = itertools.chain(*streams)
+            else:
+                merged = heapq.merge(*streams, key = key, reverse = reverse)
+            return list(itertools.islice(merged, limit))
 
-        # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit = limit, reverse = reverse)
+    @classmethod
+    def _scan_range(cls, table, codec, salted, row_start, row_stop, row_prefix, **scan_kwargs):
+        rows = table.scan(row_start, row_stop, row_prefix, **scan_kwargs)
+        return cls._init_scanned_rows(rows, codec, salted)
+
+    @classmethod
+    def _init_scanned_rows(cls, rows, codec, salted):
+        if salted:
+            # deserialize to instance
+            for row_key, row_data in rows:
+                yield cls.init_from_row(row_key, row_data, codec = codec)
+            return
 
-        # deserialize to instance list
-        results = []
+        # 旧格式的范围里可能混进了新格式的 row key，解析不了的跳过
         for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+            try:
+                instance = cls.init_from_row(row_key, row_data, codec = codec, salted = False)
+            except (ValueError, UnicodeDecodeError):
+                continue
+            if instance is None or any(getattr(instance, key) is None for key in cls.Meta.row_key):
+                continue
+            yield instance
+
+    @classmethod
+    def _unique_by_row_key(cls, instances):
+        # 同一行同时存在新旧两种格式的时候，heapq.merge 保证新格式的排在前面，只保留新格式的
+        last_key = None
+        for instance in instances:
+            key = cls.merge_key(instance)
+            if key == last_key:
+                continue
+            last_key = key
+            yield instance
+
+    @classmethod
+    def count(cls, start = None, stop = None, prefix = None, filter_string = None):
+        # 每一行只传输 row key 和第一个 column 的 column key，不传输任何 value
+        # 如果有 SingleColumnValueFilter 之类需要读取 column value 的 filter，就不能再叠加
+        # KeyOnlyFilter 了，这种情况下直接使用调用者的 filter，只是不做 deserialize
+        if filter_string is None:
+            filter_string = FirstKeyOnlyFilter() & KeyOnlyFilter()
+
+        if cls._legacy_row_key_codec is not None:
+            # 新旧格式的数据需要去重，只能解析 row key
+            instances = cls.iter_filter(start, stop, prefix, filter_string = filter_string)
+            return sum(1 for _ in instances)
+
+        # 不同 bucket 里的数据不会重复，各自 count 之后加起来就可以
+        total = 0
+        with cls.get_table() as table:
+            for codec, salted, row_start, row_stop, row_prefix in cls.get_scan_ranges(start, stop, prefix):
+                rows = table.scan(
+                    row_start,
+                    row_stop,
+                    row_prefix,
+                    filter = str(filter_string),
+                    batch_size = settings.HBASE_SCAN_BATCH_SIZE,
+                )
+                total += sum(1 for _ in rows)
+        return total
+
+    @classmethod
+    def exists(cls, start = None, stop = None, prefix = None, filter_string = None):
+        if filter_string is None:
+            filter_string = FirstKeyOnlyFilter() & KeyOnlyFilter()
+        results = cls.filter(
+            start = start,
+            stop = stop,
+            prefix = prefix,
+            limit = 1,
+            filter_string = filter_string,
+        )
+        return len(results) > 0
 
     @classmethod
-    def delete(cls, **kwargs):
-        row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
\ No newline at end of file
+    def get_column_keys(cls, columns):
+        # ['to_user_id'] -> [b'cf:to_user_id']
+        if columns is None:
+            return None
+        column_keys = []
+        for key in columns:
+            field = cls._field_hash.get(key)
+            if field is None or not field.column_family:
+                raise ValueError(f'{key} is not a column field of {cls.__name__}')
+            column_keys.append(bytes('{}:{}'.format(field.column_family, key), encoding = 'utf-8'))
+        return column_keys
+
+    @classmethod
+    def column_value_filter(cls, key, operator, value, filter_if_missing = True):
+        """
+        HBaseFollowing.column_value_filter('to_user_id', '=', 2)
+        按照 field 的规则 serialize value，生成一个 SingleColumnValueFilter
+        """
+        field = cls._field_hash.get(key)
+        if field is None or not field.column_family:
+            raise ValueError(f'{key} is not a column field of {cls.__name__}')
+        return SingleColumnValueFilter(
+            field.column_family,
+            key,
+            operator,
+            field.serialize(value),
+            filter_if_missing = filter_if_missing,
+        )
+
+    @classmethod
+    def get_counter_column_key(cls, key):
+        field = cls._field_hash.get(key)
+        if not isinstance(field, CounterField):
+            raise ValueError(f'{key} is not a counter field of {cls.__name__}')
+        return bytes('{}:{}'.format(field.column_family, key), encoding = 'utf-8')
+
+    @classmethod
+    def counter_inc(cls, key, value = 1, **kwargs):
+        """
+        HBaseFriendshipCount.counter_inc('followings_count', 1, user_id = 1)
+        在 region server 上原子地加 value，返回加完之后的值，不存在的 counter 从 0 开始
+        counter 不能放在 batch 里，每次调用都是一次 rpc
+        """
+        row_key = cls.salt_row_key(cls.serialize_row_key(kwargs))
+        with cls.get_table() as table:
+            return table.counter_inc(row_key, cls.get_counter_column_key(key), value = value)
+
+    @classmethod
+    def counter_get(cls, key, **kwargs):
+        # 不存在的 counter 返回 0
+        row_key = cls.salt_row_key(cls.serialize_row_key(kwargs))
+        with cls.get_table() as table:
+            return table.counter_get(row_key, cls.get_counter_column_key(key))
+
+    @classmethod
+    def counter_set(cls, key, value, **kwargs):
+        row_key = cls.salt_row_key(cls.serialize_row_key(kwargs))
+        with cls.get_table() as table:
+            table.counter_set(row_key, cls.get_counter_column_key(key), value = value)
+
+    @classmethod
+    def delete(cls, instance = None, **kwargs):
+        """
+        HBaseFollowing.delete(from_user_id = 1, created_at = ts)
+        调用方已经读出了整行的话传 instance，不会再 get 一次去找索引
+        HBaseFollowing.delete(instance = following)
+        """
+        if instance is not None:
+            kwargs = instance.__dict__
+        # 迁移 row key 格式的过程中，新旧两种格式的 row key 都要删掉
+        row_keys = [cls.salt_row_key(cls.serialize_row_key(kwargs))]
+        if cls._legacy_row_key_codec is not None:
+            row_keys.append(cls.serialize_row_key(kwargs, codec = cls._legacy_row_key_codec))
+        index_keys = []
+        if cls._indexes:
+            # 索引里可能有 column 里的 field，需要先读出整行才知道要删哪些索引
+            if instance is None:
+                instance = cls.get(**kwargs)
+            if instance is not None:
+                index_keys = cls.get_index_keys(instance.__dict__)
+        with cls.get_writer() as writer:
+            for row_key in row_keys:
+                writer.delete(row_key)
+        if index_keys:
+            with cls.get_writer(cls.get_index_table_name()) as writer:
+                for index_key in index_keys:
+                    writer.delete(index_key)
+
+    @classmethod
+    def migrate_legacy_rows(cls, prefix = None, batch_size = None):
+        """
+        把旧格式 row key 的数据改写成新格式，写入新格式的同时删除旧格式
+        HBaseFollowing.migrate_legacy_rows(prefix = (user_id,))
+        """
+        legacy_codec = cls._legacy_row_key_codec
+        if legacy_codec is None:
+            raise ValueError(f'{cls.__name__} has no legacy_row_key_codec to migrate from')
+        row_prefix = cls.serialize_row_key_from_tuple(prefix, codec = legacy_codec)
+        migrated = 0
+        with cls.get_table() as table, cls.batch(batch_size = batch_size) as batch:
+            rows = cls._scan_range(
+                table,
+                legacy_codec,
+                False,
+                None,
+                None,
+                row_prefix,
+                batch_size = settings.HBASE_SCAN_BATCH_SIZE,
+            )
+            for instance in rows:
+                row_data = cls.serialize_row_data(instance.__dict__)
+                batch.put(instance.row_key, row_data)
+                batch.delete(cls.serialize_row_key(instance.__dict__, codec = legacy_codec))
+                if cls._indexes:
+                    # 索引指向新格式的 row key
+                    cls.save_index_rows([(instance.row_key, row_data, instance.__dict__)])
+                migrated += 1
+        return migrated
\ No newline at end of file
@@ -5,6 +5,7 @@ from accounts.api.serializers import UserSerializerForFriendship
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from accounts.services import UserService
+from utils.serializers import PrefetchListSerializer
 
 
 class FriendshipSerializerForCreate(serializers.Serializer):
@@ -41,6 +42,9 @@ class BaseFriendshipSerializer(serializers.Serializer):
     created_at = serializers.SerializerMethodField()
     has_followed = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
     def update(self, instance, validated_data):
         pass
 
@@ -61,6 +65,9 @@ class BaseFriendshipSerializer(serializers.Serializer):
     def get_user_id(self, obj):
         raise NotImplementedError
 
+    def prefetch(self, friendships):
+        UserService.get_users_through_cache([self.get_user_id(obj) for obj in friendships])
+
     def get_has_followed(self, obj):
         return self.get_user_id(obj) in self._get_following_user_id_set()
 
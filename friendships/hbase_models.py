@@ -1,3 +1,4 @@
+from django.conf import settings
 from django_hbase import models
 
 class HBaseFollowing(models.HBaseModel):
@@ -18,6 +19,10 @@ class HBaseFollowing(models.HBaseModel):
     class Meta:
         table_name = 'twitter_followings'
         row_key = ('from_user_id', 'created_at')
+        # 大 V 一次关注很多人的时候写入会集中在同一个 region 上
+        salt_buckets = settings.HBASE_FRIENDSHIP_SALT_BUCKETS
+        # 用于判断 A 是否关注了 B
+        indexes = [('from_user_id', 'to_user_id')]
 
 class HBaseFollower(models.HBaseModel):
     """
@@ -36,4 +41,22 @@ class HBaseFollower(models.HBaseModel):
 
     class Meta:
         table_name = 'twitter_followers'
-        row_key = ('to_user_id', 'created_at')
\ No newline at end of file
+        row_key = ('to_user_id', 'created_at')
+        # 大 V 的粉丝列表是一个很长的连续范围，打散之后可以分散到多个 region 上
+        salt_buckets = settings.HBASE_FRIENDSHIP_SALT_BUCKETS
+
+class HBaseFriendshipCount(models.HBaseModel):
+    """
+    每个用户关注了多少人，被多少人关注，使用 hbase 的 counter，读取的时候不需要 scan
+    follow / unfollow 的时候原子地加减，数据不一致的时候可以用全量 scan 重建
+    """
+    # row_key
+    user_id = models.IntegerField(reverse = True)
+
+    # column_key
+    followings_count = models.CounterField(column_family = 'cf')
+    followers_count = models.CounterField(column_family = 'cf')
+
+    class Meta:
+        table_name = 'twitter_friendship_counts'
+        row_key = ('user_id',)
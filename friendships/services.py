@@ -1,10 +1,14 @@
 from friendships.models import Friendship
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Q
 from twitter.cache import FOLLOWINGS_PATTERN
 from gatekeeper.models import GateKeeper
-from friendships.hbase_models import HBaseFollowing, HBaseFollower
+from friendships.hbase_models import HBaseFollowing, HBaseFollower, HBaseFriendshipCount
+from django_hbase.models import FirstKeyOnlyFilter, KeyOnlyFilter
 
+import collections
+import itertools
 import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
@@ -40,15 +44,65 @@ class FriendshipService(object):
 
     @classmethod
     def get_follower_ids(cls, to_user_id):
-        friendships = Friendship.objects.filter(to_user_id = to_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+        return [
+            follower_id
+            for follower_ids in cls.iter_follower_id_batches(to_user_id)
+            for follower_id in follower_ids
+        ]
+
+    @classmethod
+    def iter_follower_id_batches(cls, to_user_id, batch_size = None):
+        """
+        每次 yield 一批 follower ids，不会把所有 followers 一次读到内存里
+        大 V 的 followers 很多，fanout 的时候边读边分发
+        """
+        if batch_size is None:
+            batch_size = settings.FOLLOWER_ID_BATCH_SIZE
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            yield from cls._iter_mysql_follower_id_batches(to_user_id, batch_size)
+            return
+        # hbase 的 scanner 本身就是按需一批一批读取的，只需要读 from_user_id 这一个 column
+        followers = HBaseFollower.iter_filter(
+            prefix = (to_user_id,),
+            batch_size = batch_size,
+            columns = ['from_user_id'],
+        )
+        while True:
+            follower_ids = [
+                follower.from_user_id
+                for follower in itertools.islice(followers, batch_size)
+            ]
+            if not follower_ids:
+                return
+            yield follower_ids
+
+    @classmethod
+    def _iter_mysql_follower_id_batches(cls, to_user_id, batch_size):
+        # 用 (created_at, id) 做 keyset 分页，每一页都走 (to_user_id, created_at) 的索引
+        # 不使用 offset，否则越往后的页数据库需要跳过的行越多
+        queryset = Friendship.objects.filter(to_user_id = to_user_id).order_by('created_at', 'id')
+        last = None
+        while True:
+            page = queryset
+            if last is not None:
+                created_at, friendship_id = last
+                page = page.filter(
+                    Q(created_at__gt = created_at) | Q(created_at = created_at, id__gt = friendship_id),
+                )
+            rows = list(page.values_list('created_at', 'id', 'from_user_id')[:batch_size])
+            if not rows:
+                return
+            yield [from_user_id for _, _, from_user_id in rows]
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][:2]
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             friendships = Friendship.objects.filter(from_user_id = from_user_id)
         else:
-            friendships = HBaseFollowing.filter(prefix = (from_user_id,))
+            friendships = HBaseFollowing.iter_filter(prefix = (from_user_id,))
         user_id_set = set([fs.to_user_id for fs in friendships])
         return user_id_set
 
@@ -63,23 +117,37 @@ class FriendshipService(object):
             return None
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             # create data in mysql
-            return Friendship.objects.create(
+            friendship = Friendship.objects.create(
                 from_user_id = from_user_id,
                 to_user_id = to_user_id,
             )
+            cls.notify_newsfeeds(from_user_id, to_user_id, followed = True)
+            return friendship
+
+        # 已经关注过的话直接返回，否则会多写一行并且 counter 被加两次
+        # 和 unfollow 一样先通过 (from_user_id, to_user_id) 的索引查一次
+        following = cls.get_follow_instance(from_user_id, to_user_id)
+        if following is not None:
+            return following
 
         # create data in hbase
+        # 两张表各自用一个 batch，with 里出错的话两张表都不会写入
         now = int(time.time() * 1000000)
-        HBaseFollower.create(
-            from_user_id = from_user_id,
-            to_user_id = to_user_id,
-            created_at = now,
-        )
-        return HBaseFollowing.create(
-            from_user_id = from_user_id,
-            to_user_id = to_user_id,
-            created_at = now,
-        )
+        with HBaseFollower.batch(), HBaseFollowing.batch():
+            HBaseFollower.create(
+                from_user_id = from_user_id,
+                to_user_id = to_user_id,
+                created_at = now,
+            )
+            following = HBaseFollowing.create(
+                from_user_id = from_user_id,
+                to_user_id = to_user_id,
+                created_at = now,
+            )
+        # 两张表都写成功之后再更新 counter
+        cls.incr_friendship_counts(from_user_id, to_user_id, 1)
+        cls.notify_newsfeeds(from_user_id, to_user_id, followed = True)
+        return following
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -96,16 +164,64 @@ class FriendshipService(object):
                 from_user_id = from_user_id,
                 to_user_id = to_user_id,
             ).delete()
+            if deleted:
+                cls.notify_newsfeeds(from_user_id, to_user_id, followed = False)
             return deleted
 
         instance = cls.get_follow_instance(from_user_id, to_user_id)
         if instance is None:
             return 0
 
-        HBaseFollowing.delete(from_user_id = from_user_id, created_at = instance.created_at)
-        HBaseFollower.delete(to_user_id = to_user_id, created_at = instance.created_at)
+        # 和 follow 一样先删掉 friendship，再更新 counter
+        with HBaseFollower.batch(), HBaseFollowing.batch():
+            # 索引需要的整行已经读出来了，不用再 get 一次
+            HBaseFollowing.delete(instance = instance)
+            HBaseFollower.delete(to_user_id = to_user_id, created_at = instance.created_at)
+        cls.incr_friendship_counts(from_user_id, to_user_id, -1)
+        cls.notify_newsfeeds(from_user_id, to_user_id, followed = False)
         return 1
 
+    @classmethod
+    def notify_newsfeeds(cls, from_user_id, to_user_id, followed):
+        # 如果这个import放在函数外面，会出现循环引用的问题
+        from newsfeeds.services import NewsFeedService
+        if followed:
+            NewsFeedService.on_follow(from_user_id, to_user_id)
+        else:
+            NewsFeedService.on_unfollow(from_user_id, to_user_id)
+
+    @classmethod
+    def incr_friendship_counts(cls, from_user_id, to_user_id, value):
+        # counter 和 friendship 不在同一个 batch 里，没有办法原子地一起写入
+        # 所以总是先写 friendship，只有真的新建或者删掉了一行才更新 counter，
+        # 两步之间进程挂掉的话 counter 会少算，由每天定时执行的 rebuild_friendship_counts 修复
+        HBaseFriendshipCount.counter_inc('followings_count', value, user_id = from_user_id)
+        HBaseFriendshipCount.counter_inc('followers_count', value, user_id = to_user_id)
+
+    @classmethod
+    def backfill_hbase_friendships(cls, friendships, batch_size = None, wal = True):
+        """
+        把 mysql 里的 friendships 写入 hbase 的两张表，用于数据迁移
+        每张表一个 batch，而不是每条数据两次 rpc
+        不会更新 counter，迁移完成之后需要执行一次 rebuild_friendship_counts
+        """
+        followers, followings = [], []
+        for friendship in friendships:
+            created_at = int(friendship.created_at.timestamp() * 1000000)
+            followers.append(HBaseFollower(
+                from_user_id = friendship.from_user_id,
+                to_user_id = friendship.to_user_id,
+                created_at = created_at,
+            ))
+            followings.append(HBaseFollowing(
+                from_user_id = friendship.from_user_id,
+                to_user_id = friendship.to_user_id,
+                created_at = created_at,
+            ))
+        HBaseFollower.bulk_create(followers, batch_size = batch_size, wal = wal)
+        HBaseFollowing.bulk_create(followings, batch_size = batch_size, wal = wal)
+        return len(followings)
+
 
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
@@ -121,15 +237,60 @@ class FriendshipService(object):
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix = (from_user_id,))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
-        return None
+        # 通过 (from_user_id, to_user_id) 的二级索引直接读取一行，不需要 scan
+        instance = HBaseFollowing.get_by_index(from_user_id = from_user_id, to_user_id = to_user_id)
+        if instance is not None or not settings.HBASE_FRIENDSHIP_INDEX_FALLBACK:
+            return instance
+        # 加索引之前关注的还没有索引，build_indexes 执行完之前还需要 scan 一次
+        # 在 region server 上按照 to_user_id 过滤，找到之后 limit = 1 马上结束 scan
+        followings = HBaseFollowing.filter(
+            prefix = (from_user_id,),
+            filter_string = HBaseFollowing.column_value_filter('to_user_id', '=', to_user_id),
+            limit = 1,
+        )
+        return followings[0] if followings else None
 
     @classmethod
     def get_following_count(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(from_user_id = from_user_id).count()
-        followings = HBaseFollowing.filter(prefix = (from_user_id,))
-        return len(followings)
\ No newline at end of file
+        # follow / unfollow 的时候维护的 counter，一次 rpc 读取，不需要 scan
+        return HBaseFriendshipCount.counter_get('followings_count', user_id = from_user_id)
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return Friendship.objects.filter(to_user_id = to_user_id).count()
+        return HBaseFriendshipCount.counter_get('followers_count', user_id = to_user_id)
+
+    @classmethod
+    def rebuild_friendship_counts(cls, batch_size = None):
+        """
+        全量 scan 两张表重新计算每个用户的 counter，用于修复不一致的数据
+        scan 过程中发生的 follow / unfollow 可能会被覆盖掉，需要在低峰期执行
+        """
+        # 只需要 row key 里的 user id，不传输 column value
+        key_only = FirstKeyOnlyFilter() & KeyOnlyFilter()
+        followings_counts = collections.Counter(
+            following.from_user_id
+            for following in HBaseFollowing.iter_filter(filter_string = key_only)
+        )
+        followers_counts = collections.Counter(
+            follower.to_user_id
+            for follower in HBaseFollower.iter_filter(filter_string = key_only)
+        )
+        # 已经没有任何关注关系的用户也需要把 counter 清零
+        user_ids = set(followings_counts) | set(followers_counts) | set(
+            count.user_id
+            for count in HBaseFriendshipCount.iter_filter(filter_string = key_only)
+        )
+        # counter 的存储格式就是 8 个字节的 long，可以直接用 batch 写入
+        HBaseFriendshipCount.bulk_create([
+            HBaseFriendshipCount(
+                user_id = user_id,
+                followings_count = followings_counts[user_id],
+                followers_count = followers_counts[user_id],
+            )
+            for user_id in user_ids
+        ], batch_size = batch_size)
+        return len(user_ids)
\ No newline at end of file
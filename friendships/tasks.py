@@ -0,0 +1,9 @@
+from celery import shared_task
+from friendships.services import FriendshipService
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key = 'default', time_limit = ONE_HOUR)
+def rebuild_friendship_counts_task():
+    users_count = FriendshipService.rebuild_friendship_counts()
+    return '{} friendship counts rebuilt'.format(users_count)
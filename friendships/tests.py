@@ -1,11 +1,55 @@
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from friendships.tasks import rebuild_friendship_counts_task
+from gatekeeper.models import GateKeeper
 from testing.testcases import TestCase
-from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.hbase_models import HBaseFollower, HBaseFollowing
+from django_hbase import models
+from django_hbase.models.codecs import get_row_key_codec
+from django_hbase.models import (
+    BadRowKeyError,
+    EmptyColumnError,
+    FirstKeyOnlyFilter,
+    KeyOnlyFilter,
+    PageFilter,
+    SingleColumnValueFilter,
+)
+from friendships.hbase_models import HBaseFollower, HBaseFollowing, HBaseFriendshipCount
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django_hbase import memory
+from django_hbase.client import HBaseClient, HBaseConnectionPool, NoConnectionsAvailable
 
+from thriftpy2.thrift import TException
+from unittest import mock
+
+import socket
+import threading
 import time
 
+
+class BinaryFollowing(models.HBaseModel):
+    # 和 HBaseFollowing 一样的结构，使用 binary row key，并且支持读取 text row key 的旧数据
+    from_user_id = models.IntegerField(reverse = True)
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family = 'cf')
+
+    class Meta:
+        table_name = 'binary_followings'
+        row_key = ('from_user_id', 'created_at')
+        row_key_codec = 'binary'
+        legacy_row_key_codec = 'text'
+
+class SaltedFollowing(models.HBaseModel):
+    # 和 HBaseFollowing 一样的结构，row key 打散到 4 个 bucket 里
+    from_user_id = models.IntegerField(reverse = True)
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family = 'cf')
+
+    class Meta:
+        table_name = 'salted_followings'
+        row_key = ('from_user_id', 'created_at')
+        salt_buckets = 4
+
 class FriendshipServiceTests(TestCase):
 
     def setUp(self):
@@ -26,6 +70,116 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(self.rui.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
+    def test_backfill_hbase_friendships(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        friendships = [
+            Friendship.objects.create(from_user = self.rui, to_user = user1),
+            Friendship.objects.create(from_user = self.rui, to_user = user2),
+            Friendship.objects.create(from_user = self.ming, to_user = user1),
+        ]
+        count = FriendshipService.backfill_hbase_friendships(friendships, batch_size = 2)
+        self.assertEqual(count, 3)
+
+        followings = HBaseFollowing.filter(prefix = (self.rui.id,))
+        self.assertEqual([f.to_user_id for f in followings], [user1.id, user2.id])
+        followers = HBaseFollower.filter(prefix = (user1.id,))
+        self.assertEqual([f.from_user_id for f in followers], [self.rui.id, self.ming.id])
+        self.assertEqual(FriendshipService.has_followed(self.ming.id, user1.id), True)
+        self.assertEqual(FriendshipService.has_followed(self.ming.id, user2.id), False)
+
+        # backfill 不会更新 counter，需要重建一次
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 0)
+        self.assertEqual(FriendshipService.rebuild_friendship_counts(), 4)
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(user1.id), 2)
+
+    def test_follow_instance_without_index(self):
+        FriendshipService.follow(self.rui.id, self.ming.id)
+        # 索引上线之前的关注关系没有索引
+        with HBaseFollowing.get_table(HBaseFollowing.get_index_table_name()) as table:
+            for row_key, _ in table.scan():
+                table.delete(row_key)
+        # 默认不 scan，只有迁移期间打开 fallback 才能查到
+        self.assertEqual(FriendshipService.has_followed(self.rui.id, self.ming.id), False)
+        with self.settings(HBASE_FRIENDSHIP_INDEX_FALLBACK = True):
+            self.assertEqual(FriendshipService.has_followed(self.rui.id, self.ming.id), True)
+        HBaseFollowing.build_indexes()
+        self.assertEqual(FriendshipService.has_followed(self.rui.id, self.ming.id), True)
+
+    def test_unfollow_without_extra_get(self):
+        FriendshipService.follow(self.rui.id, self.ming.id)
+        # unfollow 已经通过索引读出了整行，delete 的时候不需要再 get 一次
+        with mock.patch.object(HBaseFollowing, 'get', wraps = HBaseFollowing.get) as get:
+            self.assertEqual(FriendshipService.unfollow(self.rui.id, self.ming.id), 1)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(FriendshipService.has_followed(self.rui.id, self.ming.id), False)
+        with HBaseFollowing.get_table(HBaseFollowing.get_index_table_name()) as table:
+            self.assertEqual(list(table.scan()), [])
+
+    def test_iter_follower_id_batches(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        for user in users:
+            FriendshipService.follow(user.id, self.rui.id)
+        batches = list(FriendshipService.iter_follower_id_batches(self.rui.id, batch_size = 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(sorted(sum(batches, [])), [user.id for user in users])
+        self.assertEqual(sorted(FriendshipService.get_follower_ids(self.rui.id)), [user.id for user in users])
+
+        # mysql 里用 keyset 分页，每一批一次 query
+        GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 0)
+        for user in users:
+            Friendship.objects.create(from_user = user, to_user = self.ming)
+        with self.assertNumQueries(3):
+            batches = list(FriendshipService.iter_follower_id_batches(self.ming.id, batch_size = 2))
+        self.assertEqual(batches, [[users[0].id, users[1].id], [users[2].id, users[3].id], [users[4].id]])
+        self.assertEqual(list(FriendshipService.iter_follower_id_batches(self.rui.id)), [])
+
+    def test_friendship_counts(self):
+        user1 = self.create_user('user1')
+        FriendshipService.follow(self.rui.id, user1.id)
+        FriendshipService.follow(self.rui.id, self.ming.id)
+        FriendshipService.follow(self.ming.id, user1.id)
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 2)
+        self.assertEqual(FriendshipService.get_following_count(user1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(user1.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(self.ming.id), 1)
+
+        # 重复关注不会多写一行，counter 也不变
+        following = FriendshipService.follow(self.rui.id, user1.id)
+        self.assertEqual(following.to_user_id, user1.id)
+        self.assertEqual(len(HBaseFollowing.filter(prefix = (self.rui.id,))), 2)
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(user1.id), 2)
+
+        FriendshipService.unfollow(self.rui.id, user1.id)
+        # 没有关注过，counter 不变
+        FriendshipService.unfollow(self.rui.id, user1.id)
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(user1.id), 1)
+
+        # counter 被改乱之后可以通过全量 scan 重建
+        HBaseFriendshipCount.counter_set('followings_count', 100, user_id = self.rui.id)
+        HBaseFriendshipCount.counter_set('followers_count', 100, user_id = self.rui.id)
+        self.assertEqual(FriendshipService.rebuild_friendship_counts(), 3)
+        self.assertEqual(FriendshipService.get_following_count(self.rui.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(self.rui.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.ming.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(user1.id), 1)
+
+        # 写完 friendship 之后更新 counter 之前挂掉，counter 少算，由定时任务修复
+        user2 = self.create_user('user2')
+        with mock.patch.object(FriendshipService, 'incr_friendship_counts', side_effect = RuntimeError):
+            with self.assertRaises(RuntimeError):
+                FriendshipService.follow(self.ming.id, user2.id)
+        self.assertEqual(FriendshipService.has_followed(self.ming.id, user2.id), True)
+        self.assertEqual(FriendshipService.get_follower_count(user2.id), 0)
+        schedule = settings.CELERY_BEAT_SCHEDULE['rebuild-friendship-counts']
+        self.assertEqual(schedule['task'], rebuild_friendship_counts_task.name)
+        rebuild_friendship_counts_task.delay()
+        self.assertEqual(FriendshipService.get_follower_count(user2.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.ming.id), 2)
+
 
 class HBaseTests(TestCase):
 
@@ -134,3 +288,675 @@ class HBaseTests(TestCase):
         self.assertEqual(results[1].to_user_id, 2)
 
 
+
+    def test_field_metadata(self):
+        self.assertEqual(
+            [key for key, field in HBaseFollowing._row_key_fields],
+            ['from_user_id', 'created_at'],
+        )
+        self.assertEqual(
+            [column_key for key, field, column_key in HBaseFollowing._column_fields],
+            ['cf:to_user_id'],
+        )
+        self.assertIs(HBaseFollower._column_key_hash[b'cf:from_user_id'][1], HBaseFollower.from_user_id)
+        self.assertEqual(set(HBaseFollower.get_field_hash()), {'to_user_id', 'created_at', 'from_user_id'})
+
+        # 和之前的编码方式保持一致
+        row_key = HBaseFollowing.serialize_row_key({'from_user_id': 123, 'created_at': 456})
+        self.assertEqual(row_key, b'3210000000000000:456')
+        self.assertEqual(
+            HBaseFollowing.deserialize_row_key(row_key),
+            {'from_user_id': 123, 'created_at': 456},
+        )
+        self.assertEqual(HBaseFollowing.deserialize_row_key(b'3210000000000000'), {'from_user_id': 123})
+        self.assertEqual(
+            HBaseFollowing.serialize_row_data({'to_user_id': 7}),
+            {'cf:to_user_id': '0000000000000007'},
+        )
+
+    def test_binary_row_key(self):
+        data = {'from_user_id': 123, 'created_at': 456}
+        row_key = BinaryFollowing.serialize_row_key(data)
+        # 1 个字节的 salt + 8 个字节的 from_user_id + 8 个字节的 created_at
+        self.assertEqual(len(row_key), 17)
+        self.assertEqual(row_key[1:9], (123 + (1 << 63)).to_bytes(8, 'big'))
+        self.assertEqual(BinaryFollowing.deserialize_row_key(row_key), data)
+        self.assertEqual(BinaryFollowing.deserialize_row_key(row_key[:9]), {'from_user_id': 123})
+        self.assertEqual(BinaryFollowing.serialize_row_key_from_tuple((123,)), row_key[:9])
+        self.assertEqual(
+            BinaryFollowing.serialize_row_key(data, codec = HBaseFollowing._row_key_codec),
+            HBaseFollowing.serialize_row_key(data),
+        )
+
+        # 字典序和数值大小的顺序一致，包括负数
+        keys = [
+            BinaryFollowing.serialize_row_key({'from_user_id': 1, 'created_at': ts})
+            for ts in [-5, 0, 9, 10, 1 << 40]
+        ]
+        self.assertEqual(sorted(keys), keys)
+
+        # binary row key 只支持定长的 field
+        class BadModel:
+            _row_key_fields = (('name', models.HBaseField()),)
+        try:
+            get_row_key_codec('binary').validate(BadModel)
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_binary_row_key_dual_read(self):
+        ts = self.ts_now
+        # 旧格式的数据
+        text_codec = HBaseFollowing._row_key_codec
+        with BinaryFollowing.get_table() as table:
+            for i in [0, 2]:
+                data = {'from_user_id': 1, 'created_at': ts + i}
+                row_key = BinaryFollowing.serialize_row_key(data, codec = text_codec)
+                table.put(row_key, {'cf:to_user_id': str(i).rjust(16, '0')})
+        # 新格式的数据
+        for i in [1, 3]:
+            BinaryFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+
+        self.assertEqual(BinaryFollowing.get(from_user_id = 1, created_at = ts).to_user_id, 0)
+        self.assertEqual(BinaryFollowing.get(from_user_id = 1, created_at = ts + 1).to_user_id, 1)
+        instances = BinaryFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts + 2},
+            {'from_user_id': 1, 'created_at': ts + 3},
+            {'from_user_id': 1, 'created_at': ts + 4},
+        ])
+        self.assertEqual([i and i.to_user_id for i in instances], [2, 3, None])
+
+        # 新旧两种格式的数据归并之后仍然按照 row key 有序
+        results = BinaryFollowing.filter(prefix = (1,))
+        self.assertEqual([f.to_user_id for f in results], [0, 1, 2, 3])
+        results = BinaryFollowing.filter(prefix = (1,), reverse = True, limit = 3)
+        self.assertEqual([f.to_user_id for f in results], [3, 2, 1])
+        results = BinaryFollowing.filter(start = (1, ts + 1), stop = (1, ts + 3))
+        self.assertEqual([f.to_user_id for f in results], [1, 2])
+        self.assertEqual(BinaryFollowing.count(prefix = (1,)), 4)
+
+        # 旧数据被重新保存之后，新旧两种格式同时存在，只返回一次
+        BinaryFollowing.create(from_user_id = 1, to_user_id = 2, created_at = ts + 2)
+        self.assertEqual(BinaryFollowing.count(prefix = (1,)), 4)
+
+        # 删除的时候两种格式都删掉
+        BinaryFollowing.delete(from_user_id = 1, created_at = ts + 2)
+        self.assertEqual(BinaryFollowing.get(from_user_id = 1, created_at = ts + 2), None)
+        self.assertEqual(BinaryFollowing.count(prefix = (1,)), 3)
+
+        # 迁移之后只剩新格式
+        self.assertEqual(BinaryFollowing.migrate_legacy_rows(prefix = (1,)), 1)
+        self.assertEqual(BinaryFollowing.migrate_legacy_rows(prefix = (1,)), 0)
+        with BinaryFollowing.get_table() as table:
+            row_keys = [row_key for row_key, _ in table.scan()]
+        self.assertEqual(len(row_keys), 3)
+        self.assertEqual(set(len(row_key) for row_key in row_keys), {17})
+        results = BinaryFollowing.filter(prefix = (1,))
+        self.assertEqual([f.to_user_id for f in results], [0, 1, 3])
+
+    def test_salted_row_key(self):
+        ts = self.ts_now
+        for i in range(10):
+            SaltedFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+        SaltedFollowing.create(from_user_id = 2, to_user_id = 100, created_at = ts)
+
+        # 同一个用户的数据分布在多个 bucket 里
+        with SaltedFollowing.get_table() as table:
+            row_keys = [row_key for row_key, _ in table.scan()]
+        self.assertEqual(len(row_keys), 11)
+        self.assertEqual(len(set(row_key[:1] for row_key in row_keys)) > 1, True)
+        self.assertEqual(set(row_key[0] for row_key in row_keys) <= {0, 1, 2, 3}, True)
+
+        instance = SaltedFollowing.get(from_user_id = 1, created_at = ts + 3)
+        self.assertEqual(instance.to_user_id, 3)
+        instances = SaltedFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts + 5},
+            {'from_user_id': 1, 'created_at': ts + 20},
+        ])
+        self.assertEqual([i and i.to_user_id for i in instances], [5, None])
+
+        # 各个 bucket 的结果归并之后仍然按照 row key 有序
+        results = SaltedFollowing.filter(prefix = (1,))
+        self.assertEqual([f.to_user_id for f in results], list(range(10)))
+        results = SaltedFollowing.filter(prefix = (1,), reverse = True, limit = 3)
+        self.assertEqual([f.to_user_id for f in results], [9, 8, 7])
+        results = SaltedFollowing.filter(start = (1, ts + 2), stop = (1, ts + 5))
+        self.assertEqual([f.to_user_id for f in results], [2, 3, 4])
+        # 和 paginate_hbase 一样的向下翻页的查询方式
+        results = SaltedFollowing.filter(start = (1, ts + 5), stop = (1, None), limit = 3, reverse = True)
+        self.assertEqual([f.to_user_id for f in results], [5, 4, 3])
+        results = SaltedFollowing.filter(start = (1, ts + 7), stop = None)
+        self.assertEqual([f.from_user_id for f in results], [1, 1, 1, 2])
+        self.assertEqual(SaltedFollowing.count(prefix = (1,)), 10)
+        self.assertEqual(SaltedFollowing.count(), 11)
+        self.assertEqual(SaltedFollowing.exists(prefix = (2,)), True)
+
+        SaltedFollowing.delete(from_user_id = 1, created_at = ts + 3)
+        self.assertEqual(SaltedFollowing.get(from_user_id = 1, created_at = ts + 3), None)
+        self.assertEqual(SaltedFollowing.count(prefix = (1,)), 9)
+
+    def test_salted_parallel_scan(self):
+        ts = self.ts_now
+        for i in range(20):
+            SaltedFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+        SaltedFollowing.create(from_user_id = 2, to_user_id = 100, created_at = ts)
+
+        # 每个 bucket 分成每次 2 行的多次 scan，在线程池里执行
+        thread_ids = set()
+        scan_chunk = SaltedFollowing._scan_chunk
+
+        def record_thread(*args, **kwargs):
+            thread_ids.add(threading.get_ident())
+            return scan_chunk(*args, **kwargs)
+
+        with mock.patch.object(SaltedFollowing, '_scan_chunk', side_effect = record_thread) as chunk:
+            results = SaltedFollowing.filter(prefix = (1,), batch_size = 2)
+            self.assertEqual([f.to_user_id for f in results], list(range(20)))
+            self.assertEqual(chunk.call_count > 4, True)
+            self.assertEqual(threading.get_ident() in thread_ids, False)
+
+            # limit 限制了每个 bucket 最多 scan 多少行
+            chunk.reset_mock()
+            results = SaltedFollowing.filter(prefix = (1,), reverse = True, limit = 3, batch_size = 2)
+            self.assertEqual([f.to_user_id for f in results], [19, 18, 17])
+            self.assertEqual(chunk.call_count <= 8, True)
+
+            # 调用者提前结束的时候不再继续 scan
+            chunk.reset_mock()
+            instances = SaltedFollowing.iter_filter(prefix = (1,), batch_size = 2)
+            self.assertEqual(next(instances).to_user_id, 0)
+            instances.close()
+            self.assertEqual(chunk.call_count <= 8, True)
+
+            # pool 里没有空闲的 connection 的时候在当前线程里执行
+            thread_ids.clear()
+            with mock.patch.object(HBaseConnectionPool, 'get_free_count', return_value = 0):
+                results = SaltedFollowing.filter(start = (1, ts + 5), stop = (1, ts + 15), batch_size = 2)
+            self.assertEqual([f.to_user_id for f in results], list(range(5, 15)))
+            self.assertEqual(thread_ids, {threading.get_ident()})
+
+    def test_copy_unsalted_rows(self):
+        ts = self.ts_now
+        self.assertEqual(SaltedFollowing.get_table_name(), 'test_salted_followings_salted4')
+        unsalted_table_name = SaltedFollowing.get_unsalted_table_name()
+        with HBaseClient.connection() as conn:
+            conn.create_table(unsalted_table_name, {'cf': dict()})
+        try:
+            # 打开 salt_buckets 之前写入的没有打散的数据
+            with SaltedFollowing.get_table(unsalted_table_name) as table:
+                for i in range(5):
+                    data = {'from_user_id': 1, 'to_user_id': i, 'created_at': ts + i}
+                    table.put(SaltedFollowing.serialize_row_key(data), SaltedFollowing.serialize_row_data(data))
+            self.assertEqual(SaltedFollowing.filter(prefix = (1,)), [])
+
+            self.assertEqual(SaltedFollowing.copy_unsalted_rows(batch_size = 2), 5)
+            results = SaltedFollowing.filter(prefix = (1,))
+            self.assertEqual([f.to_user_id for f in results], list(range(5)))
+            # 重复执行不会产生重复的数据
+            self.assertEqual(SaltedFollowing.copy_unsalted_rows(), 5)
+            self.assertEqual(SaltedFollowing.count(prefix = (1,)), 5)
+        finally:
+            with HBaseClient.connection() as conn:
+                conn.delete_table(unsalted_table_name, True)
+        with self.assertRaises(ValueError):
+            HBaseFollowing.copy_unsalted_rows()
+
+    def test_multi_filter(self):
+        ts = self.ts_now
+        for user_id in [1, 2, 3]:
+            for i in range(3):
+                HBaseFollowing.create(
+                    from_user_id = user_id,
+                    to_user_id = user_id * 10 + i,
+                    created_at = ts + i * 3 + user_id,
+                )
+        specs = [{'prefix': (user_id,)} for user_id in [3, 1, 2]]
+
+        # 不归并的时候按照 scan_specs 的顺序拼接
+        results = HBaseFollowing.multi_filter(specs)
+        self.assertEqual([f.to_user_id for f in results], [30, 31, 32, 10, 11, 12, 20, 21, 22])
+        results = HBaseFollowing.multi_filter(specs, limit = 4, max_workers = 1)
+        self.assertEqual([f.to_user_id for f in results], [30, 31, 32, 10])
+
+        # 按照 created_at 归并
+        results = HBaseFollowing.multi_filter(specs, merge_by = 'created_at')
+        self.assertEqual([f.to_user_id for f in results], [10, 20, 30, 11, 21, 31, 12, 22, 32])
+        reverse_specs = [dict(spec, reverse = True) for spec in specs]
+        results = HBaseFollowing.multi_filter(
+            reverse_specs,
+            merge_by = 'created_at',
+            limit = 4,
+            reverse = True,
+        )
+        self.assertEqual([f.to_user_id for f in results], [32, 22, 12, 31])
+
+        # 按照 row key 归并
+        results = HBaseFollowing.multi_filter(specs, merge_by = 'row_key', limit = 2)
+        expected = sorted(HBaseFollowing.filter(), key = HBaseFollowing.merge_key)[:2]
+        self.assertEqual([f.to_user_id for f in results], [f.to_user_id for f in expected])
+
+        # 每个 scan 分块读取，凑够 limit 个就结束，不会每个 scan 都读满 limit 行
+        chunk_specs = [dict(spec, batch_size = 1) for spec in specs]
+        with mock.patch.object(HBaseFollowing, '_scan_chunk', wraps = HBaseFollowing._scan_chunk) as chunk:
+            results = HBaseFollowing.multi_filter(chunk_specs, limit = 2)
+        self.assertEqual([f.to_user_id for f in results], [30, 31])
+        # 每个 scan 的第一块加上第一个 scan 的第二块
+        self.assertEqual(chunk.call_count, 4)
+
+        # 调用者在 batch() 里占用了 connection，pool 里没有空闲的时候在当前线程里执行
+        thread_ids = set()
+        scan_chunk = HBaseFollowing._scan_chunk
+
+        def record_thread(*args, **kwargs):
+            thread_ids.add(threading.get_ident())
+            return scan_chunk(*args, **kwargs)
+
+        with mock.patch.object(HBaseFollowing, '_scan_chunk', side_effect = record_thread), \
+                mock.patch.object(HBaseConnectionPool, 'get_free_count', return_value = 0), \
+                HBaseFollowing.batch():
+            results = HBaseFollowing.multi_filter(specs, merge_by = 'created_at', limit = 4)
+        self.assertEqual([f.to_user_id for f in results], [10, 20, 30, 11])
+        self.assertEqual(thread_ids, {threading.get_ident()})
+
+        self.assertEqual(HBaseFollowing.multi_filter([]), [])
+        with self.assertRaises(ValueError):
+            HBaseFollowing.multi_filter(specs, merge_by = 'unknown')
+
+    def test_exclusive_bounds(self):
+        ts = self.ts_now
+        for model_class in [HBaseFollowing, SaltedFollowing, BinaryFollowing]:
+            for i in range(5):
+                model_class.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+            model_class.create(from_user_id = 2, to_user_id = 100, created_at = ts)
+
+            results = model_class.filter(start = (1, ts + 1), stop = (1, ts + 3), start_exclusive = True)
+            self.assertEqual([f.to_user_id for f in results], [2])
+            results = model_class.filter(start = (1, ts + 1), stop = (1, ts + 3), stop_inclusive = True)
+            self.assertEqual([f.to_user_id for f in results], [1, 2, 3])
+            results = model_class.filter(start = (1, ts + 3), stop = (1, None), reverse = True, start_exclusive = True)
+            self.assertEqual([f.to_user_id for f in results], [2, 1, 0])
+            results = model_class.filter(
+                start = (1, ts + 3),
+                stop = (1, ts + 1),
+                reverse = True,
+                start_exclusive = True,
+                stop_inclusive = True,
+            )
+            self.assertEqual([f.to_user_id for f in results], [2, 1])
+            results = model_class.filter(start = (1, ts + 4), start_exclusive = True)
+            self.assertEqual([f.to_user_id for f in results], [100])
+
+    def test_counter_field(self):
+        self.assertEqual(HBaseFriendshipCount.counter_get('followings_count', user_id = 1), 0)
+        self.assertEqual(HBaseFriendshipCount.counter_inc('followings_count', user_id = 1), 1)
+        self.assertEqual(HBaseFriendshipCount.counter_inc('followings_count', 5, user_id = 1), 6)
+        self.assertEqual(HBaseFriendshipCount.counter_inc('followers_count', -2, user_id = 1), -2)
+        self.assertEqual(HBaseFriendshipCount.counter_get('followings_count', user_id = 1), 6)
+
+        # counter 也可以像普通的 column 一样读取
+        instance = HBaseFriendshipCount.get(user_id = 1)
+        self.assertEqual(instance.followings_count, 6)
+        self.assertEqual(instance.followers_count, -2)
+
+        HBaseFriendshipCount.counter_set('followers_count', 3, user_id = 1)
+        self.assertEqual(HBaseFriendshipCount.counter_get('followers_count', user_id = 1), 3)
+        HBaseFriendshipCount.create(user_id = 2, followings_count = 7)
+        self.assertEqual(HBaseFriendshipCount.counter_inc('followings_count', user_id = 2), 8)
+
+        with self.assertRaises(ValueError):
+            HBaseFollowing.counter_inc('to_user_id', from_user_id = 1, created_at = self.ts_now)
+        with self.assertRaises(ValueError):
+            models.CounterField()
+
+    def test_memory_backend(self):
+        conn = memory.Connection()
+        conn.create_table('test_memory', {'cf': dict()})
+        table = conn.table('test_memory')
+        for row_key in [b'b', b'a', b'ab', b'b\x00', b'c']:
+            table.put(row_key, {'cf:v': row_key, 'cf:w': b'1'})
+
+        # row key 按照字典序排序
+        self.assertEqual([k for k, _ in table.scan()], [b'a', b'ab', b'b', b'b\x00', b'c'])
+        self.assertEqual([k for k, _ in table.scan(row_start = b'ab', row_stop = b'b\x00')], [b'ab', b'b'])
+        self.assertEqual([k for k, _ in table.scan(row_prefix = b'b')], [b'b', b'b\x00'])
+        # reverse 的时候 row_start 是上界（包含），row_stop 是下界（不包含）
+        rows = table.scan(row_start = b'b', row_stop = b'a', reverse = True)
+        self.assertEqual([k for k, _ in rows], [b'b', b'ab'])
+        rows = table.scan(row_start = b'ab', reverse = True)
+        self.assertEqual([k for k, _ in rows], [b'ab', b'a'])
+        with self.assertRaises(TypeError):
+            list(table.scan(row_start = b'a', row_prefix = b'a'))
+
+        self.assertEqual(table.row(b'ab'), {b'cf:v': b'ab', b'cf:w': b'1'})
+        self.assertEqual(table.row(b'ab', columns = ['cf:w']), {b'cf:w': b'1'})
+        self.assertEqual(table.row(b'x'), {})
+        self.assertEqual([k for k, _ in table.rows([b'c', b'x', b'a'])], [b'c', b'a'])
+
+        # filter
+        key_only = FirstKeyOnlyFilter() & KeyOnlyFilter()
+        self.assertEqual(list(table.scan(row_prefix = b'c', filter = str(key_only))), [(b'c', {b'cf:v': b''})])
+        value_filter = SingleColumnValueFilter('cf', 'v', '>=', 'b')
+        self.assertEqual([k for k, _ in table.scan(filter = str(value_filter))], [b'b', b'b\x00', b'c'])
+        rows = table.scan(filter = str(value_filter & KeyOnlyFilter()))
+        self.assertEqual([d for _, d in rows][0], {b'cf:v': b'', b'cf:w': b''})
+        self.assertEqual(len(list(table.scan(filter = str(PageFilter(2))))), 2)
+
+        # batch 在 send 之前不会写入
+        with table.batch(batch_size = 10) as batch:
+            batch.delete(b'a')
+            batch.put(b'd', {'cf:v': b'd'})
+            self.assertEqual(table.row(b'd'), {})
+        self.assertEqual(table.row(b'a'), {})
+        self.assertEqual(table.row(b'd'), {b'cf:v': b'd'})
+        table.delete(b'c', columns = ['cf:w'])
+        self.assertEqual(table.row(b'c'), {b'cf:v': b'c'})
+
+        # counter
+        self.assertEqual(table.counter_get(b'n', 'cf:count'), 0)
+        self.assertEqual(table.counter_inc(b'n', 'cf:count', value = 3), 3)
+        self.assertEqual(table.counter_dec(b'n', 'cf:count'), 2)
+        self.assertEqual(table.row(b'n'), {b'cf:count': (2).to_bytes(8, 'big')})
+
+        conn.delete_table('test_memory')
+        self.assertEqual(b'test_memory' in conn.tables(), False)
+
+    def test_iter_filter(self):
+        ts = self.ts_now
+        for i in range(5):
+            HBaseFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+
+        followings = HBaseFollowing.iter_filter(prefix = (1,), batch_size = 2)
+        # generator，还没有开始 scan
+        self.assertEqual(isinstance(followings, list), False)
+        self.assertEqual([f.to_user_id for f in followings], list(range(5)))
+
+        results = HBaseFollowing.iter_filter(prefix = (1,), reverse = True, limit = 3)
+        self.assertEqual([f.to_user_id for f in results], [4, 3, 2])
+
+        # 提前结束 scan 之后 connection 会被 checkin
+        pool = HBaseClient.get_pool()
+        for following in HBaseFollowing.iter_filter(prefix = (1,), batch_size = 1):
+            self.assertEqual(pool.get_stats()['in_use'], 1)
+            if following.to_user_id == 1:
+                break
+        self.assertEqual(following.to_user_id, 1)
+        self.assertEqual(pool.get_stats()['in_use'], 0)
+
+        # scan 单独占用一个 connection，外层的 with 结束之后也不会被 checkin 给其他线程
+        with HBaseClient.connection() as conn:
+            followings = HBaseFollowing.iter_filter(prefix = (1,))
+            first = next(followings)
+            self.assertEqual(pool.get_stats()['in_use'], 2)
+            instance = HBaseFollowing.get(from_user_id = 1, created_at = first.created_at)
+            self.assertEqual(instance.to_user_id, first.to_user_id)
+        self.assertEqual(pool.get_stats()['in_use'], 1)
+        self.assertEqual(len(list(followings)), 4)
+        self.assertEqual(pool.get_stats()['in_use'], 0)
+
+    def test_filter_columns_and_filter_string(self):
+        ts = self.ts_now
+        for i in range(5):
+            HBaseFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+        HBaseFollowing.create(from_user_id = 2, to_user_id = 3, created_at = ts)
+
+        # column projection
+        results = HBaseFollowing.filter(prefix = (1,), columns = ['to_user_id'])
+        self.assertEqual([f.to_user_id for f in results], list(range(5)))
+        try:
+            HBaseFollowing.filter(prefix = (1,), columns = ['created_at'])
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+        # server side filter
+        results = HBaseFollowing.filter(
+            prefix = (1,),
+            filter_string = HBaseFollowing.column_value_filter('to_user_id', '>=', 3),
+        )
+        self.assertEqual([f.to_user_id for f in results], [3, 4])
+        results = HBaseFollowing.filter(
+            prefix = (1,),
+            filter_string = str(HBaseFollowing.column_value_filter('to_user_id', '=', 2)),
+        )
+        self.assertEqual([f.to_user_id for f in results], [2])
+
+        # key only，只有 row key 里的 field 有值
+        results = HBaseFollowing.filter(prefix = (1,), filter_string = KeyOnlyFilter(), limit = 2)
+        self.assertEqual([f.created_at for f in results], [ts, ts + 1])
+        self.assertEqual(results[0].to_user_id, None)
+
+        self.assertEqual(HBaseFollowing.count(prefix = (1,)), 5)
+        self.assertEqual(HBaseFollowing.count(prefix = (2,)), 1)
+        self.assertEqual(HBaseFollowing.count(prefix = (3,)), 0)
+        self.assertEqual(HBaseFollowing.count(
+            prefix = (1,),
+            filter_string = HBaseFollowing.column_value_filter('to_user_id', '<', 2),
+        ), 2)
+        self.assertEqual(HBaseFollowing.exists(prefix = (2,)), True)
+        self.assertEqual(HBaseFollowing.exists(prefix = (3,)), False)
+
+    def test_filter_string_builder(self):
+        self.assertEqual(str(KeyOnlyFilter()), 'KeyOnlyFilter()')
+        self.assertEqual(
+            str(FirstKeyOnlyFilter() & KeyOnlyFilter()),
+            '(FirstKeyOnlyFilter() AND KeyOnlyFilter())',
+        )
+        self.assertEqual(str(PageFilter(10) | KeyOnlyFilter()), '(PageFilter(10) OR KeyOnlyFilter())')
+        self.assertEqual(
+            str(SingleColumnValueFilter('cf', 'name', '=', "it's")),
+            "SingleColumnValueFilter('cf', 'name', =, 'binary:it''s', true, true)",
+        )
+        self.assertEqual(
+            str(HBaseFollowing.column_value_filter('to_user_id', '!=', 2, filter_if_missing = False)),
+            "SingleColumnValueFilter('cf', 'to_user_id', !=, 'binary:0000000000000002', false, true)",
+        )
+        try:
+            SingleColumnValueFilter('cf', 'name', '==', 1)
+            exception_raised = False
+        except ValueError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_secondary_index(self):
+        ts = self.ts_now
+        # create 的时候没有旧的 row，不会多读一次
+        with mock.patch.object(HBaseFollowing, 'get', side_effect = AssertionError):
+            following = HBaseFollowing.create(from_user_id = 1, to_user_id = 2, created_at = ts)
+            HBaseFollowing.create(from_user_id = 1, to_user_id = 3, created_at = ts + 1)
+
+        instance = HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 2)
+        self.assertEqual(instance.created_at, ts)
+        self.assertEqual(instance.to_user_id, 2)
+        self.assertEqual(HBaseFollowing.get_by_index(to_user_id = 3, from_user_id = 1).created_at, ts + 1)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 2, to_user_id = 1), None)
+        with self.assertRaises(ValueError):
+            HBaseFollowing.get_by_index(from_user_id = 1)
+
+        # 索引的值变了之后，旧的索引会被删掉
+        following.to_user_id = 4
+        following.save()
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 2), None)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 4).created_at, ts)
+        # 从表里读出来的 instance 更新之后也会删掉旧的索引
+        loaded = HBaseFollowing.get(from_user_id = 1, created_at = ts + 1)
+        loaded.to_user_id = 5
+        loaded.save()
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 3), None)
+        loaded.to_user_id = 3
+        loaded.save()
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 5), None)
+
+        # 删除主表的数据的时候索引也会被删掉
+        with HBaseFollowing.batch():
+            HBaseFollowing.delete(from_user_id = 1, created_at = ts)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 4), None)
+        with HBaseFollowing.get_table(HBaseFollowing.get_index_table_name()) as table:
+            self.assertEqual(len(list(table.scan())), 1)
+
+        HBaseFollowing.bulk_create([
+            HBaseFollowing(from_user_id = 5, to_user_id = i, created_at = ts + i)
+            for i in range(3)
+        ])
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 5, to_user_id = 2).created_at, ts + 2)
+
+        # 已经有数据的表可以重新建立索引
+        with HBaseFollowing.get_table(HBaseFollowing.get_index_table_name()) as table:
+            for row_key, _ in table.scan():
+                table.delete(row_key)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 3), None)
+        self.assertEqual(HBaseFollowing.build_indexes(), 4)
+        self.assertEqual(HBaseFollowing.get_by_index(from_user_id = 1, to_user_id = 3).created_at, ts + 1)
+
+    def test_get_many(self):
+        ts = self.ts_now
+        for i in range(5):
+            HBaseFollowing.create(from_user_id = 1, to_user_id = i, created_at = ts + i)
+
+        keys = [
+            {'from_user_id': 1, 'created_at': ts + 3},
+            {'from_user_id': 2, 'created_at': ts},
+            {'from_user_id': 1, 'created_at': ts},
+            {'from_user_id': 1, 'created_at': ts + 4},
+            {'from_user_id': 1, 'created_at': ts + 3},
+        ]
+        # chunk_size = 2 会拆成多次 rpc，结果和一次取完一样
+        for chunk_size in [None, 2]:
+            instances = HBaseFollowing.get_many(keys, chunk_size = chunk_size)
+            self.assertEqual(len(instances), 5)
+            self.assertEqual(instances[0].to_user_id, 3)
+            self.assertEqual(instances[1], None)
+            self.assertEqual(instances[2].to_user_id, 0)
+            self.assertEqual(instances[3].to_user_id, 4)
+            self.assertEqual(instances[4].to_user_id, 3)
+
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+        # 和 get 一样，row key 不完整的话 raise
+        try:
+            HBaseFollowing.get_many([{'from_user_id': 1}])
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_batch(self):
+        ts = self.ts_now
+        with HBaseFollowing.batch():
+            HBaseFollowing.create(from_user_id = 1, to_user_id = 2, created_at = ts)
+            HBaseFollowing.create(from_user_id = 1, to_user_id = 3, created_at = ts + 1)
+            # 还没有发送到 hbase
+            self.assertEqual(HBaseFollowing.get(from_user_id = 1, created_at = ts), None)
+        self.assertEqual(len(HBaseFollowing.filter(prefix = (1,))), 2)
+
+        with HBaseFollowing.batch():
+            HBaseFollowing.delete(from_user_id = 1, created_at = ts)
+        self.assertEqual(HBaseFollowing.get(from_user_id = 1, created_at = ts), None)
+        self.assertEqual(len(HBaseFollowing.filter(prefix = (1,))), 1)
+
+        # with 里出现异常的话，batch 里的数据不会写入
+        try:
+            with HBaseFollowing.batch():
+                HBaseFollowing.create(from_user_id = 1, to_user_id = 4, created_at = ts + 2)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(HBaseFollowing.get(from_user_id = 1, created_at = ts + 2), None)
+
+    def test_bulk_create(self):
+        ts = self.ts_now
+        followings = [
+            HBaseFollowing(from_user_id = 1, to_user_id = i, created_at = ts + i)
+            for i in range(5)
+        ]
+        HBaseFollowing.bulk_create(followings, batch_size = 2, wal = False)
+        results = HBaseFollowing.filter(prefix = (1,))
+        self.assertEqual([f.to_user_id for f in results], list(range(5)))
+
+        # 有一个 instance 不合法的话，所有的 instance 都不会写入
+        try:
+            HBaseFollowing.bulk_create([
+                HBaseFollowing(from_user_id = 2, to_user_id = 1, created_at = ts),
+                HBaseFollowing(from_user_id = 2, created_at = ts + 1),
+            ])
+            exception_raised = False
+        except EmptyColumnError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+        self.assertEqual(HBaseFollowing.filter(prefix = (2,)), [])
+
+    def test_connection_pool(self):
+        pool = HBaseClient.get_pool()
+        stats = pool.get_stats()
+
+        # 同一个线程里嵌套使用同一个 connection，只算一次 checkout
+        with HBaseClient.connection() as conn1:
+            with HBaseClient.connection() as conn2:
+                self.assertIs(conn1, conn2)
+        new_stats = pool.get_stats()
+        self.assertEqual(new_stats['checkouts'], stats['checkouts'] + 1)
+        self.assertEqual(new_stats['in_use'], 0)
+
+        # model 的读写都会通过 pool checkout / checkin
+        ts = self.ts_now
+        HBaseFollower.create(from_user_id = 1, to_user_id = 2, created_at = ts)
+        HBaseFollower.get(to_user_id = 2, created_at = ts)
+        stats = pool.get_stats()
+        self.assertEqual(stats['checkouts'], new_stats['checkouts'] + 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['created'], pool.size)
+
+    def test_connection_pool_reconnect_failure(self):
+        created = []
+
+        class FlakyConnection:
+            # 第一个 connection 可以建立，之后的都失败
+            def __init__(self, **kwargs):
+                if created:
+                    raise socket.error('connection refused')
+                created.append(self)
+                self.transport = self
+
+            def is_open(self):
+                return True
+
+            def close(self):
+                pass
+
+        pool = HBaseConnectionPool(size = 1, connection_class = FlakyConnection)
+        try:
+            with pool.connection():
+                raise TException('broken pipe')
+        except TException:
+            pass
+        # 重连失败的时候已经关掉的 connection 不会被放回 pool，名额让出来了
+        stats = pool.get_stats()
+        self.assertEqual(stats['idle'], 0)
+        self.assertEqual(stats['created'], 0)
+        self.assertEqual(stats['reconnects'], 1)
+
+    def test_connection_pool_timeout(self):
+        pool = HBaseConnectionPool(
+            size = 1,
+            timeout = 0.01,
+            connection_class = import_string(settings.HBASE_BACKEND),
+            host = settings.HBASE_HOST,
+        )
+        checked_out = []
+
+        def checkout_in_other_thread():
+            try:
+                with pool.connection():
+                    pass
+            except NoConnectionsAvailable:
+                checked_out.append(False)
+
+        with pool.connection():
+            thread = threading.Thread(target = checkout_in_other_thread)
+            thread.start()
+            thread.join()
+        self.assertEqual(checked_out, [False])
+        stats = pool.get_stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checkouts'], 1)
@@ -26,4 +26,24 @@ class GateKeeper(object):
 
     @classmethod
     def in_gk(cls, gk_name, user_id):
-        return user_id % 100 < cls.get(gk_name)['percent']
\ No newline at end of file
+        return user_id % 100 < cls.get(gk_name)['percent']
+
+    @classmethod
+    def get_members_key(cls, gk_name):
+        return f'gatekeeper:{gk_name}:members'
+
+    @classmethod
+    def add_member(cls, gk_name, user_id):
+        # 除了按照百分比，也可以把指定的 user 加到 gatekeeper 的名单里
+        conn = RedisClient.get_connection()
+        conn.sadd(cls.get_members_key(gk_name), user_id)
+
+    @classmethod
+    def remove_member(cls, gk_name, user_id):
+        conn = RedisClient.get_connection()
+        conn.srem(cls.get_members_key(gk_name), user_id)
+
+    @classmethod
+    def is_member(cls, gk_name, user_id):
+        conn = RedisClient.get_connection()
+        return bool(conn.sismember(cls.get_members_key(gk_name), user_id))
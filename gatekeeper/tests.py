@@ -19,3 +19,11 @@ class GateKeeperTests(TestCase):
         GateKeeper.set_kv('gk_name', 'percent', 100)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
         self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+
+    def test_members(self):
+        self.assertEqual(GateKeeper.is_member('gk_name', 1), False)
+        GateKeeper.add_member('gk_name', 1)
+        self.assertEqual(GateKeeper.is_member('gk_name', 1), True)
+        self.assertEqual(GateKeeper.is_member('gk_name', 2), False)
+        GateKeeper.remove_member('gk_name', 1)
+        self.assertEqual(GateKeeper.is_member('gk_name', 1), False)
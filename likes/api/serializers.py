@@ -5,6 +5,8 @@ from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from accounts.services import UserService
+from utils.serializers import PrefetchListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -12,8 +14,12 @@ class LikeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Like
+        list_serializer_class = PrefetchListSerializer
         fields = ('user', 'created_at')
 
+    def prefetch(self, likes):
+        UserService.get_users_through_cache([like.user_id for like in likes])
+
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
     content_type = serializers.ChoiceField(choices=['comment', 'tweet'])
@@ -1,6 +1,9 @@
 from rest_framework import serializers
 from newsfeeds.models import NewsFeed
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
@@ -8,4 +11,13 @@ class NewsFeedSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = NewsFeed
-        fields = ('id', 'created_at', 'tweet')
\ No newline at end of file
+        list_serializer_class = PrefetchListSerializer
+        # pull 模式的 author 的 tweet 没有 newsfeed，id 是负的 tweet id
+        fields = ('id', 'created_at', 'tweet')
+
+    def prefetch(self, newsfeeds):
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds if newsfeed.tweet_id is not None],
+        )
+        self.fields['tweet'].prefetch(tweets)
\ No newline at end of file
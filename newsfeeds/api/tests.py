@@ -4,6 +4,8 @@ from utils.paginations import EndlessPagination
 from django.conf import settings
 from newsfeeds.services import NewsFeedService
 from newsfeeds.models import NewsFeed
+from newsfeeds.constants import PULL_FANOUT_GATEKEEPER
+from gatekeeper.models import GateKeeper
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
@@ -201,3 +203,49 @@ class NewsFeedApiTests(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    def test_hybrid_fanout(self):
+        page_size = EndlessPagination.page_size
+        followed_user = self.create_user('followed')
+        self.create_friendship(self.rui, followed_user)
+        self.create_friendship(self.rui, self.ming)
+        # ming 使用 pull 模式，发的 tweet 不会 fanout
+        GateKeeper.add_member(PULL_FANOUT_GATEKEEPER, self.ming.id)
+
+        tweet_ids = []
+        for i in range(page_size):
+            tweet = self.create_tweet(followed_user)
+            self.create_newsfeed(self.rui, tweet)
+            tweet_ids.append(tweet.id)
+            tweet = self.create_tweet(self.ming)
+            NewsFeedService.fanout_to_followers(tweet)
+            tweet_ids.append(tweet.id)
+        tweet_ids = tweet_ids[::-1]
+        self.assertEqual(NewsFeed.objects.filter(user = self.rui, tweet__user = self.ming).count(), 0)
+        self.assertEqual(NewsFeed.objects.filter(user = self.ming).count(), page_size)
+
+        # push 和 pull 的 newsfeeds 按照 created_at 合并，翻页的时候 cursor 在两个来源上都正确
+        response = self.rui_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(len(response.data['results']), page_size)
+        results = self._paginate_to_get_newsfeeds(self.rui_client)
+        self.assertEqual([r['tweet']['id'] for r in results], tweet_ids)
+        # pull 来的 tweet 没有 newsfeed，id 是负的 tweet id
+        self.assertEqual(results[0]['tweet']['user']['id'], self.ming.id)
+        self.assertEqual(results[0]['id'], -results[0]['tweet']['id'])
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.rui.id)
+        self.assertEqual([f.tweet_id for f in cached_newsfeeds], tweet_ids)
+
+        # 上翻页也可以看到新的 pull 的 tweet
+        tweet = self.create_tweet(self.ming)
+        NewsFeedService.fanout_to_followers(tweet)
+        response = self.rui_client.get(
+            NEWSFEEDS_URL,
+            {'created_at__gt': results[0]['created_at']},
+        )
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], [tweet.id])
+
+        # 成为 pull 模式之前已经 fanout 过的 tweet 不会重复出现
+        self.create_newsfeed(self.rui, tweet)
+        results = self._paginate_to_get_newsfeeds(self.rui_client)
+        self.assertEqual([r['tweet']['id'] for r in results], [tweet.id] + tweet_ids)
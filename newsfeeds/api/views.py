@@ -7,6 +7,8 @@ from newsfeeds.models import NewsFeed
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
+import functools
+
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
@@ -21,8 +23,10 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        page = self.paginator.paginate_cached_timeline(
+            functools.partial(NewsFeedService.get_cached_newsfeeds_page, request.user.id),
+            request,
+        )
         # page是None代表现在请求的数据不在cache里，需要去db中获取
         if page is None:
             queryset = NewsFeed.objects.filter(user=request.user)
@@ -1,3 +1,28 @@
 from django.conf import settings
+from utils.time_constants import ONE_HOUR
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# follower 数量超过这个值的 author 发 tweet 的时候不 fanout
+# 由 followers 读取 newsfeeds 的时候从 author 的 tweets 里 pull
+PULL_FANOUT_FOLLOWERS_THRESHOLD = 10000 if not settings.TESTING else 10
+# 在这个 gatekeeper 名单里的 author 不论 follower 数量都使用 pull 模式
+PULL_FANOUT_GATEKEEPER = 'newsfeeds_pull_fanout'
+
+# 超过这么多天没有访问过的 follower 不 fanout，回来之后第一次读取 newsfeeds 的时候重建
+FANOUT_INACTIVE_DAYS = 30
+
+# fanout 的 batches 按照 author 的类型分到不同的 lane，每个 lane 是一个单独的 celery queue
+# 大 V 的 fanout 再多也不会让普通用户的 fanout 排在后面
+FANOUT_LANE_SMALL = 'newsfeeds_small'
+FANOUT_LANE_LARGE = 'newsfeeds_large'
+# 重新 fanout 以前的 tweets，不着急，优先级最低
+FANOUT_LANE_BACKFILL = 'newsfeeds_backfill'
+FANOUT_LANES = (FANOUT_LANE_SMALL, FANOUT_LANE_LARGE, FANOUT_LANE_BACKFILL)
+# follower 数量超过这个值的 author 使用 large lane
+LARGE_AUTHOR_FOLLOWERS_THRESHOLD = 1000 if not settings.TESTING else 5
+# 执行一个 batch 的 lane task 最多运行这么久，超时会被 celery kill
+FANOUT_LANE_TASK_TIME_LIMIT = ONE_HOUR
+# 取出来的 batch 超过这么久没有 ack，说明 worker 挂掉了或者被 kill 了，放回队列重新执行
+# 比 task 的 time limit 长，不会把还在执行的 batch 放回去
+FANOUT_BATCH_ACK_TIMEOUT = FANOUT_LANE_TASK_TIME_LIMIT + 10 * 60
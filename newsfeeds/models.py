@@ -23,6 +23,9 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # 从 redis timeline hydrate 出来的 newsfeed 已经批量读取过 tweet 了
+        if NewsFeed.tweet.is_cached(self):
+            return self.tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
-post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
+post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
@@ -1,7 +1,41 @@
 from newsfeeds.models import NewsFeed
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from newsfeeds.constants import (
+    FANOUT_BATCH_ACK_TIMEOUT,
+    FANOUT_INACTIVE_DAYS,
+    FANOUT_LANE_BACKFILL,
+    FANOUT_LANE_LARGE,
+    FANOUT_LANE_SMALL,
+    FANOUT_LANES,
+    LARGE_AUTHOR_FOLLOWERS_THRESHOLD,
+    PULL_FANOUT_FOLLOWERS_THRESHOLD,
+    PULL_FANOUT_GATEKEEPER,
+)
+from accounts.services import UserService
+from tweets.models import Tweet
+from tweets.services import TweetService
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_serializers import TimelineEntry
+from twitter.cache import (
+    USER_NEWSFEEDS_PATTERN,
+    NEWSFEED_PULL_AUTHORS_KEY,
+    NEWSFEED_PULL_FOLLOWINGS_PATTERN,
+    NEWSFEED_REBUILD_USERS_KEY,
+    NEWSFEED_FANOUT_QUEUE_PATTERN,
+    NEWSFEED_FANOUT_LATENCY_PATTERN,
+)
 from utils.redis_helper import RedisHelper
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import fanout_newsfeeds_main_task, fanout_newsfeeds_lane_task
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from utils.time_constants import ONE_DAY
+
+import heapq
+import json
+import time
 
 class NewsFeedService(object):
 
@@ -17,18 +51,382 @@ class NewsFeedService(object):
         # 的进程，甚至在不同的机器上，没有办法知道当前 web 进程的某片内存空间里的值是什么。所以
         # 我们只能把 tweet.id 作为参数传进去，而不能把 tweet 传进去。因为 celery 并不知道
         # 如何 serialize Tweet。
-        fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
+        # enqueued_at 用于统计从发 tweet 到 fanout 完成的延迟
+        fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id, enqueued_at = time.time())
+
+    @classmethod
+    def backfill_fanout(cls, tweet):
+        # 重新 fanout 以前的 tweet，已经存在的 newsfeeds 会被忽略，使用优先级最低的 lane
+        fanout_newsfeeds_main_task.delay(
+            tweet.id,
+            tweet.user_id,
+            enqueued_at = time.time(),
+            backfill = True,
+        )
+
+    @classmethod
+    def get_fanout_lane(cls, user_id, follower_count = None, backfill = False):
+        # 调用的地方已经读过 follower_count 的话直接传进来，不再重复读取
+        if backfill:
+            return FANOUT_LANE_BACKFILL
+        if follower_count is None:
+            follower_count = FriendshipService.get_follower_count(user_id)
+        if follower_count >= LARGE_AUTHOR_FOLLOWERS_THRESHOLD:
+            return FANOUT_LANE_LARGE
+        return FANOUT_LANE_SMALL
+
+    @classmethod
+    def push_fanout_batch(cls, lane, tweet_user_id, tweet_id, follower_ids, enqueued_at):
+        # 同一个 lane 里按照 author 轮流执行，大 V 的几千个 batches 不会挡住其他 author
+        batch = json.dumps({
+            'tweet_id': tweet_id,
+            'follower_ids': follower_ids,
+            'enqueued_at': enqueued_at,
+        })
+        key = NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane)
+        return RedisHelper.push_fair_queue(key, tweet_user_id, batch)
+
+    @classmethod
+    def pop_fanout_batch(cls, lane):
+        # 返回 (job_id, batch)，执行完之后需要 ack_fanout_batch，否则超时之后会被放回队列
+        key = NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane)
+        popped = RedisHelper.pop_fair_queue(key, FANOUT_BATCH_ACK_TIMEOUT)
+        if popped is None:
+            return None
+        job_id, batch = popped
+        return job_id, json.loads(batch)
+
+    @classmethod
+    def ack_fanout_batch(cls, lane, job_id):
+        key = NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane)
+        return RedisHelper.ack_fair_queue(key, job_id)
+
+    @classmethod
+    def requeue_expired_fanout_batches(cls, lane):
+        # 没有 ack 的 batches 放回队列，每个 batch 再发一个 lane task，返回放回去的个数
+        key = NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane)
+        requeued = RedisHelper.requeue_fair_queue(key)
+        for _ in range(requeued):
+            fanout_newsfeeds_lane_task.apply_async(args = [lane], queue = lane, routing_key = lane)
+        return requeued
+
+    @classmethod
+    def record_fanout_latency(cls, lane, seconds):
+        key = NEWSFEED_FANOUT_LATENCY_PATTERN.format(lane = lane)
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.hincrby(key, 'batches', 1)
+        pipe.hincrbyfloat(key, 'total_seconds', seconds)
+        pipe.hset(key, 'last_seconds', seconds)
+        pipe.execute()
+
+    @classmethod
+    def get_fanout_lane_stats(cls):
+        """
+        每个 lane 的 depth（等待执行的 batches）、inflight（正在执行还没有 ack 的 batches）
+        和从发 tweet 到 batch 执行完的延迟
+        lane -> {'depth': x, 'inflight': v, 'batches': y, 'avg_seconds': z, 'last_seconds': w}
+        """
+        conn = RedisClient.get_connection()
+        stats = {}
+        for lane in FANOUT_LANES:
+            latency = conn.hgetall(NEWSFEED_FANOUT_LATENCY_PATTERN.format(lane = lane))
+            batches = int(latency.get(b'batches', 0))
+            total_seconds = float(latency.get(b'total_seconds', 0))
+            stats[lane] = {
+                'depth': RedisHelper.get_fair_queue_depth(
+                    NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane),
+                ),
+                'inflight': RedisHelper.get_fair_queue_inflight(
+                    NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = lane),
+                ),
+                'batches': batches,
+                'avg_seconds': total_seconds / batches if batches else 0,
+                'last_seconds': float(latency.get(b'last_seconds', 0)),
+            }
+        return stats
+
+    @classmethod
+    def is_pull_author(cls, user_id, follower_count = None):
+        # follower 太多的 author 不 fanout，followers 读取的时候再 pull
+        if GateKeeper.is_member(PULL_FANOUT_GATEKEEPER, user_id):
+            return True
+        if follower_count is None:
+            follower_count = FriendshipService.get_follower_count(user_id)
+        return follower_count >= PULL_FANOUT_FOLLOWERS_THRESHOLD
+
+    @classmethod
+    def add_pull_author(cls, user_id):
+        # 不会从 set 里删除，否则这个 author 之前没有 fanout 的 tweets 就看不到了
+        # 之后重新 fanout 的 tweets 和 pull 的 tweets 在 merge 的时候会去重
+        conn = RedisClient.get_connection()
+        if conn.sadd(NEWSFEED_PULL_AUTHORS_KEY, user_id):
+            # 第一次成为 pull 模式，加到所有 followers 的 pull followings 里
+            # 先加入 pull authors 再读取 followers，这期间 follow 的 user 在 follow 的时候会加上
+            cls.add_pull_followings(user_id)
+
+    @classmethod
+    def add_pull_followings(cls, author_id):
+        conn = RedisClient.get_connection()
+        for follower_ids in FriendshipService.iter_follower_id_batches(author_id):
+            pipe = conn.pipeline(transaction = False)
+            for follower_id in follower_ids:
+                pipe.sadd(NEWSFEED_PULL_FOLLOWINGS_PATTERN.format(user_id = follower_id), author_id)
+            pipe.execute()
+
+    @classmethod
+    def rebuild_pull_followings(cls):
+        """
+        重新生成所有 followers 的 pull followings，返回 pull authors 的个数
+        有 pull followings 之前就已经是 pull 模式的 authors，上线的时候在 shell 里执行一次
+        """
+        author_ids = cls.get_all_pull_author_ids()
+        for author_id in author_ids:
+            cls.add_pull_followings(author_id)
+        return len(author_ids)
+
+    @classmethod
+    def on_follow(cls, from_user_id, to_user_id):
+        # follow / unfollow 的时候由 FriendshipService 调用，维护 from_user_id 的 pull followings
+        conn = RedisClient.get_connection()
+        if conn.sismember(NEWSFEED_PULL_AUTHORS_KEY, to_user_id):
+            conn.sadd(NEWSFEED_PULL_FOLLOWINGS_PATTERN.format(user_id = from_user_id), to_user_id)
+
+    @classmethod
+    def on_unfollow(cls, from_user_id, to_user_id):
+        conn = RedisClient.get_connection()
+        conn.srem(NEWSFEED_PULL_FOLLOWINGS_PATTERN.format(user_id = from_user_id), to_user_id)
+
+    @classmethod
+    def get_all_pull_author_ids(cls):
+        conn = RedisClient.get_connection()
+        return {int(author_id) for author_id in conn.smembers(NEWSFEED_PULL_AUTHORS_KEY)}
+
+    @classmethod
+    def get_pull_author_ids(cls, user_id):
+        # user 关注的 pull 模式的 authors，一次 smembers，和 user 关注了多少人无关
+        conn = RedisClient.get_connection()
+        key = NEWSFEED_PULL_FOLLOWINGS_PATTERN.format(user_id = user_id)
+        return sorted(int(author_id) for author_id in conn.smembers(key))
+
+    @classmethod
+    def split_inactive_followers(cls, follower_ids):
+        """
+        返回 (active_ids, inactive_ids)，超过 FANOUT_INACTIVE_DAYS 没有访问过的 follower 是 inactive
+        没有访问记录的 follower（比如上线之前注册的用户）当作 active 处理
+        """
+        deadline = time.time() - FANOUT_INACTIVE_DAYS * ONE_DAY
+        last_seen = UserService.get_last_seen_many(follower_ids)
+        active_ids, inactive_ids = [], []
+        for follower_id in follower_ids:
+            seen_at = last_seen.get(follower_id)
+            if seen_at is not None and seen_at < deadline:
+                inactive_ids.append(follower_id)
+            else:
+                active_ids.append(follower_id)
+        return active_ids, inactive_ids
+
+    @classmethod
+    def mark_for_rebuild(cls, user_ids):
+        # 跳过 fanout 的 users 回来之后第一次读取 newsfeeds 的时候重建
+        if not user_ids:
+            return
+        conn = RedisClient.get_connection()
+        conn.sadd(NEWSFEED_REBUILD_USERS_KEY, *user_ids)
+
+    @classmethod
+    def rebuild_newsfeeds_if_needed(cls, user_id):
+        # srem 是原子的，同一个 user 同时有多个请求的时候只会重建一次
+        conn = RedisClient.get_connection()
+        if not conn.srem(NEWSFEED_REBUILD_USERS_KEY, user_id):
+            return False
+        cls.rebuild_newsfeeds(user_id)
+        return True
+
+    @classmethod
+    def rebuild_newsfeeds(cls, user_id):
+        """
+        用关注的人最近的 tweets 补上不活跃期间没有 fanout 的 newsfeeds
+        只补 cache 能放下的数量，更早的 newsfeeds 不补
+        """
+        following_user_ids = FriendshipService.get_following_user_id_set(user_id)
+        # pull 模式的 authors 的 tweets 读取的时候再 pull，不写 newsfeeds
+        following_user_ids -= set(cls.get_pull_author_ids(user_id))
+        if not following_user_ids:
+            return
+        tweet_ids = list(
+            Tweet.objects.filter(user_id__in = following_user_ids)
+            .order_by('-created_at')
+            .values_list('id', flat = True)[:settings.REDIS_LIST_LENGTH_LIMIT]
+        )
+        rebuild_started_at = timezone.now()
+        # 已经 fanout 过的 newsfeed 会因为 (user, tweet) 的 unique index 被忽略
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id = user_id, tweet_id = tweet_id) for tweet_id in tweet_ids],
+            ignore_conflicts = True,
+        )
+        # created_at 是 auto_now_add，bulk_create 的时候会被设置成现在
+        # 改成 tweet 的创建时间，否则补上的 newsfeeds 会排在最前面
+        NewsFeed.objects.filter(
+            user_id = user_id,
+            tweet_id__in = tweet_ids,
+            created_at__gte = rebuild_started_at,
+        ).update(
+            created_at = Subquery(
+                Tweet.objects.filter(id = OuterRef('tweet_id')).values('created_at')[:1]
+            ),
+        )
+        # bulk_create 不会触发 post_save，cache 里的 timeline 直接删除，下次读取的时候重新 load
+        conn = RedisClient.get_connection()
+        conn.delete(USER_NEWSFEEDS_PATTERN.format(user_id = user_id))
+
+    @classmethod
+    def merge_timelines(cls, timelines):
+        """
+        每个 timeline 都是按照 created_at 倒序排列的 TimelineEntry，用 heap merge 合并
+        author 成为 pull 模式之前的 tweets 已经 fanout 过，同一个 tweet 只保留一个
+        """
+        merged = []
+        seen_tweet_ids = set()
+        for entry in heapq.merge(*timelines, key = lambda entry: entry.created_at, reverse = True):
+            if entry.tweet_id is not None:
+                if entry.tweet_id in seen_tweet_ids:
+                    continue
+                seen_tweet_ids.add(entry.tweet_id)
+            merged.append(entry)
+        return merged
+
+    @classmethod
+    def get_pulled_entries(cls, tweet_entries):
+        # pull 来的 tweets 没有对应的 NewsFeed，id 用负的 tweet id
+        # 同一个 tweet 每次读取都是同一个 id，也不会和真正的 newsfeed id 重复
+        return [entry._replace(id = -entry.tweet_id) for entry in tweet_entries]
 
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
+        cls.rebuild_newsfeeds_if_needed(user_id)
         # QuerySet is Lazy loading
         queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        entries = RedisHelper.load_timeline(key, queryset, tweet_id_attr = 'tweet_id')
+
+        pull_author_ids = cls.get_pull_author_ids(user_id)
+        if pull_author_ids:
+            timelines = [entries] + [
+                cls.get_pulled_entries(TweetService.get_cached_tweet_entries(author_id))
+                for author_id in pull_author_ids
+            ]
+            entries = cls.merge_timelines(timelines)[:settings.REDIS_LIST_LENGTH_LIMIT]
+        return cls.hydrate_newsfeeds(user_id, entries)
+
+    @classmethod
+    def query_timeline_page(
+            cls,
+            queryset,
+            page_size,
+            tweet_id_attr,
+            created_at__lt = None,
+            created_at__gt = None):
+        # cache 里的数据不全的时候，和 EndlessPagination.paginate_queryset 一样从数据库读取一页
+        if created_at__gt is not None:
+            queryset = queryset.filter(created_at__gt = created_at__gt)
+        elif created_at__lt is not None:
+            queryset = queryset.filter(created_at__lt = created_at__lt)
+        rows = queryset.order_by('-created_at').values_list('id', tweet_id_attr, 'created_at')
+        if created_at__gt is not None:
+            return [TimelineEntry(*row) for row in rows], False
+        entries = [TimelineEntry(*row) for row in rows[:page_size + 1]]
+        return entries[:page_size], len(entries) > page_size
+
+    @classmethod
+    def get_cached_newsfeeds_page(
+            cls,
+            user_id,
+            page_size,
+            created_at__lt = None,
+            created_at__gt = None):
+        # 只从 redis 里读取一页，返回 (newsfeeds, has_next_page)
+        # newsfeeds 是 None 说明 cache 里的数据不全，需要去数据库查询
+        cls.rebuild_newsfeeds_if_needed(user_id)
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        entries, has_next_page = RedisHelper.load_timeline_page(
+            key,
+            queryset,
+            page_size,
+            tweet_id_attr = 'tweet_id',
+            created_at__lt = created_at__lt,
+            created_at__gt = created_at__gt,
+        )
+        pull_author_ids = cls.get_pull_author_ids(user_id)
+        if not pull_author_ids:
+            if entries is None:
+                return None, False
+            return cls.hydrate_newsfeeds(user_id, entries), has_next_page
+
+        # 每个来源都用同一个 cursor 取一页，合并之后再取前 page_size 个
+        # 每个来源都至少取了 page_size 个或者取完了，所以合并之后的这一页是正确的
+        cursor = {'created_at__lt': created_at__lt, 'created_at__gt': created_at__gt}
+        if entries is None:
+            entries, has_next_page = cls.query_timeline_page(queryset, page_size, 'tweet_id', **cursor)
+        timelines = [entries]
+        for author_id in pull_author_ids:
+            tweet_entries, has_more = TweetService.get_cached_tweet_entries_page(
+                author_id,
+                page_size,
+                **cursor,
+            )
+            if tweet_entries is None:
+                tweet_entries, has_more = cls.query_timeline_page(
+                    Tweet.objects.filter(user_id = author_id),
+                    page_size,
+                    'id',
+                    **cursor,
+                )
+            timelines.append(cls.get_pulled_entries(tweet_entries))
+            has_next_page = has_next_page or has_more
+
+        entries = cls.merge_timelines(timelines)
+        if created_at__gt is not None:
+            return cls.hydrate_newsfeeds(user_id, entries), False
+        has_next_page = has_next_page or len(entries) > page_size
+        return cls.hydrate_newsfeeds(user_id, entries[:page_size]), has_next_page
+
+    @classmethod
+    def hydrate_newsfeeds(cls, user_id, entries):
+        # 所有 newsfeed 的 tweet 用一次 memcached get_many 读取，miss 的用一次 id__in 查询
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [entry.tweet_id for entry in entries if entry.tweet_id is not None],
+        )
+        tweet_map = {tweet.id: tweet for tweet in tweets}
+        newsfeeds = []
+        for entry in entries:
+            newsfeed = NewsFeed(
+                id = entry.id,
+                user_id = user_id,
+                tweet_id = entry.tweet_id,
+                created_at = entry.created_at,
+            )
+            if entry.tweet_id in tweet_map:
+                newsfeed.tweet = tweet_map[entry.tweet_id]
+            newsfeeds.append(newsfeed)
+        return newsfeeds
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         # QuerySet is Lazy loading
         queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        RedisHelper.push_timeline_entry(key, newsfeed, queryset, tweet_id_attr = 'tweet_id')
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # fanout 的时候一次推送一批 newsfeeds，冷的 key 跳过，返回推送成功的个数
+        return RedisHelper.push_timeline_entries(
+            [
+                (USER_NEWSFEEDS_PATTERN.format(user_id = newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ],
+            tweet_id_attr = 'tweet_id',
+        )
@@ -2,7 +2,9 @@ from celery import shared_task
 from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
 from utils.time_constants import ONE_HOUR
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import FANOUT_BATCH_SIZE, FANOUT_LANES, FANOUT_LANE_TASK_TIME_LIMIT
+
+import time
 
 
 @shared_task(routing_key = 'newsfeeds', time_limit = ONE_HOUR)
@@ -18,32 +20,111 @@ def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
     #         tweet_id = tweet_id,
     #     )
 
+    # 很久没有访问的 followers 不写数据库也不推 cache，回来之后第一次读取的时候重建
+    total = len(follower_ids)
+    follower_ids, inactive_ids = NewsFeedService.split_inactive_followers(follower_ids)
+    NewsFeedService.mark_for_rebuild(inactive_ids)
+
     # 正确的方法
     newsfeeds = [
         NewsFeed(user_id = follower_id, tweet_id = tweet_id)
         for follower_id in follower_ids
     ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    start = time.perf_counter()
+    # backfill 或者重试的时候 newsfeed 可能已经存在，用 (user, tweet) 的 unique index 忽略掉
+    NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts = True)
+    # MySQL 的 bulk_create 不会给 objects 设置 id，用 (user, tweet) 的 unique index 一次查回来
+    newsfeeds = list(NewsFeed.objects.filter(tweet_id = tweet_id, user_id__in = follower_ids))
+    db_seconds = time.perf_counter() - start
 
     # bulk_create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
-    return '{} newsfeeds created'.format(len(newsfeeds))
+    # 一个 lua script 推送整个 batch，cache 里没有的 follower 跳过，读取的时候再从数据库 load
+    start = time.perf_counter()
+    pushed = NewsFeedService.push_newsfeeds_to_cache(newsfeeds)
+    cache_seconds = time.perf_counter() - start
+    return (
+        '{} newsfeeds created, {} pushed to cache, {} cold keys skipped, '
+        '{} inactive followers skipped ({:.1%}), db {:.3f}s, cache {:.3f}s'
+    ).format(
+        len(newsfeeds),
+        pushed,
+        len(newsfeeds) - pushed,
+        len(inactive_ids),
+        len(inactive_ids) / total if total else 0,
+        db_seconds,
+        cache_seconds,
+    )
+
+
+@shared_task(time_limit = FANOUT_LANE_TASK_TIME_LIMIT)
+def fanout_newsfeeds_lane_task(lane):
+    """
+    每个 lane 一个 celery queue，这个 task 被发到哪个 lane 的 queue 就从哪个 lane 取 batch
+    取到的不一定是创建这个 task 的 author 的 batch，而是在这个 lane 的所有 authors 之间轮流取
+    batch 执行完之后才 ack，中途挂掉的话由 requeue_fanout_batches_task 放回队列重新执行
+    """
+    from newsfeeds.services import NewsFeedService
+
+    popped = NewsFeedService.pop_fanout_batch(lane)
+    if popped is None:
+        return 'no batch in {}.'.format(lane)
+    job_id, batch = popped
+    msg = fanout_newsfeeds_batch_task(batch['tweet_id'], batch['follower_ids'])
+    NewsFeedService.ack_fanout_batch(lane, job_id)
+    NewsFeedService.record_fanout_latency(lane, time.time() - batch['enqueued_at'])
+    return msg
 
 
 @shared_task(routing_key = 'default', time_limit = ONE_HOUR)
-def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
+def requeue_fanout_batches_task():
+    # 由 celery beat 定时执行，见 settings.CELERY_BEAT_SCHEDULE
+    from newsfeeds.services import NewsFeedService
+
+    requeued = {
+        lane: NewsFeedService.requeue_expired_fanout_batches(lane)
+        for lane in FANOUT_LANES
+    }
+    return '{} expired batches requeued.'.format(sum(requeued.values()))
+
+
+@shared_task(routing_key = 'default', time_limit = ONE_HOUR)
+def fanout_newsfeeds_main_task(tweet_id, tweet_user_id, enqueued_at = None, backfill = False):
+    from newsfeeds.services import NewsFeedService
+
+    if enqueued_at is None:
+        enqueued_at = time.time()
+
     # 将推给自己的 newsfeeds 率先创建，确保自己能最快看见
-    NewsFeed.objects.create(user_id = tweet_user_id, tweet_id = tweet_id)
-
-    # 获得所有的follower ids，按照 batch size 拆开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index:index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # backfill 的 tweet 之前已经创建过了
+    if not backfill:
+        NewsFeed.objects.create(user_id = tweet_user_id, tweet_id = tweet_id)
+
+    # follower 数量只读一次，pull mode 和 lane 的判断都用它
+    follower_count = FriendshipService.get_follower_count(tweet_user_id)
+
+    # follower 太多的 author 不 fanout，followers 读取 newsfeeds 的时候再 pull
+    if NewsFeedService.is_pull_author(tweet_user_id, follower_count = follower_count):
+        NewsFeedService.add_pull_author(tweet_user_id)
+        return 'pull mode, 0 newsfeeds going to fanout.'
+
+    # 一批一批地读取 follower ids，读到一批就放进对应 lane 的队列里
+    # 不把所有 followers 读到内存里，worker 的内存和 follower 的数量无关
+    lane = NewsFeedService.get_fanout_lane(
+        tweet_user_id,
+        follower_count = follower_count,
+        backfill = backfill,
+    )
+    followers_count, batches_count = 0, 0
+    for batch_ids in FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        batch_size = FANOUT_BATCH_SIZE,
+    ):
+        NewsFeedService.push_fanout_batch(lane, tweet_user_id, tweet_id, batch_ids, enqueued_at)
+        # 每个 batch 对应 lane 的 queue 里的一个 task，worker 执行的时候再决定执行哪个 author 的 batch
+        fanout_newsfeeds_lane_task.apply_async(args = [lane], queue = lane, routing_key = lane)
+        followers_count += len(batch_ids)
+        batches_count += 1
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
-    )
\ No newline at end of file
+        followers_count,
+        batches_count,
+    )
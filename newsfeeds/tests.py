@@ -1,9 +1,29 @@
 from newsfeeds.services import NewsFeedService
 from testing.testcases import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import (
+    USER_NEWSFEEDS_PATTERN,
+    USER_LAST_SEEN_KEY,
+    NEWSFEED_REBUILD_USERS_KEY,
+    NEWSFEED_FANOUT_QUEUE_PATTERN,
+    NEWSFEED_PULL_FOLLOWINGS_PATTERN,
+)
+from utils.time_constants import ONE_DAY
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 from newsfeeds.models import NewsFeed
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import (
+    fanout_newsfeeds_main_task,
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_lane_task,
+    requeue_fanout_batches_task,
+)
+from newsfeeds.constants import FANOUT_LANE_SMALL, FANOUT_LANE_LARGE, FANOUT_LANE_BACKFILL
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from unittest import mock
+
+import time
 
 
 class NewsFeedServiceTests(TestCase):
@@ -50,6 +70,65 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.rui.id)
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
 
+    def test_newsfeed_timeline_hydration(self):
+        tweets = [self.create_tweet(self.ming) for i in range(3)]
+        feeds = [self.create_newsfeed(self.rui, tweet) for tweet in tweets]
+        self.clear_cache()
+
+        # redis 里不存 tweet 的内容，所有 tweet 用一次 id__in 查询读取
+        with self.assertNumQueries(2):
+            cached_list = NewsFeedService.get_cached_newsfeeds(self.rui.id)
+        with self.assertNumQueries(0):
+            cached_list = NewsFeedService.get_cached_newsfeeds(self.rui.id)
+            self.assertEqual(
+                [(f.id, f.user_id, f.created_at) for f in cached_list],
+                [(f.id, f.user_id, f.created_at) for f in feeds[::-1]],
+            )
+            self.assertEqual(
+                [f.cached_tweet.content for f in cached_list],
+                [t.content for t in tweets[::-1]],
+            )
+
+    def test_pull_author_read_cost(self):
+        lily = self.create_user('lily')
+        self.create_friendship(lily, self.ming)
+        # 成为 pull 模式的时候加到已有 followers 的 pull followings 里
+        NewsFeedService.add_pull_author(self.ming.id)
+        # 成为 pull 模式之后 follow 的时候加上
+        self.create_friendship(self.rui, self.ming)
+        for i in range(5):
+            self.create_friendship(self.rui, self.create_user('user{}'.format(i)))
+
+        # 读取的时候不检查关注关系，和 rui 关注了多少人无关
+        with self.assertNumQueries(0), mock.patch.object(
+            FriendshipService,
+            'get_following_user_id_set',
+            side_effect = AssertionError,
+        ), mock.patch.object(FriendshipService, 'has_followed', side_effect = AssertionError):
+            self.assertEqual(NewsFeedService.get_pull_author_ids(self.rui.id), [self.ming.id])
+            self.assertEqual(NewsFeedService.get_pull_author_ids(lily.id), [self.ming.id])
+            self.assertEqual(NewsFeedService.get_pull_author_ids(self.ming.id), [])
+
+        FriendshipService.unfollow(self.rui.id, self.ming.id)
+        self.assertEqual(NewsFeedService.get_pull_author_ids(self.rui.id), [])
+        self.assertEqual(NewsFeedService.get_pull_author_ids(lily.id), [self.ming.id])
+
+        # mysql 里的关注关系也一样维护
+        GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 0)
+        FriendshipService.follow(self.rui.id, self.ming.id)
+        self.assertEqual(NewsFeedService.get_pull_author_ids(self.rui.id), [self.ming.id])
+        FriendshipService.unfollow(self.rui.id, self.ming.id)
+        self.assertEqual(NewsFeedService.get_pull_author_ids(self.rui.id), [])
+
+        # pull followings 丢失之后可以重新生成
+        RedisClient.get_connection().delete(
+            NEWSFEED_PULL_FOLLOWINGS_PATTERN.format(user_id = lily.id),
+        )
+        GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 100)
+        self.assertEqual(NewsFeedService.rebuild_pull_followings(), 1)
+        self.assertEqual(NewsFeedService.get_pull_author_ids(lily.id), [self.ming.id])
+
+
 class NewsFeedTaskTests(TestCase):
 
     def setUp(self):
@@ -85,4 +164,173 @@ class NewsFeedTaskTests(TestCase):
         cached_list = NewsFeedService.get_cached_newsfeeds(self.rui.id)
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.ming.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_batch_task(self):
+        tweet = self.create_tweet(self.rui, 'tweet 1')
+        self.create_newsfeed(self.ming, tweet)
+        # ming 的 newsfeeds 在 cache 里，lily 的不在
+        lily = self.create_user('lily')
+        NewsFeedService.get_cached_newsfeeds(self.ming.id)
+        conn = RedisClient.get_connection()
+
+        tweet = self.create_tweet(self.rui, 'tweet 2')
+        msg = fanout_newsfeeds_batch_task(tweet.id, [self.ming.id, lily.id])
+        self.assertEqual(msg.startswith('2 newsfeeds created, 1 pushed to cache, 1 cold keys skipped'), True)
+        self.assertEqual(conn.zcard(USER_NEWSFEEDS_PATTERN.format(user_id = self.ming.id)), 2)
+        self.assertEqual(conn.exists(USER_NEWSFEEDS_PATTERN.format(user_id = lily.id)), False)
+
+        newsfeed = NewsFeed.objects.get(user = self.ming, tweet = tweet)
+        cached_list = NewsFeedService.get_cached_newsfeeds(self.ming.id)
+        self.assertEqual([f.id for f in cached_list][0], newsfeed.id)
+        # 冷的 key 读取的时候从数据库 load
+        cached_list = NewsFeedService.get_cached_newsfeeds(lily.id)
+        self.assertEqual([f.tweet_id for f in cached_list], [tweet.id])
+
+    def test_skip_inactive_followers(self):
+        lily = self.create_user('lily')
+        self.create_friendship(self.ming, self.rui)
+        self.create_friendship(lily, self.rui)
+        conn = RedisClient.get_connection()
+        # lily 很久没有访问过了，ming 没有访问记录当作 active
+        conn.hset(USER_LAST_SEEN_KEY, lily.id, int(time.time() - 40 * ONE_DAY))
+
+        # lily 也关注了一个 pull 模式的 author
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(lily, celebrity)
+        NewsFeedService.add_pull_author(celebrity.id)
+        celebrity_tweet = self.create_tweet(celebrity)
+
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(2)]
+        for tweet in tweets:
+            msg = fanout_newsfeeds_batch_task(tweet.id, [self.ming.id, lily.id])
+            self.assertEqual('1 inactive followers skipped (50.0%)' in msg, True)
+        self.assertEqual(NewsFeed.objects.filter(user = self.ming).count(), 2)
+        self.assertEqual(NewsFeed.objects.filter(user = lily).count(), 0)
+        self.assertEqual(conn.sismember(NEWSFEED_REBUILD_USERS_KEY, lily.id), True)
+
+        # lily 回来之后第一次读取的时候重建，created_at 和 tweet 一致
+        # pull 模式的 author 的 tweet 读取的时候 pull，不写 newsfeeds
+        cached_list = NewsFeedService.get_cached_newsfeeds(lily.id)
+        self.assertEqual(
+            [(f.tweet_id, f.created_at) for f in cached_list],
+            [(t.id, t.created_at) for t in tweets[::-1] + [celebrity_tweet]],
+        )
+        self.assertEqual(conn.sismember(NEWSFEED_REBUILD_USERS_KEY, lily.id), False)
+        self.assertEqual(NewsFeed.objects.filter(user = lily).count(), 2)
+        self.assertEqual(NewsFeed.objects.filter(user = lily, tweet = celebrity_tweet).exists(), False)
+        self.assertEqual(NewsFeedService.rebuild_newsfeeds_if_needed(lily.id), False)
+
+    def test_fanout_lane_fairness(self):
+        # rui 一次放进 3 个 batches，ming 后放进 1 个，ming 不需要等 rui 的全部执行完
+        for i in range(3):
+            NewsFeedService.push_fanout_batch(FANOUT_LANE_SMALL, self.rui.id, i, [i], 0)
+        NewsFeedService.push_fanout_batch(FANOUT_LANE_SMALL, self.ming.id, 100, [100], 0)
+        self.assertEqual(NewsFeedService.get_fanout_lane_stats()[FANOUT_LANE_SMALL]['depth'], 4)
+
+        tweet_ids = []
+        popped = NewsFeedService.pop_fanout_batch(FANOUT_LANE_SMALL)
+        while popped is not None:
+            job_id, batch = popped
+            tweet_ids.append(batch['tweet_id'])
+            self.assertEqual(NewsFeedService.ack_fanout_batch(FANOUT_LANE_SMALL, job_id), True)
+            popped = NewsFeedService.pop_fanout_batch(FANOUT_LANE_SMALL)
+        self.assertEqual(tweet_ids, [0, 100, 1, 2])
+        stats = NewsFeedService.get_fanout_lane_stats()[FANOUT_LANE_SMALL]
+        self.assertEqual((stats['depth'], stats['inflight']), (0, 0))
+        # 其他 lane 不受影响
+        self.assertEqual(NewsFeedService.pop_fanout_batch(FANOUT_LANE_LARGE), None)
+
+    def test_fanout_queue_keys(self):
+        # 同一个 lane 的所有 key 都带同一个 hash tag，redis cluster 里在同一个 slot
+        key = NEWSFEED_FANOUT_QUEUE_PATTERN.format(lane = FANOUT_LANE_SMALL)
+        keys = RedisHelper.get_fair_queue_keys(key)
+        tag = '{' + key + '}'
+        for k in list(keys) + [keys.group_prefix + str(self.rui.id)]:
+            self.assertEqual(k[k.index('{'):k.index('}') + 1], tag)
+
+        # 读到的第一个 group 在执行 lua 之前被别的 worker 取走了，什么都不改
+        RedisHelper.push_fair_queue(key, self.rui.id, 'a')
+        RedisHelper.push_fair_queue(key, self.ming.id, 'b')
+        result = RedisHelper.get_script('pop_fair_queue')(
+            keys = [
+                keys.round_robin,
+                keys.group_prefix + str(self.ming.id),
+                keys.depth,
+                keys.inflight,
+                keys.deadlines,
+                keys.sequence,
+            ],
+            args = [self.ming.id, 0],
+        )
+        self.assertEqual(result, [0])
+        self.assertEqual(RedisHelper.get_fair_queue_depth(key), 2)
+        self.assertEqual(RedisHelper.get_fair_queue_inflight(key), 0)
+        job_id, value = RedisHelper.pop_fair_queue(key, 60)
+        self.assertEqual((job_id.startswith('{}:'.format(self.rui.id)), value), (True, b'a'))
+        self.assertEqual(RedisHelper.pop_fair_queue(key, 60)[1], b'b')
+        self.assertEqual(RedisHelper.pop_fair_queue(key, 60), None)
+        self.assertEqual(RedisHelper.get_fair_queue_inflight(key), 2)
+
+        # 没有超时的不会被放回去，ack 过的也不会
+        self.assertEqual(RedisHelper.ack_fair_queue(key, job_id), True)
+        self.assertEqual(RedisHelper.ack_fair_queue(key, job_id), False)
+        self.assertEqual(RedisHelper.requeue_fair_queue(key), 0)
+        self.assertEqual(RedisHelper.get_fair_queue_inflight(key), 1)
+
+    def test_fanout_batch_requeue(self):
+        lane = FANOUT_LANE_SMALL
+        tweet = self.create_tweet(self.rui)
+        NewsFeedService.push_fanout_batch(lane, self.rui.id, tweet.id, [self.ming.id], time.time())
+
+        # worker 执行 batch 的时候挂掉，batch 留在 in-flight 里，没有丢失
+        with mock.patch('newsfeeds.services.FANOUT_BATCH_ACK_TIMEOUT', -1), mock.patch(
+            'newsfeeds.tasks.fanout_newsfeeds_batch_task',
+            side_effect = RuntimeError,
+        ):
+            with self.assertRaises(RuntimeError):
+                fanout_newsfeeds_lane_task(lane)
+        stats = NewsFeedService.get_fanout_lane_stats()[lane]
+        self.assertEqual((stats['depth'], stats['inflight']), (0, 1))
+        self.assertEqual(NewsFeed.objects.filter(user = self.ming).exists(), False)
+
+        # 超时之后放回队列，发一个新的 lane task 重新执行
+        self.assertEqual(requeue_fanout_batches_task(), '1 expired batches requeued.')
+        self.assertEqual(NewsFeed.objects.filter(user = self.ming, tweet = tweet).exists(), True)
+        stats = NewsFeedService.get_fanout_lane_stats()[lane]
+        self.assertEqual((stats['depth'], stats['inflight']), (0, 0))
+        self.assertEqual(requeue_fanout_batches_task(), '0 expired batches requeued.')
+
+    def test_fanout_reads_follower_count_once(self):
+        self.create_friendship(self.ming, self.rui)
+        tweet = self.create_tweet(self.rui)
+        with mock.patch.object(
+            FriendshipService,
+            'get_follower_count',
+            wraps = FriendshipService.get_follower_count,
+        ) as get_follower_count:
+            fanout_newsfeeds_main_task(tweet.id, self.rui.id)
+        self.assertEqual(get_follower_count.call_count, 1)
+
+    def test_fanout_lanes(self):
+        self.create_friendship(self.ming, self.rui)
+        tweet = self.create_tweet(self.rui)
+        fanout_newsfeeds_main_task(tweet.id, self.rui.id)
+        stats = NewsFeedService.get_fanout_lane_stats()
+        self.assertEqual(stats[FANOUT_LANE_SMALL]['batches'], 1)
+        self.assertEqual(stats[FANOUT_LANE_SMALL]['depth'], 0)
+        self.assertEqual(stats[FANOUT_LANE_SMALL]['avg_seconds'] >= 0, True)
+        self.assertEqual(stats[FANOUT_LANE_LARGE]['batches'], 0)
+
+        # follower 多的 author 使用 large lane
+        for i in range(4):
+            self.create_friendship(self.create_user('user{}'.format(i)), self.rui)
+        tweet = self.create_tweet(self.rui)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.rui.id)
+        self.assertEqual(msg, '5 newsfeeds going to fanout, 2 batches created.')
+        self.assertEqual(NewsFeedService.get_fanout_lane_stats()[FANOUT_LANE_LARGE]['batches'], 2)
+
+        # backfill 已经 fanout 过的 tweet，已经存在的 newsfeeds 被忽略
+        fanout_newsfeeds_main_task(tweet.id, self.rui.id, backfill = True)
+        self.assertEqual(NewsFeedService.get_fanout_lane_stats()[FANOUT_LANE_BACKFILL]['batches'], 2)
+        self.assertEqual(NewsFeed.objects.filter(tweet = tweet).count(), 6)
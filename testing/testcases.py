@@ -7,15 +7,35 @@ from likes.models import Like
 from newsfeeds.models import NewsFeed
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
+from django.test import override_settings
 from friendships.services import FriendshipService
 from utils.redis_client import RedisClient
+from utils.memcached_helper import MemcachedHelper
+from accounts.services import UserService
 from django_hbase.models import HBaseModel
 from gatekeeper.models import GateKeeper
 
+import shutil
+import tempfile
+
 class TestCase(DjangoTestCase):
 
     hbase_tables_created = False
 
+    @classmethod
+    def setUpClass(cls):
+        # 上传的文件写到临时目录里，测试结束之后删除，不会留在 media/ 下面
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_root_override = override_settings(MEDIA_ROOT = cls.media_root)
+        cls.media_root_override.enable()
+        super(TestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestCase, cls).tearDownClass()
+        cls.media_root_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors = True)
+
     def setUp(self):
         self.clear_cache()
         try:
@@ -35,6 +55,8 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         RedisClient.clear()
         caches['testing'].clear()
+        MemcachedHelper.clear_local_cache()
+        UserService.clear_last_seen_updates()
         GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 100)
 
     @property
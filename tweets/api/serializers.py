@@ -8,6 +8,8 @@ from comments.api.serializers import CommentSerializer
 from likes.services import LikeService
 from likes.api.serializers import LikeSerializer
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
+from accounts.services import UserService
 
 class TweetSerializer(serializers.ModelSerializer):
     user = UserSerializerForTweet(source = 'cached_user') # who creates this tweet
@@ -18,6 +20,7 @@ class TweetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Tweet
+        list_serializer_class = PrefetchListSerializer
         fields = (
             'id',
             'user',
@@ -29,6 +32,10 @@ class TweetSerializer(serializers.ModelSerializer):
             'photo_urls',
         )
 
+    def prefetch(self, tweets):
+        # 一页 tweets 的 user 和 profile 批量读取，渲染的时候 cached_user 就是 L1 hit
+        UserService.get_users_through_cache([tweet.user_id for tweet in tweets])
+
     def get_likes_count(self, obj):
         # select count(*) -> redis get
         # N + 1 queries
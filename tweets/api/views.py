@@ -14,6 +14,8 @@ from tweets.services import TweetService
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
+import functools
+
 
 class TweetViewSet(viewsets.GenericViewSet):
     serializer_class = TweetSerializerForCreate
@@ -39,8 +41,10 @@ class TweetViewSet(viewsets.GenericViewSet):
     @required_params(params=['user_id'])
     def list(self, request, *args, **kwargs):
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        page = self.paginator.paginate_cached_timeline(
+            functools.partial(TweetService.get_cached_tweets_page, user_id),
+            request,
+        )
         if page is None:
             # 这句查询会被翻译为
             # select * from twitter_tweets
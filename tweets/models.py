@@ -94,4 +94,4 @@ class TweetPhoto(models.Model):
 
 post_save.connect(invalidate_object_cache, sender = Tweet)
 pre_delete.connect(invalidate_object_cache, sender = Tweet)
-post_save.connect(push_tweet_to_cache, sender = Tweet)
\ No newline at end of file
+post_save.connect(push_tweet_to_cache, sender = Tweet)
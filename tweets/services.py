@@ -1,5 +1,6 @@
 from tweets.models import Tweet, TweetPhoto
 from twitter.cache import USER_TWEETS_PATTERN
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
 
@@ -19,12 +20,73 @@ class TweetService(object):
         TweetPhoto.objects.bulk_create(photos)
 
     @classmethod
-    def get_cached_tweets(cls, user_id):
+    def get_cached_tweet_entries(cls, user_id):
         # Queryset is lazy loading
         # 此时并没有进行数据库的访问，只有需要进行iteration的时候才会真正查询数据库
         queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return RedisHelper.load_timeline(key, queryset)
+
+    @classmethod
+    def get_cached_tweet_entries_page(
+            cls,
+            user_id,
+            page_size,
+            created_at__lt = None,
+            created_at__gt = None):
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_timeline_page(
+            key,
+            queryset,
+            page_size,
+            created_at__lt = created_at__lt,
+            created_at__gt = created_at__gt,
+        )
+
+    @classmethod
+    def get_cached_tweets(cls, user_id):
+        # redis 里只存 tweet id，tweet 的内容从 memcached 批量读取
+        entries = cls.get_cached_tweet_entries(user_id)
+        return MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [entry.id for entry in entries],
+        )
+
+    @classmethod
+    def get_cached_tweets_page(
+            cls,
+            user_id,
+            page_size,
+            created_at__lt = None,
+            created_at__gt = None):
+        # 只从 redis 里读取一页，返回 (tweets, has_next_page)
+        # tweets 是 None 说明 cache 里的数据不全，需要去数据库查询
+        for _ in range(2):
+            entries, has_next_page = cls.get_cached_tweet_entries_page(
+                user_id,
+                page_size,
+                created_at__lt = created_at__lt,
+                created_at__gt = created_at__gt,
+            )
+            if entries is None:
+                return None, False
+            tweets = MemcachedHelper.get_objects_through_cache(
+                Tweet,
+                [entry.id for entry in entries],
+            )
+            if len(tweets) == len(entries):
+                return tweets, has_next_page
+            # 已经删除的 tweet 还在 sorted set 里，跳过之后这一页会不满
+            # 从 sorted set 里删掉之后再读一次，用后面的数据补满这一页
+            tweet_ids = set(tweet.id for tweet in tweets)
+            RedisHelper.remove_timeline_entries(
+                USER_TWEETS_PATTERN.format(user_id=user_id),
+                Tweet.objects.filter(user_id=user_id).order_by('-created_at'),
+                [entry for entry in entries if entry.id not in tweet_ids],
+            )
+        # 另一个进程正在重新 load，这一页直接查数据库
+        return None, False
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
@@ -32,4 +94,4 @@ class TweetService(object):
         # 此时并没有进行数据库的访问，只有需要进行iteration的时候才会真正查询数据库
         queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
+        RedisHelper.push_timeline_entry(key, tweet, queryset)
\ No newline at end of file
@@ -1,12 +1,23 @@
 from datetime import timedelta
 from utils.time_helpers import utc_now
 from testing.testcases import TestCase
-from tweets.models import TweetPhoto
+from tweets.models import Tweet, TweetPhoto
 from tweets.constants import TweetPhotoStatus
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_serializers import (
+    DjangoModelSerializer,
+    SchemaVersionError,
+    TimelineEntrySerializer,
+)
 from tweets.services import TweetService
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_PATTERN, LEGACY_TIMELINE_KEY_PREFIXES
+from utils.redis_helper import RedisHelper
+from django.conf import settings
+from django.test import override_settings
+from utils.cache_lease import should_refresh_early
+from utils.benchmarks import benchmark_redis_serializers
+
+import struct
 
 
 class TweetTests(TestCase):
@@ -96,4 +107,220 @@ class TweetServiceTests(TestCase):
         self.assertEqual(conn.exists(key), True)
 
         tweets = TweetService.get_cached_tweets(self.rui.id)
-        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
\ No newline at end of file
+        self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_redis_helper_round_trips(self):
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(3)]
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id = self.rui.id)
+
+        # cache miss 的时候 rpush 和 expire 一起执行
+        cached_tweets = TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+        self.assertEqual(
+            conn.zrevrange(key, 0, -1),
+            [TimelineEntrySerializer.serialize(t) for t in tweets[::-1]],
+        )
+        self.assertEqual(0 < conn.ttl(key) <= settings.REDIS_KEY_EXPIRE_TIME, True)
+
+        # 已经存在的 key 不会被重复写入
+        RedisHelper._load_timeline_to_cache(key, tweets, 'id')
+        self.assertEqual(conn.zcard(key), 3)
+
+        # push 之后 list 的长度不会超过上限
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT):
+            self.create_tweet(self.rui, 'new tweet {}'.format(i))
+        self.assertEqual(conn.zcard(key), settings.REDIS_LIST_LENGTH_LIMIT)
+
+        # key 不存在的时候 push 会从数据库 load
+        conn.delete(key)
+        queryset = Tweet.objects.filter(user_id = self.rui.id).order_by('-created_at')
+        RedisHelper.push_timeline_entry(key, tweets[0], queryset)
+        self.assertEqual(conn.zcard(key), settings.REDIS_LIST_LENGTH_LIMIT)
+
+        # counter 不存在的时候从数据库 back fill，存在的时候直接加减
+        tweet = tweets[0]
+        count_key = RedisHelper.get_count_key(tweet, 'likes_count')
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), tweet.likes_count)
+        self.assertEqual(0 < conn.ttl(count_key) <= settings.REDIS_KEY_EXPIRE_TIME, True)
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), tweet.likes_count + 1)
+        self.assertEqual(RedisHelper.decr_count(tweet, 'likes_count'), tweet.likes_count)
+
+    def test_timeline_hydration(self):
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(3)]
+        self.clear_cache()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id = self.rui.id)
+
+        # cache miss 的时候 redis 里只存 (id, tweet_id, created_at)
+        # tweet 的内容用一次 id__in 查询读取
+        with self.assertNumQueries(2):
+            cached_tweets = TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+        self.assertEqual(cached_tweets[0].content, tweets[2].content)
+        for data in conn.zrevrange(key, 0, -1):
+            self.assertEqual(len(data), TimelineEntrySerializer.STRUCT.size)
+
+        # redis 和 memcached 都 hit 的时候不访问数据库
+        with self.assertNumQueries(0):
+            cached_tweets = TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+
+        entry = TimelineEntrySerializer.deserialize(TimelineEntrySerializer.serialize(tweets[0]))
+        self.assertEqual(entry, (tweets[0].id, tweets[0].id, tweets[0].created_at))
+        with self.assertRaises(SchemaVersionError):
+            TimelineEntrySerializer.deserialize(DjangoModelSerializer.serialize(tweets[0]).encode('utf-8'))
+        # 没有版本号的旧格式和其他版本号的 entry 都当成 cache miss
+        with self.assertRaises(SchemaVersionError):
+            TimelineEntrySerializer.deserialize(struct.pack('>qqq', tweets[0].id, tweets[0].id, 0))
+        with self.assertRaises(SchemaVersionError):
+            TimelineEntrySerializer.deserialize(TimelineEntrySerializer.STRUCT.pack(
+                TimelineEntrySerializer.VERSION + 1,
+                tweets[0].id,
+                tweets[0].id,
+                0,
+            ))
+
+        results = benchmark_redis_serializers(tweets, repeat = 1)
+        self.assertEqual(results['timeline_entry']['bytes'], 3 * TimelineEntrySerializer.STRUCT.size)
+        self.assertLess(results['timeline_entry']['bytes'], results['json']['bytes'])
+
+        # 修改过的 tweet 会从 memcached 里删除，hydrate 的时候读取到最新的内容
+        tweets[1].content = 'updated'
+        tweets[1].save()
+        cached_tweets = TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual(cached_tweets[1].content, 'updated')
+
+        # 被删除的 tweet 会被跳过
+        tweets[0].delete()
+        cached_tweets = TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual([t.id for t in cached_tweets], [tweets[2].id, tweets[1].id])
+
+    def test_timeline_page(self):
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(5)]
+        tweets = tweets[::-1]
+        self.clear_cache()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id = self.rui.id)
+
+        # cache miss 的时候从数据库 load 到 sorted set
+        page, has_next_page = TweetService.get_cached_tweets_page(self.rui.id, 2)
+        self.assertEqual([t.id for t in page], [t.id for t in tweets[:2]])
+        self.assertEqual(has_next_page, True)
+        self.assertEqual(conn.zcard(key), 5)
+
+        # 每次只读取一页
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.rui.id,
+            2,
+            created_at__lt = tweets[1].created_at,
+        )
+        self.assertEqual([t.id for t in page], [t.id for t in tweets[2:4]])
+        self.assertEqual(has_next_page, True)
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.rui.id,
+            2,
+            created_at__lt = tweets[3].created_at,
+        )
+        self.assertEqual([t.id for t in page], [tweets[4].id])
+        self.assertEqual(has_next_page, False)
+
+        # 上翻页返回所有更新的数据
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.rui.id,
+            2,
+            created_at__gt = tweets[4].created_at,
+        )
+        self.assertEqual([t.id for t in page], [t.id for t in tweets[:4]])
+        self.assertEqual(has_next_page, False)
+
+        # sorted set 满了并且翻到了最后，说明数据库里可能还有数据
+        conn.delete(key)
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT):
+            self.create_tweet(self.rui, 'new tweet {}'.format(i))
+        TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual(conn.zcard(key), settings.REDIS_LIST_LENGTH_LIMIT)
+        entries = RedisHelper.load_timeline(key, Tweet.objects.none())
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.rui.id,
+            2,
+            created_at__lt = entries[-2].created_at,
+        )
+        self.assertEqual(page, None)
+
+    def test_timeline_page_with_deleted_tweets(self):
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(5)]
+        tweets = tweets[::-1]
+        self.clear_cache()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id = self.rui.id)
+        TweetService.get_cached_tweets(self.rui.id)
+
+        # 删除的 tweet 还在 sorted set 里，读到的时候删掉并且用后面的数据补满这一页
+        Tweet.objects.filter(id__in = [tweets[0].id, tweets[1].id]).delete()
+        self.assertEqual(conn.zcard(key), 5)
+        page, has_next_page = TweetService.get_cached_tweets_page(self.rui.id, 2)
+        self.assertEqual([t.id for t in page], [tweets[2].id, tweets[3].id])
+        self.assertEqual(has_next_page, True)
+        self.assertEqual(conn.zcard(key), 3)
+
+        # sorted set 是满的时候从数据库重新 load，更早的数据也会补进来
+        conn.delete(key)
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        for i in range(limit):
+            self.create_tweet(self.rui, 'new tweet {}'.format(i))
+        TweetService.get_cached_tweets(self.rui.id)
+        self.assertEqual(conn.zcard(key), limit)
+        newest_id = Tweet.objects.filter(user_id = self.rui.id).order_by('-created_at').first().id
+        Tweet.objects.filter(id = newest_id).delete()
+        page, has_next_page = TweetService.get_cached_tweets_page(self.rui.id, 2)
+        self.assertEqual(len(page), 2)
+        self.assertEqual(newest_id in [t.id for t in page], False)
+        self.assertEqual(has_next_page, True)
+        self.assertEqual(conn.zcard(key), limit)
+
+    def test_delete_legacy_keys(self):
+        self.create_tweet(self.rui)
+        TweetService.get_cached_tweets(self.rui.id)
+        conn = RedisClient.get_connection()
+        conn.rpush('user_tweets:{}'.format(self.rui.id), 'old')
+        conn.rpush('user_newsfeeds:{}'.format(self.rui.id), 'old')
+        self.assertEqual(RedisHelper.delete_legacy_keys(LEGACY_TIMELINE_KEY_PREFIXES, batch_size = 1), 2)
+        self.assertEqual(conn.exists('user_tweets:{}'.format(self.rui.id)), False)
+        self.assertEqual(conn.exists(USER_TWEETS_PATTERN.format(user_id = self.rui.id)), True)
+
+    def test_cache_lease(self):
+        tweets = [self.create_tweet(self.rui, 'tweet {}'.format(i)) for i in range(2)]
+        tweet_ids = [t.id for t in tweets[::-1]]
+        self.clear_cache()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id = self.rui.id)
+        queryset = Tweet.objects.filter(user_id = self.rui.id).order_by('-created_at')
+
+        # 其他进程拿着 lease 在 fill，等不到的话直接读数据库，但是不写 cache
+        conn.set(RedisHelper.get_lease_key(key), 'other')
+        entries = RedisHelper.load_timeline(key, queryset)
+        self.assertEqual([entry.id for entry in entries], tweet_ids)
+        self.assertEqual(conn.exists(key), False)
+        RedisHelper.push_timeline_entry(key, tweets[0], queryset)
+        self.assertEqual(conn.exists(key), False)
+        # 读取一页的时候等不到 fill 直接返回 None，由调用方只查询一页，不会先查一次整个 timeline
+        with self.assertNumQueries(0):
+            self.assertEqual(RedisHelper.load_timeline_page(key, queryset, 1), (None, False))
+
+        # lease 释放之后正常 fill，并且 fill 完会释放自己的 lease
+        conn.delete(RedisHelper.get_lease_key(key))
+        RedisHelper.load_timeline(key, queryset)
+        self.assertEqual(conn.zcard(key), 2)
+        self.assertEqual(conn.exists(RedisHelper.get_lease_key(key)), False)
+
+        # 快过期的时候提前重新 load，绕过 signal 写入的数据也会被 load 进来
+        Tweet.objects.bulk_create([Tweet(user = self.rui, content = 'bulk tweet')])
+        conn.expire(key, 1)
+        with override_settings(CACHE_EARLY_REFRESH_WINDOW = 10 ** 9):
+            entries = RedisHelper.load_timeline(key, queryset)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(conn.zcard(key), 3)
+        self.assertEqual(conn.ttl(key) > 1, True)
+        self.assertEqual(should_refresh_early(-1), False)
@@ -4,5 +4,22 @@ FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # redis
-USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+# timeline 从 list 改成了 sorted set，换一个 key 避免读到旧的 list 出现 WRONGTYPE
+USER_TWEETS_PATTERN = 'user_tweets:z:{user_id}'
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:z:{user_id}'
+# 改成 sorted set 之前的 list，例如 'user_tweets:1'。写入的时候都设置了 REDIS_KEY_EXPIRE_TIME
+# 的过期时间，不需要处理也会自动删除。需要马上释放内存的话在 shell 里执行
+#     RedisHelper.delete_legacy_keys(LEGACY_TIMELINE_KEY_PREFIXES)
+LEGACY_TIMELINE_KEY_PREFIXES = ('user_tweets:', 'user_newsfeeds:')
+# 使用 pull 模式的 author，set 类型
+NEWSFEED_PULL_AUTHORS_KEY = 'newsfeeds:pull_authors'
+# 每个 user 关注的 pull 模式的 authors，set 类型，读取 newsfeeds 的时候不需要检查关注关系
+NEWSFEED_PULL_FOLLOWINGS_PATTERN = 'newsfeeds:pull_followings:{user_id}'
+# user 最近一次访问的时间，hash 类型，user_id -> timestamp
+USER_LAST_SEEN_KEY = 'users:last_seen'
+# 不活跃期间被跳过 fanout 的 users，下次读取 newsfeeds 的时候重建，set 类型
+NEWSFEED_REBUILD_USERS_KEY = 'newsfeeds:rebuild_users'
+# 每个 fanout lane 里等待执行的 batches，使用 RedisHelper 的公平队列，按照 author 轮流取
+NEWSFEED_FANOUT_QUEUE_PATTERN = 'newsfeeds:fanout_queue:{lane}'
+# 每个 fanout lane 的延迟统计，hash 类型
+NEWSFEED_FANOUT_LATENCY_PATTERN = 'newsfeeds:fanout_latency:{lane}'
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+from celery.schedules import crontab
 from kombu import Queue
 from pathlib import Path
 
@@ -73,6 +74,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middlewares.LastSeenMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
@@ -213,6 +215,22 @@ REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400 # in seconds
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
 
+# 进程内的 L1 cache，在 memcached 前面
+# 其他进程修改了 object 之后通过 redis pub/sub 广播 invalidation
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_TTL = 60 # in seconds
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidation' if not TESTING else 'testing:local_cache_invalidation'
+
+# cache miss 的时候同一个 key 只有拿到 lease 的进程去数据库 fill，其他进程等一小会
+CACHE_LEASE_TIMEOUT = 5 # in seconds
+CACHE_LEASE_WAIT = 0.2 # in seconds
+CACHE_LEASE_POLL_INTERVAL = 0.02 # in seconds
+# 剩余过期时间在这个量级的时候开始有明显的概率提前 refresh
+CACHE_EARLY_REFRESH_WINDOW = 3600 # in seconds
+
+# 同一个进程里同一个 user 的 last seen 最多这么久写一次 redis
+USER_LAST_SEEN_UPDATE_INTERVAL = 60 # in seconds
+
 # Celery Configuration Options
 # 使用如下命令把worker进程（只执行异步任务的进程，可以在不同的机器上）单独运行
 #     celery -A twitter worker -l INFO
@@ -222,8 +240,29 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_ALWAYS_EAGER = TESTING
 CELERY_QUEUES = (
     Queue('default', routing_key = 'default'),
+    # 升级之前已经在队列里的 fanout_newsfeeds_batch_task
     Queue('newsfeeds', routing_key = 'newsfeeds'),
+    # fanout 的三个 lane，见 newsfeeds.constants，可以给每个 lane 单独启动 worker
+    #     celery -A twitter worker -Q newsfeeds_small -l INFO
+    Queue('newsfeeds_small', routing_key = 'newsfeeds_small'),
+    Queue('newsfeeds_large', routing_key = 'newsfeeds_large'),
+    Queue('newsfeeds_backfill', routing_key = 'newsfeeds_backfill'),
 )
+# 定时任务，使用如下命令启动 beat 进程
+#     celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    # fanout 的 batch 执行过程中 worker 挂掉的话，超时之后放回队列重新执行
+    'requeue-fanout-batches': {
+        'task': 'newsfeeds.tasks.requeue_fanout_batches_task',
+        'schedule': 60,
+    },
+    # follow / unfollow 写完 friendship 之后再单独更新 counter，两步之间进程挂掉的话
+    # counter 会和 friendship 不一致，每天低峰期全量重算一次，不一致最多持续到下一次重算
+    'rebuild-friendship-counts': {
+        'task': 'friendships.tasks.rebuild_friendship_counts_task',
+        'schedule': crontab(hour = 4, minute = 0),
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -232,6 +271,38 @@ RATELIMIT_ENABLE = not TESTING # 在某些环境下，比如内部测试等环
 
 # HBase database
 HBASE_HOST = '127.0.0.1'
+# HBase connection 的实现，单元测试使用进程内存里的实现，不需要启动 hbase
+HBASE_BACKEND = 'django_hbase.memory.Connection' if TESTING else 'happybase.Connection'
+# 每个进程里的 HBase connection pool 的大小，一般设置成和每个进程的线程数差不多
+# gunicorn 的 threads 或者 celery worker 的 concurrency
+HBASE_POOL_SIZE = 10
+# pool 里的 connection 都被占用的时候，最多等待多少秒
+HBASE_POOL_TIMEOUT = 5
+# connection 闲置超过多少秒之后，checkout 的时候先 ping 一下确认还能用
+HBASE_POOL_HEALTH_CHECK_INTERVAL = 60
+# HBaseModel.batch() 里攒够多少个 mutation 发送一次
+HBASE_BATCH_SIZE = 1000
+# HBaseModel.get_many() 每次 rpc 最多取多少行
+HBASE_GET_MANY_CHUNK_SIZE = 100
+# HBaseModel.iter_filter() 每次 rpc 从 scanner 里取多少行
+HBASE_SCAN_BATCH_SIZE = 100
+# HBaseModel.multi_filter() 和打散的 model 的 filter() 最多同时执行多少个 scan
+# 不会超过 pool 里空闲的 connection 个数
+HBASE_MULTI_FILTER_MAX_WORKERS = 4
+# HBaseFollowing / HBaseFollower 的 row key 打散到多少个 bucket，None 表示不打散
+# 打散的数据存在单独的 <table_name>_salted<N> 表里，已经有数据的时候按照下面的步骤打开:
+#   1. 创建 twitter_followings_salted<N>、twitter_followings_salted<N>_index 和
+#      twitter_followers_salted<N> 三张表，column family 和原来的表一样
+#   2. 在 local_settings.py 里设置好这个值之后打开 shell，执行
+#      HBaseFollowing.copy_unsalted_rows() 和 HBaseFollower.copy_unsalted_rows()
+#   3. 所有进程使用新的设置重新部署之后，在低峰期再执行一次第 2 步，补上这期间写入旧表的数据
+HBASE_FRIENDSHIP_SALT_BUCKETS = None
+# HBaseFollowing 的 (from_user_id, to_user_id) 索引没有命中的时候是否再 scan 一次
+# 打开之后每次 follow 和每次没有关注的 has_followed 都会多一次 prefix scan，所以默认关闭
+# 索引上线之前的关注关系没有索引，只在 HBaseFollowing.build_indexes() 补完旧数据之前打开
+HBASE_FRIENDSHIP_INDEX_FALLBACK = False
+# FriendshipService.iter_follower_id_batches() 默认每批读取多少个 follower ids
+FOLLOWER_ID_BATCH_SIZE = 1000
 
 try:
     from .local_settings import *
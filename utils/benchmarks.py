@@ -0,0 +1,46 @@
+"""
+一些用于比较不同实现性能的小工具，在 python manage.py shell 里使用:
+    from utils.benchmarks import benchmark_redis_serializers
+    benchmark_redis_serializers(Tweet.objects.all()[:200])
+"""
+from utils.redis_serializers import DjangoModelSerializer, TimelineEntrySerializer
+
+import time
+
+REDIS_SERIALIZERS = {
+    'json': DjangoModelSerializer,
+    'timeline_entry': TimelineEntrySerializer,
+}
+
+
+def _to_bytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+def benchmark_redis_serializers(instances, repeat = 10):
+    """
+    对同一批 instances 分别用每种格式 serialize / deserialize repeat 次
+    返回 {name: {'bytes': 总大小, 'serialize_seconds': ..., 'deserialize_seconds': ...}}
+    """
+    instances = list(instances)
+    results = {}
+    for name, serializer in REDIS_SERIALIZERS.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            serialized_list = [_to_bytes(serializer.serialize(instance)) for instance in instances]
+        serialize_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for serialized_data in serialized_list:
+                serializer.deserialize(serialized_data)
+        deserialize_seconds = time.perf_counter() - start
+
+        results[name] = {
+            'bytes': sum(len(serialized_data) for serialized_data in serialized_list),
+            'serialize_seconds': serialize_seconds,
+            'deserialize_seconds': deserialize_seconds,
+        }
+    return results
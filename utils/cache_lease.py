@@ -0,0 +1,31 @@
+from django.conf import settings
+
+import math
+import random
+import time
+
+
+def wait_for_fill(read):
+    """
+    其他进程拿到了 lease 正在 fill cache，等一小会再读
+    在 CACHE_LEASE_WAIT 时间内没有读到返回 None，由调用方直接查数据库
+    """
+    deadline = time.monotonic() + settings.CACHE_LEASE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(settings.CACHE_LEASE_POLL_INTERVAL)
+        result = read()
+        if result:
+            return result
+    return None
+
+
+def should_refresh_early(ttl):
+    """
+    probabilistic early expiration: 剩余的过期时间越短，提前 refresh 的概率越大
+    这样热点 key 在过期之前就会被某一个请求重新 load，不会所有请求同时 cache miss
+    ttl 是 redis 返回的剩余秒数，-1 表示不过期，-2 表示 key 不存在
+    """
+    if ttl is None or ttl < 0:
+        return False
+    # 1 - random() 的范围是 (0, 1]，避免 log(0)
+    return -settings.CACHE_EARLY_REFRESH_WINDOW * math.log(1.0 - random.random()) >= ttl
@@ -1,29 +1,189 @@
 from django.conf import settings
 from django.core.cache import caches
+from utils.cache_lease import wait_for_fill
+from utils.local_cache import LocalCache
+from utils.redis_client import RedisClient
+
+import os
+import pickle
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 进程内的 L1 cache，在 memcached 前面，避免同一个进程反复读取同样的热点 object
+# 存储的是 pickle 之后的 bytes，每次 hit 都得到一个新的 object，调用方修改了也不会影响其他请求
+local_cache = LocalCache(
+    max_size = settings.LOCAL_CACHE_MAX_SIZE,
+    ttl = settings.LOCAL_CACHE_TTL,
+)
+
+LOCAL_TIER = 'local'
+MEMCACHED_TIER = 'memcached'
+
+
 class MemcachedHelper:
+    # 每一层 cache 的命中次数，tier -> {'hits': x, 'misses': y}
+    stats = {
+        LOCAL_TIER: {'hits': 0, 'misses': 0},
+        MEMCACHED_TIER: {'hits': 0, 'misses': 0},
+    }
+    _pubsub = None
+    _pubsub_pid = None
 
     @classmethod
     def get_key(cls, model_class, object_id):
         return '{}:{}'.format(model_class.__name__, object_id)
     # User -> 'User'
 
+    @classmethod
+    def record(cls, tier, hits = 0, misses = 0):
+        cls.stats[tier]['hits'] += hits
+        cls.stats[tier]['misses'] += misses
+
+    @classmethod
+    def get_stats(cls):
+        return {tier: dict(counters) for tier, counters in cls.stats.items()}
+
+    @classmethod
+    def reset_stats(cls):
+        for counters in cls.stats.values():
+            counters['hits'] = 0
+            counters['misses'] = 0
+
+    @classmethod
+    def _get_pubsub(cls):
+        pid = os.getpid()
+        if cls._pubsub is not None and cls._pubsub_pid == pid:
+            return cls._pubsub
+        # fork 出来的子进程不能共用父进程的 pubsub 连接，需要重新 subscribe
+        # 从父进程继承来的 L1 也收不到之前的 invalidation 了，直接清空
+        local_cache.clear()
+        pubsub = RedisClient.get_connection().pubsub(ignore_subscribe_messages = True)
+        pubsub.subscribe(settings.LOCAL_CACHE_INVALIDATION_CHANNEL)
+        cls._pubsub = pubsub
+        cls._pubsub_pid = pid
+        return pubsub
+
+    @classmethod
+    def sync_local_cache(cls):
+        # 读取 L1 之前把其他进程广播的 invalidation 处理掉
+        # 不需要单独的线程，get_message 没有消息的时候马上返回
+        pubsub = cls._get_pubsub()
+        message = pubsub.get_message()
+        while message is not None:
+            local_cache.delete(message['data'].decode('utf-8'))
+            message = pubsub.get_message()
+
+    @classmethod
+    def _get_local(cls, key):
+        data = local_cache.get(key)
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    @classmethod
+    def _set_local(cls, key, obj):
+        local_cache.set(key, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def set_local_objects(cls, model_class, objects):
+        # 调用方在 objects 上记下了额外的数据（比如 user 的 profile）之后重新写进 L1
+        # 之后 L1 hit 的时候 unpickle 出来的 object 上也有这些数据
+        for obj in objects:
+            cls._set_local(cls.get_key(model_class, obj.id), obj)
+
+    @classmethod
+    def clear_local_cache(cls):
+        local_cache.clear()
+
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
+        cls.sync_local_cache()
+        # L1 hit
+        obj = cls._get_local(key)
+        if obj is not None:
+            cls.record(LOCAL_TIER, hits = 1)
+            return obj
+        cls.record(LOCAL_TIER, misses = 1)
+
         # cache hit
         obj = cache.get(key)
         if obj:
+            cls.record(MEMCACHED_TIER, hits = 1)
+            cls._set_local(key, obj)
             return obj
+        cls.record(MEMCACHED_TIER, misses = 1)
+
         # cache miss
-        obj = model_class.objects.get(id = object_id)
-        # using default expire time
-        cache.set(key, obj)
+        obj = cls._fill_once(key, model_class, object_id)
+        cls._set_local(key, obj)
         return obj
 
+    @classmethod
+    def _fill_once(cls, key, model_class, object_id):
+        # 热点 object 被 invalidate 之后，只有拿到 lease 的进程去数据库读取并写回 memcached
+        # memcached 的 add 是原子的，key 已经存在的时候返回 False
+        lease_key = 'lease:{}'.format(key)
+        if cache.add(lease_key, 1, timeout = settings.CACHE_LEASE_TIMEOUT):
+            try:
+                obj = model_class.objects.get(id = object_id)
+                # using default expire time
+                cache.set(key, obj)
+                return obj
+            finally:
+                cache.delete(lease_key)
+
+        # 其他进程正在读取，等一小会，等不到的话直接读数据库
+        obj = wait_for_fill(lambda: cache.get(key))
+        if obj is not None:
+            return obj
+        return model_class.objects.get(id = object_id)
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        按照 object_ids 的顺序返回 objects，先读 L1，再一次 get_many 读取 memcached
+        cache miss 的 objects 用一次 id__in 查询从数据库读取，再用 set_many 写回 memcached
+        数据库里已经不存在的 object 会被跳过
+        """
+        keys = {
+            object_id: cls.get_key(model_class, object_id)
+            for object_id in object_ids
+        }
+        cls.sync_local_cache()
+        objects = {}
+        for object_id, key in keys.items():
+            obj = cls._get_local(key)
+            if obj is not None:
+                objects[object_id] = obj
+        cls.record(LOCAL_TIER, hits = len(objects), misses = len(keys) - len(objects))
+
+        missed_keys = [key for object_id, key in keys.items() if object_id not in objects]
+        if missed_keys:
+            cached = cache.get_many(missed_keys)
+            cls.record(MEMCACHED_TIER, hits = len(cached), misses = len(missed_keys) - len(cached))
+            for object_id, key in keys.items():
+                if key in cached:
+                    objects[object_id] = cached[key]
+                    cls._set_local(key, cached[key])
+
+        missed_ids = [object_id for object_id in keys if object_id not in objects]
+        if missed_ids:
+            missed_objects = list(model_class.objects.filter(id__in = missed_ids))
+            objects.update({obj.id: obj for obj in missed_objects})
+            cache.set_many({
+                keys[obj.id]: obj
+                for obj in missed_objects
+            })
+            for obj in missed_objects:
+                cls._set_local(keys[obj.id], obj)
+
+        return [objects[object_id] for object_id in object_ids if object_id in objects]
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        local_cache.delete(key)
+        # 通知其他进程删除各自 L1 里的这个 key
+        RedisClient.get_connection().publish(settings.LOCAL_CACHE_INVALIDATION_CHANNEL, key)
@@ -14,31 +14,6 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
-
-        index = 0
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没有找到任何满足条件的objects，返回空数组
-                # 注意这个else对应的是for，参见python的for else用法
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
-
     def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
             created_at__gt = request.query_params['created_at__gt']
@@ -55,22 +30,24 @@ class EndlessPagination(BasePagination):
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
-        paginated_list = self.paginate_ordered_list(cached_list, request)
-        # 如果是上翻页，paginated_list 里面是所有最新的数据，直接返回
+    def paginate_cached_timeline(self, load_page, request):
+        """
+        load_page(page_size, created_at__lt, created_at__gt) 只从 redis 的 sorted set 里读取一页
+        返回 None 说明 cache 里的数据不全，需要去数据库查询
+        """
+        created_at__lt = None
+        created_at__gt = None
         if 'created_at__gt' in request.query_params:
-            return paginated_list
-
-        # 如果还有下一页，说明cached_list里的数据还没有取完，也直接返回
-        if self.has_next_page:
-            return paginated_list
-
-        # 如果cached_list的长度不是最大限制，说明cached_list里已经是所有数据了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
-            return paginated_list
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+        elif 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
 
-        # 如果进入这里，说明可能存在在数据库里没有load在cache里的数据，需要直接去数据库查询
-        return None
+        page, self.has_next_page = load_page(
+            page_size = self.page_size,
+            created_at__lt = created_at__lt,
+            created_at__gt = created_at__gt,
+        )
+        return page
 
     def get_paginated_response(self, data):
         return Response({
@@ -92,20 +69,17 @@ class EndlessPagination(BasePagination):
             # (1, 123123) -> '1:123123'
             # (1, 123124) -> '1:123124'
             # (1, .......)
-            objects = hb_model.filter(start = start, stop = stop)
-            if len(objects) and objects[0].created_at == int(created_at__gt):
-                objects = objects[:0:-1]
-            else:
-                objects = objects[::-1]
+            # start_exclusive 不包含 created_at__gt 这一行
+            objects = hb_model.filter(start = start, stop = stop, start_exclusive = True)
             self.has_next_page = False
-            return objects
+            return objects[::-1]
 
         if 'created_at__lt' in request.query_params:
             # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页（更旧）的数据
             # 寻找 timestamp < created_at__lt 的 objects 里按照 timestamp 倒序的前 page_size + 1 个 objects
             # 比如目前的 timestamp 列表是 [1,2,3,4,5,6,7,8,9,10]如果 created_at__lt=5, page_size = 2
             # 则应该返回 [4,3,2]，多返回一个 object 的原因是为了判断是否还有下一页从而减少一次空加载。
-            # 由于 hbase 只支持 <= 的查询而不支持 <，因此我们还需要再多取一个 item 保证 < 的 item 有 page_size + 1 个
+            # hbase 的 scan 本身只支持 <=，start_exclusive 会从前一个 row key 开始 scan，不会读到 created_at__lt 这一行
             created_at__lt = request.query_params['created_at__lt']
             start = (*row_key_prefix, created_at__lt)
             stop = (*row_key_prefix, None)
@@ -120,9 +94,13 @@ class EndlessPagination(BasePagination):
             # (2, ts2) ^
             # (2, ts3) -> start
             # (2, ts4)
-            objects = hb_model.filter(start = start, stop = stop, limit = self.page_size + 2, reverse = True)
-            if len(objects) and objects[0].created_at == int(created_at__lt):
-                objects = objects[1:]
+            objects = hb_model.filter(
+                start = start,
+                stop = stop,
+                limit = self.page_size + 1,
+                reverse = True,
+                start_exclusive = True,
+            )
             if len(objects) > self.page_size:
                 self.has_next_page = True
                 objects = objects[:-1]
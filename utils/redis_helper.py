@@ -1,57 +1,530 @@
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_serializers import (
+    SchemaVersionError,
+    TimelineEntry,
+    TimelineEntrySerializer,
+    datetime_to_micros,
+)
+from utils.cache_lease import should_refresh_early, wait_for_fill
 from django.conf import settings
+from collections import namedtuple
+from contextlib import contextmanager
+
+import time
+import uuid
+
+FairQueueKeys = namedtuple('FairQueueKeys', [
+    'round_robin',
+    'group_prefix',
+    'depth',
+    'inflight',
+    'deadlines',
+    'sequence',
+])
+
+# 多个命令合并成一个 lua script，一次 round trip 并且在 redis 里原子地执行
+LUA_SCRIPTS = {
+    # key 存在才 incr / decr，不存在返回 nil
+    # KEYS[1]: count key, ARGV[1]: 1 或者 -1
+    'incr_if_exists': """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return nil
+        end
+        return redis.call('INCRBY', KEYS[1], ARGV[1])
+    """,
+    # timeline 的 sorted set，score 是 created_at 的微秒数
+    # zadd 之后马上设置过期时间，key 已经存在的话什么都不做，避免并发的 cache miss 重复写入
+    # 提前 refresh 的时候 ARGV[2] 是 1，先删除旧的 zset，整个替换是原子的
+    # KEYS[1]: zset key, ARGV[1]: 过期时间, ARGV[2]: 是否替换, ARGV[3:]: score, member, score, member ...
+    'zadd_expire': """
+        if ARGV[2] == '1' then
+            redis.call('DEL', KEYS[1])
+        elseif redis.call('EXISTS', KEYS[1]) == 1 then
+            return 0
+        end
+        for i = 3, #ARGV, 2 do
+            redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        return 1
+    """,
+    # key 存在才 zadd，并且只保留 score 最大的 ARGV[1] 个 member
+    # KEYS[1]: zset key, ARGV[1]: 长度上限, ARGV[2]: score, ARGV[3]: member
+    'zadd_if_exists': """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+        return 1
+    """,
+    # 公平队列：每个 group 一个 list，round robin list 里是还有数据的 groups
+    # group 的 list 从空变成非空的时候才加入 round robin，保证每个 group 只出现一次
+    # KEYS[1]: round robin key, KEYS[2]: group list key, KEYS[3]: 队列长度 key
+    # ARGV[1]: group, ARGV[2]: value
+    'push_fair_queue': """
+        if redis.call('RPUSH', KEYS[2], ARGV[2]) == 1 then
+            redis.call('RPUSH', KEYS[1], ARGV[1])
+        end
+        return redis.call('INCR', KEYS[3])
+    """,
+    # 从 round robin 的第一个 group 里取一个 value，group 还有数据的话放回队尾
+    # group list key 在调用之前先用 LINDEX 读出第一个 group 拼好，作为 KEYS 传进来
+    # 如果这期间第一个 group 被别的 worker 取走了就返回 {0}，调用的地方重新读取
+    # 取出来的 value 放进 in-flight，ack 之后才删除，超过 deadline 没有 ack 的会被放回队列
+    # job id 是 group:序号，重新放回队列的时候可以知道是哪个 group
+    # KEYS[1]: round robin key, KEYS[2]: group list key, KEYS[3]: 队列长度 key
+    # KEYS[4]: in-flight hash key, KEYS[5]: in-flight deadline zset key, KEYS[6]: 序号 key
+    # ARGV[1]: group, ARGV[2]: deadline
+    'pop_fair_queue': """
+        if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[1] then
+            return {0}
+        end
+        redis.call('LPOP', KEYS[1])
+        local value = redis.call('LPOP', KEYS[2])
+        if redis.call('LLEN', KEYS[2]) > 0 then
+            redis.call('RPUSH', KEYS[1], ARGV[1])
+        end
+        if not value then
+            return {1}
+        end
+        redis.call('DECR', KEYS[3])
+        local job_id = ARGV[1] .. ':' .. redis.call('INCR', KEYS[6])
+        redis.call('HSET', KEYS[4], job_id, value)
+        redis.call('ZADD', KEYS[5], ARGV[2], job_id)
+        return {1, value, job_id}
+    """,
+    # 超过 deadline 还没有 ack 的 value 放回 group 的 list 最前面，下次轮到这个 group 的时候先执行
+    # 在调用之前 ack 了或者已经被别的进程放回去了就什么都不做
+    # KEYS[1]: round robin key, KEYS[2]: group list key, KEYS[3]: 队列长度 key
+    # KEYS[4]: in-flight hash key, KEYS[5]: in-flight deadline zset key
+    # ARGV[1]: job id, ARGV[2]: group, ARGV[3]: 现在的时间
+    'requeue_fair_queue': """
+        local deadline = redis.call('ZSCORE', KEYS[5], ARGV[1])
+        if not deadline or tonumber(deadline) > tonumber(ARGV[3]) then
+            return 0
+        end
+        local value = redis.call('HGET', KEYS[4], ARGV[1])
+        redis.call('ZREM', KEYS[5], ARGV[1])
+        redis.call('HDEL', KEYS[4], ARGV[1])
+        if not value then
+            return 0
+        end
+        if redis.call('LPUSH', KEYS[2], value) == 1 then
+            redis.call('RPUSH', KEYS[1], ARGV[2])
+        end
+        redis.call('INCR', KEYS[3])
+        return 1
+    """,
+    # 只有持有 lease 的进程才能释放，避免 lease 过期之后删掉别人的 lease
+    # KEYS[1]: lease key, ARGV[1]: token
+    'release_lease': """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """,
+}
+
 
 class RedisHelper:
+    # script name -> redis-py Script，第一次调用的时候 EVALSHA 失败会自动 SCRIPT LOAD
+    _scripts = {}
+
+    @classmethod
+    def get_script(cls, name):
+        conn = RedisClient.get_connection()
+        script = cls._scripts.get(name)
+        if script is None or script.registered_client is not conn:
+            script = conn.register_script(LUA_SCRIPTS[name])
+            cls._scripts[name] = script
+        return script
+
+    @classmethod
+    def get_lease_key(cls, key):
+        return 'lease:{}'.format(key)
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
+    @contextmanager
+    def lease(cls, key):
+        """
+        同一个 key 同时只有一个进程去数据库 fill cache，拿到 lease 的时候 yield True
+        lease 有过期时间，fill 的进程挂掉也不会一直锁住这个 key
+        """
+        lease_key = cls.get_lease_key(key)
+        token = uuid.uuid4().hex
         conn = RedisClient.get_connection()
-        serialized_list = []
+        acquired = conn.set(
+            lease_key,
+            token,
+            nx = True,
+            px = int(settings.CACHE_LEASE_TIMEOUT * 1000),
+        )
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                cls.get_script('release_lease')(keys = [lease_key], args = [token])
 
+    @classmethod
+    def fill_once(cls, key, load, fill, read):
+        """
+        cache miss 的时候只有拿到 lease 的进程执行 load 并且 fill
+        其他进程等一小会再 read，等不到的话直接 load，但是不写 cache
+        """
+        with cls.lease(key) as acquired:
+            if acquired:
+                objects = load()
+                fill(objects)
+                return objects
+        objects = wait_for_fill(read)
+        if objects is not None:
+            return objects
+        return load()
+
+    @classmethod
+    def refresh_early(cls, key, ttl, load, fill):
+        # 快过期的时候由拿到 lease 的一个进程提前重新 load，其他进程继续使用现在的数据
+        if not should_refresh_early(ttl):
+            return
+        with cls.lease(key) as acquired:
+            if acquired:
+                fill(load())
+
+    @classmethod
+    def _load_timeline_to_cache(cls, key, objects, tweet_id_attr, replace = False):
+        args = [settings.REDIS_KEY_EXPIRE_TIME, int(replace)]
         for obj in objects:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-
-    @classmethod
-    def load_objects(cls, key, queryset):
-        # 最多只 cache REDIS_LIST_LENGTH_LIMIT 个 objects
-        # 超过这个限制的 objects 就去数据库里面读取。一般这个限制会比较大，比如200
-        # 因此翻页翻到 200 的用户访问量会比较少，从数据库读取也不是大问题
-        queryset = queryset[:settings.REDIS_LIST_LENGTH_LIMIT]
+            args.append(TimelineEntrySerializer.get_score(obj))
+            args.append(TimelineEntrySerializer.serialize(obj, tweet_id_attr))
+        if len(args) > 2 or replace:
+            cls.get_script('zadd_expire')(keys = [key], args = args)
+
+    @classmethod
+    def _query_timeline(cls, queryset, tweet_id_attr):
+        # 只需要这三个 field，不用从数据库读取整个 object
+        rows = queryset.values_list('id', tweet_id_attr, 'created_at')
+        return [
+            TimelineEntry(object_id, tweet_id, created_at)
+            for object_id, tweet_id, created_at in rows[:settings.REDIS_LIST_LENGTH_LIMIT]
+        ]
+
+    @classmethod
+    def _read_timeline(cls, key):
+        # 返回 (entries, ttl)，cache miss 的时候 entries 是 None
         conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction = False)
+        pipe.zrevrange(key, 0, -1)
+        pipe.ttl(key)
+        serialized_list, ttl = pipe.execute()
+        if not serialized_list:
+            return None, ttl
+        try:
+            return [
+                TimelineEntrySerializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ], ttl
+        except SchemaVersionError:
+            conn.delete(key)
+            return None, ttl
+
+    @classmethod
+    def load_timeline(cls, key, queryset, tweet_id_attr = 'id'):
+        """
+        只 cache (id, tweet_id, created_at)，返回 TimelineEntry 的 list
+        最多只 cache REDIS_LIST_LENGTH_LIMIT 个，更早的数据去数据库里读取
+        tweet 的内容由调用方通过 MemcachedHelper 批量读取
+        timeline 存在 sorted set 里，score 是 created_at 的微秒数
+        """
+        load = lambda: cls._query_timeline(queryset, tweet_id_attr)
 
-        # 如果在cache里存在，则直接拿出来，然后返回
-        if conn.exists(key):
+        entries, ttl = cls._read_timeline(key)
+        if entries is not None:
             # cache hit
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_object = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_object)
-            return objects
+            cls.refresh_early(
+                key,
+                ttl,
+                load,
+                lambda entries: cls._load_timeline_to_cache(key, entries, 'tweet_id', replace = True),
+            )
+            return entries
 
         # cache miss
-        cls._load_objects_to_cache(key, queryset)
+        return cls.fill_once(
+            key,
+            load,
+            lambda entries: cls._load_timeline_to_cache(key, entries, 'tweet_id'),
+            lambda: cls._read_timeline(key)[0],
+        )
+
+    @classmethod
+    def _read_timeline_page(cls, key, max_score, min_score, num):
+        # zcard，zrevrangebyscore 和 ttl 在一个 round trip 里执行
+        pipe = RedisClient.get_connection().pipeline(transaction = False)
+        pipe.zcard(key)
+        if num is None:
+            pipe.zrevrangebyscore(key, max_score, min_score)
+        else:
+            pipe.zrevrangebyscore(key, max_score, min_score, start = 0, num = num)
+        pipe.ttl(key)
+        return pipe.execute()
 
-        # 转换为list的原因是保持返回类型的统一，因为存在redis里的数据是list的形式
-        return list(queryset)
+    @classmethod
+    def load_timeline_page(
+            cls,
+            key,
+            queryset,
+            page_size,
+            tweet_id_attr = 'id',
+            created_at__lt = None,
+            created_at__gt = None):
+        """
+        只从 sorted set 里读取一页，返回 (entries, has_next_page)
+        cache 里的数据可能不全的时候返回 (None, False)，需要去数据库查询
+        """
+        max_score = '+inf'
+        min_score = '-inf'
+        # 多取一个数据，方便判断是否有下一页
+        num = page_size + 1
+        if created_at__gt is not None:
+            # 上翻页返回所有更新的数据，和数据库的分页保持一致
+            # sorted set 的长度有上限，所以最多也只有 REDIS_LIST_LENGTH_LIMIT 个
+            min_score = '({}'.format(datetime_to_micros(created_at__gt))
+            num = None
+        elif created_at__lt is not None:
+            max_score = '({}'.format(datetime_to_micros(created_at__lt))
+
+        def read():
+            page = cls._read_timeline_page(key, max_score, min_score, num)
+            return page if page[0] else None
+
+        page = read()
+        if page is None:
+            # cache miss，只有拿到 lease 的进程从数据库 load 整个 timeline
+            # 其他进程等它 fill 好之后读 cache，等不到的话返回 None，由调用方只查询这一页
+            with cls.lease(key) as acquired:
+                if acquired:
+                    entries = cls._query_timeline(queryset, tweet_id_attr)
+                    if not entries:
+                        return [], False
+                    cls._load_timeline_to_cache(key, entries, 'tweet_id')
+            page = read() if acquired else wait_for_fill(read)
+            if page is None:
+                return None, False
+            size, serialized_list, ttl = page
+        else:
+            size, serialized_list, ttl = page
+            cls.refresh_early(
+                key,
+                ttl,
+                lambda: cls._query_timeline(queryset, tweet_id_attr),
+                lambda entries: cls._load_timeline_to_cache(key, entries, 'tweet_id', replace = True),
+            )
+
+        try:
+            entries = [
+                TimelineEntrySerializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ]
+        except SchemaVersionError:
+            RedisClient.get_connection().delete(key)
+            return None, False
+
+        if created_at__gt is not None:
+            return entries, False
+        if len(entries) > page_size:
+            return entries[:page_size], True
+        # 如果 sorted set 的长度不是最大限制，说明 cache 里已经是所有数据了
+        if size < settings.REDIS_LIST_LENGTH_LIMIT:
+            return entries, False
+        # 数据库里可能还有没有 load 到 cache 里的数据
+        return None, False
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
-        queryset = queryset[:settings.REDIS_LIST_LENGTH_LIMIT]
+    def remove_timeline_entries(cls, key, queryset, entries, tweet_id_attr = 'id'):
+        """
+        从 sorted set 里删掉数据库里已经不存在的 entries
+        sorted set 是满的时候，删掉之后长度变短会被当成已经 cache 了所有数据，
+        所以改成从数据库重新 load 一次，用更早的数据补满
+        """
+        if not entries:
+            return
         conn = RedisClient.get_connection()
-        if not conn.exists(key):
-            # 如果key不存在，直接从数据库里面load
-            # 就不走单个push的方式加到cache里面了
-            cls._load_objects_to_cache(key, queryset)
+        if conn.zcard(key) < settings.REDIS_LIST_LENGTH_LIMIT:
+            conn.zrem(key, *[
+                TimelineEntrySerializer.serialize(entry, 'tweet_id')
+                for entry in entries
+            ])
             return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        with cls.lease(key) as acquired:
+            if acquired:
+                entries = cls._query_timeline(queryset, tweet_id_attr)
+                cls._load_timeline_to_cache(key, entries, 'tweet_id', replace = True)
+
+    @classmethod
+    def push_timeline_entry(cls, key, obj, queryset, tweet_id_attr = 'id'):
+        pushed = cls.get_script('zadd_if_exists')(
+            keys = [key],
+            args = [
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                TimelineEntrySerializer.get_score(obj),
+                TimelineEntrySerializer.serialize(obj, tweet_id_attr),
+            ],
+        )
+        if not pushed:
+            with cls.lease(key) as acquired:
+                if acquired:
+                    entries = cls._query_timeline(queryset, tweet_id_attr)
+                    cls._load_timeline_to_cache(key, entries, 'tweet_id')
+
+    @classmethod
+    def push_timeline_entries(cls, items, tweet_id_attr = 'id'):
+        """
+        items 是 [(key, obj)]，用一个 pipeline 一次 round trip 推送到多个 timeline
+        每个 key 单独执行一次 zadd_if_exists，不同的 key 在 redis cluster 里可以在不同的 slot
+        不存在的 key 直接跳过，不从数据库 load，下次读取的时候再 load
+        返回推送成功的个数
+        """
+        if not items:
+            return 0
+        script = cls.get_script('zadd_if_exists')
+        pipe = RedisClient.get_connection().pipeline(transaction = False)
+        for key, obj in items:
+            script(
+                keys = [key],
+                args = [
+                    settings.REDIS_LIST_LENGTH_LIMIT,
+                    TimelineEntrySerializer.get_score(obj),
+                    TimelineEntrySerializer.serialize(obj, tweet_id_attr),
+                ],
+                client = pipe,
+            )
+        return sum(pipe.execute())
+
+    @classmethod
+    def get_fair_queue_keys(cls, key):
+        # 所有 key 都带上同一个 {key} hash tag，redis cluster 里在同一个 slot，lua 里可以一起操作
+        tag = '{{{}}}'.format(key)
+        return FairQueueKeys(
+            round_robin = tag,
+            group_prefix = '{}:group:'.format(tag),
+            depth = '{}:depth'.format(tag),
+            inflight = '{}:inflight'.format(tag),
+            deadlines = '{}:inflight:deadlines'.format(tag),
+            sequence = '{}:sequence'.format(tag),
+        )
+
+    @classmethod
+    def push_fair_queue(cls, key, group, value):
+        """
+        把 value 放进 group 自己的 list，pop 的时候在所有 groups 之间轮流取
+        一个 group 一次放进很多 values 也不会让其他 groups 一直等，返回队列里一共有多少个 values
+        """
+        keys = cls.get_fair_queue_keys(key)
+        return cls.get_script('push_fair_queue')(
+            keys = [keys.round_robin, keys.group_prefix + str(group), keys.depth],
+            args = [group, value],
+        )
+
+    @classmethod
+    def pop_fair_queue(cls, key, timeout):
+        """
+        返回 (job_id, value)，队列是空的时候返回 None
+        处理完之后需要调用 ack_fair_queue，timeout 秒之内没有 ack 的会被 requeue_fair_queue 放回队列
+        """
+        keys = cls.get_fair_queue_keys(key)
+        conn = RedisClient.get_connection()
+        script = cls.get_script('pop_fair_queue')
+        while True:
+            group = conn.lindex(keys.round_robin, 0)
+            if group is None:
+                return None
+            group = group.decode('utf-8')
+            result = script(
+                keys = [
+                    keys.round_robin,
+                    keys.group_prefix + group,
+                    keys.depth,
+                    keys.inflight,
+                    keys.deadlines,
+                    keys.sequence,
+                ],
+                args = [group, time.time() + timeout],
+            )
+            # 第一个 group 已经被别的 worker 取走，重新读取
+            if result[0] == 0:
+                continue
+            if len(result) == 1:
+                return None
+            return result[2].decode('utf-8'), result[1]
+
+    @classmethod
+    def ack_fair_queue(cls, key, job_id):
+        keys = cls.get_fair_queue_keys(key)
+        pipe = RedisClient.get_connection().pipeline()
+        pipe.zrem(keys.deadlines, job_id)
+        pipe.hdel(keys.inflight, job_id)
+        removed, _ = pipe.execute()
+        return removed == 1
+
+    @classmethod
+    def requeue_fair_queue(cls, key):
+        """
+        把超过 deadline 还没有 ack 的 values 放回队列，返回放回去的个数
+        比如 worker 在处理的过程中挂掉或者超时被 kill 了
+        """
+        keys = cls.get_fair_queue_keys(key)
+        conn = RedisClient.get_connection()
+        now = time.time()
+        script = cls.get_script('requeue_fair_queue')
+        requeued = 0
+        for job_id in conn.zrangebyscore(keys.deadlines, '-inf', now):
+            job_id = job_id.decode('utf-8')
+            group = job_id.rsplit(':', 1)[0]
+            requeued += script(
+                keys = [
+                    keys.round_robin,
+                    keys.group_prefix + group,
+                    keys.depth,
+                    keys.inflight,
+                    keys.deadlines,
+                ],
+                args = [job_id, group, now],
+            )
+        return requeued
+
+    @classmethod
+    def get_fair_queue_depth(cls, key):
+        keys = cls.get_fair_queue_keys(key)
+        conn = RedisClient.get_connection()
+        return int(conn.get(keys.depth) or 0)
+
+    @classmethod
+    def get_fair_queue_inflight(cls, key):
+        keys = cls.get_fair_queue_keys(key)
+        conn = RedisClient.get_connection()
+        return conn.zcard(keys.deadlines)
+
+    @classmethod
+    def delete_legacy_keys(cls, prefixes, batch_size = 1000):
+        """
+        删除 prefix + user_id 格式的旧 key，例如 'user_tweets:1'，返回删除的个数
+        用 scan 而不是 keys，不会长时间阻塞 redis，'user_tweets:z:1' 这样的新 key 不会被删除
+        """
+        conn = RedisClient.get_connection()
+        deleted = 0
+        for prefix in prefixes:
+            keys = []
+            for key in conn.scan_iter(match = prefix + '*', count = batch_size):
+                if not key[len(prefix):].isdigit():
+                    continue
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    deleted += conn.delete(*keys)
+                    keys = []
+            if keys:
+                deleted += conn.delete(*keys)
+        return deleted
 
     @classmethod
     def get_count_key(cls, obj, attr):
@@ -59,31 +532,33 @@ class RedisHelper:
 
     @classmethod
     def incr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
         # return conn.incr(key)
-        if conn.exists(key):
-            return conn.incr(key)
+        count = cls.get_script('incr_if_exists')(keys = [key], args = [1])
+        if count is not None:
+            return count
         # back fill cache from db
         # 不执行+1操作，因为必须保证调用incr_count之前obj.attr已经+1过了
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+        return cls._backfill_count(key, obj, attr)
 
 
     @classmethod
     def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
         # return conn.decr(key)
-        if conn.exists(key):
-            return conn.decr(key)
+        count = cls.get_script('incr_if_exists')(keys = [key], args = [-1])
+        if count is not None:
+            return count
         # back fill cache from db
         # 不执行-1操作，因为必须保证调用decr_count之前obj.attr已经-1过了
+        return cls._backfill_count(key, obj, attr)
+
+    @classmethod
+    def _backfill_count(cls, key, obj, attr):
         obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        conn = RedisClient.get_connection()
+        # set 的同时设置过期时间，一次 round trip
+        conn.set(key, getattr(obj, attr), ex = settings.REDIS_KEY_EXPIRE_TIME)
         return getattr(obj, attr)
 
     @classmethod
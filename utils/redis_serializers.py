@@ -1,5 +1,10 @@
 from django.core import serializers
+from django.utils import timezone
 from utils.json_encoder import JSONEncoder
+from collections import namedtuple
+
+import datetime
+import struct
 
 
 class DjangoModelSerializer:
@@ -14,4 +19,58 @@ class DjangoModelSerializer:
     def deserialize(cls, serialized_data):
         # 需要加 .object 来得到原始的model类型的object数据，否则得到的数据并不是一个
         # ORM的object，而是一个 DeserializerdObject 的类型
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class SchemaVersionError(ValueError):
+    pass
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo = timezone.utc)
+
+
+def datetime_to_micros(value):
+    # 存储成 UTC 的微秒数，和 json 格式一样保留 micro second
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def micros_to_datetime(micros):
+    return EPOCH + datetime.timedelta(microseconds = micros)
+
+
+TimelineEntry = namedtuple('TimelineEntry', ['id', 'tweet_id', 'created_at'])
+
+
+class TimelineEntrySerializer:
+    """
+    timeline 里只存储 (version, id, tweet_id, created_at)，固定 25 个字节
+    tweet 的内容放在 memcached 里所有用户共享，不会在每个 follower 的 list 里重复存储
+    对于 Tweet 自己的 timeline，id 和 tweet_id 是一样的
+    """
+    # 第一个字节是格式的版本号，格式改变的时候加 1，旧版本的 entry 读取的时候当成 cache miss
+    VERSION = 1
+    STRUCT = struct.Struct('>Bqqq')
+
+    @classmethod
+    def serialize(cls, obj, tweet_id_attr = 'id'):
+        # tweet 被删除之后 NewsFeed.tweet_id 会变成 NULL，用 0 表示
+        tweet_id = getattr(obj, tweet_id_attr) or 0
+        return cls.STRUCT.pack(
+            cls.VERSION,
+            obj.id,
+            tweet_id,
+            datetime_to_micros(obj.created_at),
+        )
+
+    @classmethod
+    def get_score(cls, obj):
+        # 微秒数小于 2^53，作为 sorted set 的 score 不会丢失精度
+        return datetime_to_micros(obj.created_at)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if len(serialized_data) != cls.STRUCT.size or serialized_data[0] != cls.VERSION:
+            raise SchemaVersionError('Not a timeline entry of version {}'.format(cls.VERSION))
+        _, object_id, tweet_id, micros = cls.STRUCT.unpack(serialized_data)
+        return TimelineEntry(object_id, tweet_id or None, micros_to_datetime(micros))
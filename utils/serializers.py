@@ -0,0 +1,15 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    many = True 的时候，渲染之前先调用 child.prefetch(objects)
+    把整页需要的 user / tweet 用 get_many 批量读取到 cache 里，渲染每一项的时候就都是 L1 hit
+    Meta 里设置 list_serializer_class = PrefetchListSerializer 并且实现 prefetch 方法
+    """
+
+    def to_representation(self, data):
+        objects = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.prefetch(objects)
+        return super(PrefetchListSerializer, self).to_representation(objects)
@@ -1,3 +1,4 @@
 ONE_HOUR = 60 * 60
+ONE_DAY = 24 * ONE_HOUR
 
 MAX_TIMESTAMP = 9999999999999999
\ No newline at end of file